@@ -0,0 +1,190 @@
+from typing import *
+
+# Positions of the bits set in every byte value, most significant bit
+# first (bit 0 is the high bit of the first byte, as in BITFIELD messages)
+_SET_BITS: List[Tuple[int, ...]] = [
+    tuple(i for i in range(8) if byte & (0x80 >> i)) for byte in range(256)
+]
+_BOOLS: List[Tuple[bool, ...]] = [
+    tuple(bool(byte & (0x80 >> i)) for i in range(8)) for byte in range(256)
+]
+
+if hasattr(int, "bit_count"):
+    def _popcount(data: bytes) -> int:
+        return int.from_bytes(data, "big").bit_count()
+else: # python < 3.10
+    def _popcount(data: bytes) -> int:
+        return bin(int.from_bytes(data, "big")).count("1")
+
+
+class Bitfield:
+    """
+    Which pieces someone has: one bit per piece, stored exactly as in a
+    BITFIELD message (the high bit of the first byte is piece 0, spare
+    bits at the end are zero), so that encoding it for the wire costs
+    nothing.
+
+    The number of pieces set is kept up to date on every change: `count`
+    and `complete` are O(1). Set operations (&, |, - for "and not")
+    work on whole bytes at once.
+    """
+
+    __slots__ = ("length", "data", "_count")
+
+    def __init__(self, length: int, data: Union[bytes, bytearray, memoryview] = None):
+        self.length = length
+        num_bytes = (length + 7) >> 3
+
+        if data is None:
+            self.data = bytearray(num_bytes)
+            self._count = 0
+            return
+
+        if len(data) != num_bytes:
+            raise ValueError("A bitfield of {} pieces is {} bytes long, not {}".format(
+                length, num_bytes, len(data)
+            ))
+
+        self.data = bytearray(data)
+        self._clear_spare_bits()
+        self._count = _popcount(self.data)
+
+
+    @classmethod
+    def full(cls, length: int) -> "Bitfield":
+        return cls(length, b"\xff" * ((length + 7) >> 3))
+
+
+    @classmethod
+    def from_bools(cls, bools: Iterable[bool]) -> "Bitfield":
+        bools = list(bools)
+        bitfield = cls(len(bools))
+        for i, b in enumerate(bools):
+            if b:
+                bitfield[i] = True
+        return bitfield
+
+
+    @classmethod
+    def from_string(cls, s: str) -> "Bitfield":
+        """ From a string of "0" and "1", one per piece. """
+        length = len(s)
+        num_bytes = (length + 7) >> 3
+        value = int(s + "0" * (8 * num_bytes - length), 2) if length > 0 else 0
+        return cls(length, value.to_bytes(num_bytes, "big"))
+
+
+    def to_string(self) -> str:
+        if self.length == 0:
+            return ""
+        return format(int.from_bytes(self.data, "big"), "0{}b".format(8 * len(self.data)))[:self.length]
+
+
+    def to_bytes(self) -> bytes:
+        """ The payload of a BITFIELD message. """
+        return bytes(self.data)
+
+
+    def view(self) -> memoryview:
+        """ The payload of a BITFIELD message, without copies. """
+        return memoryview(self.data)
+
+
+    def copy(self) -> "Bitfield":
+        other = Bitfield.__new__(Bitfield)
+        other.length, other.data, other._count = self.length, bytearray(self.data), self._count
+        return other
+
+
+    def count(self) -> int:
+        """ How many pieces are set. """
+        return self._count
+
+    @property
+    def complete(self) -> bool:
+        return self._count == self.length
+
+
+    def __len__(self):
+        return self.length
+
+
+    def __getitem__(self, i: int) -> bool:
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError("Piece {} out of range".format(i))
+        return bool(self.data[i >> 3] & (0x80 >> (i & 7)))
+
+
+    def __setitem__(self, i: int, value: bool):
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError("Piece {} out of range".format(i))
+
+        mask = 0x80 >> (i & 7)
+        byte = self.data[i >> 3]
+        if value and not byte & mask:
+            self.data[i >> 3] = byte | mask
+            self._count += 1
+        elif not value and byte & mask:
+            self.data[i >> 3] = byte & ~mask
+            self._count -= 1
+
+
+    def __iter__(self) -> Iterator[bool]:
+        bools, remaining = _BOOLS, self.length
+        for byte in self.data:
+            if remaining >= 8:
+                yield from bools[byte]
+            else:
+                yield from bools[byte][:remaining]
+            remaining -= 8
+
+
+    def indices(self, value: bool = True) -> Iterator[int]:
+        """ The pieces that are set (or not set, if `value` is False). """
+        set_bits, flip = _SET_BITS, 0 if value else 0xFF
+        for byte_index, byte in enumerate(self.data):
+            byte ^= flip
+            if byte == 0:
+                continue
+            base = byte_index << 3
+            for bit in set_bits[byte]:
+                if base + bit >= self.length: # spare bits, when looking for zeros
+                    return
+                yield base + bit
+
+
+    def _combine(self, other: "Bitfield", op: Callable[[int, int], int]) -> "Bitfield":
+        if self.length != other.length:
+            raise ValueError("Bitfields of {} and {} pieces".format(self.length, other.length))
+        value = op(int.from_bytes(self.data, "big"), int.from_bytes(other.data, "big"))
+        return Bitfield(self.length, value.to_bytes(len(self.data), "big"))
+
+    def __and__(self, other: "Bitfield") -> "Bitfield":
+        return self._combine(other, lambda a, b: a & b)
+
+    def __or__(self, other: "Bitfield") -> "Bitfield":
+        return self._combine(other, lambda a, b: a | b)
+
+    def __sub__(self, other: "Bitfield") -> "Bitfield":
+        """ The pieces set in self but not in other. """
+        return self._combine(other, lambda a, b: a & ~b)
+
+
+    def __eq__(self, other):
+        if not isinstance(other, Bitfield):
+            return NotImplemented
+        return self.length == other.length and self.data == other.data
+
+
+    def __repr__(self):
+        return "<Bitfield {}/{}>".format(self._count, self.length)
+
+
+    def _clear_spare_bits(self):
+        spare = 8 * len(self.data) - self.length
+        if spare > 0:
+            self.data[-1] &= (0xFF << spare) & 0xFF
@@ -0,0 +1,74 @@
+import random
+
+from typing import *
+
+Address = Tuple[str, int]
+
+
+class Choker:
+    """
+    Decides which peers we upload to (unchoke), among those interested
+    in our pieces.
+
+    Every `round_interval` seconds, while downloading, the peers that
+    give us the most (tit-for-tat, on the measured download rates; those
+    snubbing us give nothing) get all the upload slots but one; the last
+    one goes to a random peer, rotated every `optimistic_interval`
+    seconds, so that new peers get a chance to show how fast they are.
+    When seeding there is nothing to
+    reciprocate: the slots go to the peers we upload to the fastest, but
+    peers that had their turn (unchoked for `optimistic_interval`) make
+    room for those waiting, in round-robin.
+
+    The peers are the master's ConnectionStatus, with `interested`,
+    `am_choking`, `unchoked_at`, `rate`, `upload_rate` and `snubbed`.
+    """
+
+    def __init__(self, upload_slots=4, round_interval=10.0, optimistic_interval=30.0,
+                 rng: random.Random = None):
+        self.upload_slots = max(1, upload_slots)
+        self.round_interval = round_interval
+        self.optimistic_interval = optimistic_interval
+        self.rng = rng if rng is not None else random.Random()
+
+        self.optimistic: Optional[Address] = None
+        self.optimistic_since = 0.0
+
+
+    def has_free_slot(self, peers: Dict[Address, Any]) -> bool:
+        """ True if a peer can be unchoked right away, before the next round. """
+        return sum(not p.am_choking for p in peers.values()) < self.upload_slots
+
+
+    def round(self, peers: Dict[Address, Any], seeding: bool, now: float) -> Set[Address]:
+        """
+        Returns the peers to unchoke until the next round; all the
+        others are to be choked.
+        """
+        interested = {a: p for a, p in peers.items() if p.interested}
+
+        if seeding:
+            def had_turn(p):
+                return p.unchoked_at is not None and now - p.unchoked_at >= self.optimistic_interval
+            ranked = sorted(interested, key=lambda a: (had_turn(interested[a]), -interested[a].upload_rate))
+        else:
+            ranked = sorted((a for a in interested if not interested[a].snubbed),
+                            key=lambda a: -interested[a].rate)
+
+        # One slot is kept for the optimistic unchoke
+        regular = ranked[:self.upload_slots - 1]
+
+        if (self.optimistic not in interested or self.optimistic in regular or
+            now - self.optimistic_since >= self.optimistic_interval):
+            self.optimistic = None
+
+        if self.optimistic is None:
+            candidates = [a for a in interested if a not in regular]
+            if candidates:
+                self.optimistic = self.rng.choice(candidates)
+                self.optimistic_since = now
+
+        unchoked = set(regular)
+        if self.optimistic is not None:
+            unchoked.add(self.optimistic)
+        return unchoked
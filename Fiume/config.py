@@ -11,6 +11,10 @@ BITMAPS_DIR = DOT_DIRECTORY / "bitmaps"
 if not BITMAPS_DIR.exists():
     Path.mkdir(BITMAPS_DIR)
 
+PEERS_DIR = DOT_DIRECTORY / "peers"
+if not PEERS_DIR.exists():
+    Path.mkdir(PEERS_DIR)
+
 IN_DOWNLOAD_FILE = DOT_DIRECTORY / "downloading.json"
 if not IN_DOWNLOAD_FILE.exists():
     IN_DOWNLOAD_FILE.touch()
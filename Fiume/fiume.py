@@ -9,6 +9,11 @@ import Fiume.metainfo_decoder as md
 import Fiume.state_machine as sm
 import Fiume.config as config
 
+from Fiume.peer_engine import PeerEngine
+from Fiume.piece_cache import PieceCache
+from Fiume.hasher import Hasher
+from Fiume.tracker_client import TrackerClient
+
 from Fiume.utils import *
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler, FileModifiedEvent
@@ -41,11 +46,29 @@ class Fiume:
 
         self.port = self.options["port"]
         self.host = "localhost"
+
+        # Looked up once for all the torrents, in background (or given)
+        if self.options.get("external_ip") is not None:
+            set_external_ip(self.options["external_ip"])
+        else:
+            get_external_ip()
         
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.bind((self.host, self.port))
 
+        # One event loop for all the peers of all the torrents
+        self.engine = None
+        if self.options.get("peer_engine", "asyncio") == "asyncio":
+            self.engine = PeerEngine(self.options)
+
+        # ...and one memory budget for the pieces they upload
+        self.piece_cache = PieceCache(self.options.get("cache_size", 64) * 2**20)
+        # ...and one pool of threads hashing the pieces they download
+        self.hasher = Hasher(self.options.get("hash_workers"))
+        # ...and one client, keeping connections open, for the announces to trackers
+        self.tracker_client = TrackerClient(self.options)
+
 
     def begin_session(self):
         """
@@ -80,11 +103,11 @@ class Fiume:
                 bencodepy.decode(f.read()) | local_options
             )
 
-        tm = md.TrackerManager(metainfo, local_options)
+        tm = md.TrackerManager(metainfo, local_options, client=self.tracker_client)
             
         t = sm.ThreadedServer(
-            metainfo, tm, socket=self.sock,
-            **local_options
+            metainfo, tm, listen_sock=self.sock, engine=self.engine,
+            piece_cache=self.piece_cache, hasher=self.hasher, **local_options
         )
 
         self.open_connections[local_options["torrent_path"]] = (local_options, t.master_queue)
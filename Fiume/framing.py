@@ -0,0 +1,144 @@
+import socket
+
+from typing import *
+
+import Fiume.utils as utils
+
+HANDSHAKE_LENGTH = 68
+
+
+class FrameBuffer:
+    """
+    Splits the byte stream coming from a peer into protocol messages.
+
+    Data is read in large chunks (ideally with a single `recv_into` per
+    syscall, straight into the buffer), and all the complete messages
+    it contains are returned at once as memoryview slices of the buffer,
+    with no copies. The partial message at the end, if any, is moved back
+    at the start of the buffer before the next read.
+
+    Slices are valid only until the next call to `recv_from`/`feed`: who
+    needs a message for longer (eg. to pass it to another thread) must
+    copy it with bytes().
+
+    Messages are returned as they travel on the wire, length prefix
+    included; the first one is the HANDSHAKE, if `handshake` is True.
+    Keep-alives (length 0) are only counted in `keep_alives`.
+    """
+
+    def __init__(self, size: int = 1 << 16, max_message: int = 1 << 24,
+                 handshake: bool = True):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0 # first byte not yet returned as a message
+        self.end = 0   # first free byte
+
+        self.max_message = max_message
+        self.expect_handshake = handshake
+        self.keep_alives = 0
+
+
+    def __len__(self):
+        return self.end - self.start
+
+
+    def writable(self, at_least: int = 1) -> memoryview:
+        """
+        Free space at the end of the buffer, where new data can be written.
+        Makes room (and grows the buffer if needed) for the message being
+        received and at least `at_least` more bytes.
+        """
+        needed = max(at_least, self._missing())
+
+        if len(self.buffer) - self.end < needed:
+            pending = self.end - self.start
+
+            if len(self.buffer) - pending < needed:
+                # Non c'è spazio nemmeno compattando: nuovo buffer, più grande
+                # (the old one cannot be resized while slices of it exist)
+                buffer = bytearray(max(2 * len(self.buffer), pending + needed))
+                buffer[:pending] = self.view[self.start:self.end]
+                self.buffer, self.view = buffer, memoryview(buffer)
+            else:
+                # Sposta il messaggio incompleto all'inizio del buffer
+                self.view[:pending] = self.view[self.start:self.end]
+
+            self.start, self.end = 0, pending
+
+        return self.view[self.end:]
+
+
+    def commit(self, n: int):
+        """ Registers that `n` bytes were written in writable(). """
+        self.end += n
+
+
+    def feed(self, data: bytes):
+        """ Appends data received by other means (eg. asyncio streams). """
+        self.writable(len(data))[:len(data)] = data
+        self.commit(len(data))
+
+
+    def recv_from(self, sock: socket.socket) -> int:
+        """
+        Reads whatever is available from `sock` (blocking until at least
+        one byte arrives). Returns 0 when the peer closed the connection.
+        """
+        n = sock.recv_into(self.writable())
+        self.commit(n)
+        return n
+
+
+    def messages(self) -> Iterator[memoryview]:
+        """
+        Yields all the complete messages in the buffer.
+        """
+        if self.expect_handshake:
+            if self.end - self.start < HANDSHAKE_LENGTH:
+                return
+            self.expect_handshake = False
+            self.start += HANDSHAKE_LENGTH
+            yield self.view[self.start-HANDSHAKE_LENGTH:self.start]
+
+        # Hot loop: local variables only
+        buffer, view, start, end = self.buffer, self.view, self.start, self.end
+        from_bytes = int.from_bytes
+
+        try:
+            while end - start >= 4:
+                length = 4 + from_bytes(buffer[start:start+4], "big")
+                if length > self.max_message:
+                    raise ValueError("Message of {} bytes is too long".format(length))
+                if end - start < length:
+                    return
+
+                start += length
+                if length == 4:
+                    self.keep_alives += 1
+                    continue
+
+                self.start = start
+                yield view[start-length:start]
+        finally:
+            self.start = start
+
+
+    def _next_length(self) -> Optional[int]:
+        """ Total length of the next message, if already known. """
+        if self.expect_handshake:
+            return HANDSHAKE_LENGTH
+        if self.end - self.start < 4:
+            return None
+
+        length = 4 + utils.to_int(self.view[self.start:self.start+4])
+        if length > self.max_message:
+            raise ValueError("Message of {} bytes is too long".format(length))
+        return length
+
+
+    def _missing(self) -> int:
+        """ How many bytes are still missing to complete the next message. """
+        length = self._next_length()
+        if length is None:
+            return 4 - (self.end - self.start)
+        return max(0, length - (self.end - self.start))
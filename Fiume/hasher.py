@@ -0,0 +1,86 @@
+import os
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import *
+
+import Fiume.piece_buffer as pb
+
+
+class Hasher:
+    """
+    Verifies the SHA-1 of downloaded pieces on a pool of worker threads,
+    shared by all the peer connections of a torrent (or of a whole
+    session), so that hashing a piece never stops a connection from
+    processing its messages. hashlib releases the GIL while hashing
+    large buffers: the workers do run in parallel.
+
+    Pieces are hashed incrementally: whenever the blocks at the start
+    of a piece have arrived, in order, they are hashed right away, and
+    when the piece is complete only its tail is left to hash.
+    """
+
+    def __init__(self, workers: Optional[int] = None):
+        self.workers = workers if workers else (os.cpu_count() or 1)
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="Hasher")
+
+        self.lock = threading.Lock()
+        self.verified, self.failed = 0, 0
+
+        self.logger = logging.getLogger("Hasher")
+
+
+    def __repr__(self):
+        return "<Hasher {} workers, verified={} failed={}>".format(
+            self.workers, self.verified, self.failed
+        )
+
+
+    def update(self, piece: pb.PieceBuffer):
+        """
+        Hashes, in background, the blocks of the piece received so far
+        in order (if not done already).
+        """
+        if piece.hash_pending or not piece.can_hash():
+            return
+
+        piece.hash_pending = True
+        self.pool.submit(self._hash_prefix, piece)
+
+
+    def verify(self, piece: pb.PieceBuffer, expected: bytes,
+               done: Callable[[pb.PieceBuffer, bool], None]):
+        """
+        Compares, in background, the hash of a complete piece with the
+        `expected` one. `done(piece, matches)` is called by the worker
+        thread (callers hand the result over to their own thread).
+        """
+        def check() -> bool:
+            # Whatever happens, done must be called: a piece nobody
+            # hears back about would never be downloaded again
+            try:
+                matches = piece.digest() == expected
+            except Exception:
+                self.logger.exception("Could not hash piece %s", piece.index)
+                matches = False
+
+            with self.lock:
+                if matches:
+                    self.verified += 1
+                else:
+                    self.failed += 1
+            return matches
+
+        future = self.pool.submit(check)
+        future.add_done_callback(lambda f: done(piece, f.result()))
+
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+
+
+    def _hash_prefix(self, piece: pb.PieceBuffer):
+        # Cleared first: blocks arriving while hashing submit a new task
+        piece.hash_pending = False
+        piece.hash_prefix()
@@ -1,38 +1,140 @@
 import threading
 import logging 
+import math
+import time
 
-from queue import Queue
+from queue import Queue, Empty
 from typing import *
 
 from Fiume.utils import *
+import Fiume.storage as storage_mod
+import Fiume.resume as resume_mod
+import Fiume.picker as picker_mod
+import Fiume.piece_table as piece_table_mod
+import Fiume.choker as choker_mod
 
 logging.basicConfig(
     level=logging.DEBUG,
     format="[%(levelname)s] [%(name)s] %(message)s"
 )
 
+# Pieces queued for a single peer, at most
+MAX_SCHEDULE = 64
+
 class ConnectionStatus:
-    def __init__(self, peer):
+    # Weight of the newest sample in the rate and latency EWMAs
+    ALPHA = 0.3
+    # Reports closer than this (seconds) are merged in a single rate sample
+    MIN_INTERVAL = 0.5
+    # Seconds without any byte after which the rate decays (see decay_rate)
+    STALL_INTERVAL = 5.0
+    
+    def __init__(self, peer, now: float = 0.0):
+        self.peer = peer
         self.queue_in: Queue    = peer.queue_in
         self.peer_has: Set[int] = set()
         self.already_scheduled: Set[int] = set()
+        # Pieces that the peer has, that we don't have and that are not
+        # scheduled for anyone: the candidates for the next schedule.
+        # Kept up to date by the master.
+        self.wanted: Set[int] = set()
+
+        # Download rate from the peer (bytes/sec, EWMA), from the bytes
+        # that its peer manager reports with PIECE and PEER_HAS; 0 until known
+        self.rate: float = 0.0
+        self._interval_start = now
+        self._interval_bytes = 0
+        # Seconds between scheduling a piece and its completion (EWMA)
+        self.piece_latency: Optional[float] = None
+        self.scheduled_at: Dict[int, float] = dict()
+        # Pieces the peer manager completed with a wrong hash: not
+        # scheduled to it again, as long as other peers have them
+        self.hash_failed: Set[int] = set()
+        # The peer leaves our REQUESTs unanswered (see PeerManager.check_timeouts):
+        # until it sends data again, it gets a single piece at a time, and
+        # the choker does not reciprocate it
+        self.snubbed = False
+
+        # Upload side, for the choker: is the peer interested in our pieces,
+        # are we uploading to it (since when), and how fast (bytes/sec, EWMA,
+        # from the bytes its peer manager sent, updated every choke round)
+        self.interested = False
+        self.am_choking = True
+        self.unchoked_at: Optional[float] = None
+        self.upload_rate: float = 0.0
+        self._uploaded = 0
+        self._uploaded_at = now
 
         
-    def update_peer_has(self, pieces: List[int]):
+    def update_rate(self, downloaded: int, now: float):
         """
-        Updates local list of pieces possessed by the peer.
+        Accounts `downloaded` bytes, received from the peer since the
+        previous report.
+        """
+        self._interval_bytes += downloaded
+        if downloaded > 0:
+            self.snubbed = False
+        
+        elapsed = now - self._interval_start
+        if elapsed < self.MIN_INTERVAL or self._interval_bytes == 0:
+            return
+
+        sample = self._interval_bytes / elapsed
+        self.rate = sample if self.rate == 0 else (
+            self.ALPHA * sample + (1 - self.ALPHA) * self.rate
+        )
+        self._interval_start = now
+        self._interval_bytes = 0
+
+
+    def decay_rate(self, now: float):
+        """
+        Called every choke round: if the peer sent nothing for a while,
+        the silence is a sample of 0 bytes/sec. Otherwise a stalled peer
+        would keep its last rate, and as many pieces as it deserved then.
         """
-        self.peer_has |= set(pieces)
+        if self.rate == 0 or self._interval_bytes > 0:
+            return
+        if now - self._interval_start < self.STALL_INTERVAL:
+            return
+
+        self.rate *= 1 - self.ALPHA
+        self._interval_start = now
+
+
+    def update_upload_rate(self, uploaded: int, now: float):
+        """ `uploaded` is the total of bytes sent to the peer, so far. """
+        elapsed = now - self._uploaded_at
+        if elapsed <= 0:
+            return
+
+        sample = (uploaded - self._uploaded) / elapsed
+        self.upload_rate = sample if self.upload_rate == 0 else (
+            self.ALPHA * sample + (1 - self.ALPHA) * self.upload_rate
+        )
+        self._uploaded, self._uploaded_at = uploaded, now
+
+
+    def update_latency(self, piece_idx: int, now: float):
+        """ The piece, scheduled for this peer, was completed by it. """
+        scheduled_at = self.scheduled_at.pop(piece_idx, None)
+        if scheduled_at is None:
+            return
+
+        sample = now - scheduled_at
+        self.piece_latency = sample if self.piece_latency is None else (
+            self.ALPHA * sample + (1 - self.ALPHA) * self.piece_latency
+        )
 
-    def set_suggested(self, pieces: List[int]):
-        self.already_scheduled |= set(pieces)
         
-    def not_yet_scheduled(self) -> Set[int]:
+    def update_peer_has(self, pieces: List[int]) -> Set[int]:
         """
-        Returns all the pieces that the peer has and that 
-        were not already scheduled for request.
+        Updates local list of pieces possessed by the peer.
+        Returns the pieces that were not known before.
         """
-        return self.peer_has - self.already_scheduled
+        new_pieces = set(pieces) - self.peer_has
+        self.peer_has |= new_pieces
+        return new_pieces
 
     
     def completed_piece(self, piece_idx: int):
@@ -40,12 +142,16 @@ class ConnectionStatus:
         When we receive the full piece, remove it from the 
         already_scheduled set.
         """
-        self.already_scheduled -= {piece_idx}
+        self.already_scheduled.discard(piece_idx)
+        self.scheduled_at.pop(piece_idx, None)
 
 
         
 class MasterControlUnit:
-    def __init__(self, metainfo, initial_bitmap, cm_queue, tracker_manager, options):
+    def __init__(self, metainfo, initial_bitmap, cm_queue, tracker_manager, options,
+                 storage: "storage_mod.Storage" = None,
+                 resume: "resume_mod.ResumeFile" = None,
+                 piece_table: "piece_table_mod.PieceTable" = None):
         self.logger = logging.getLogger("Master")
         self.logger.setLevel(options.get("debug_level", logging.DEBUG))
         
@@ -53,14 +159,64 @@ class MasterControlUnit:
         self.tracker_manager = tracker_manager
         self.options  = options
         
-        self.bitmap: List[bool] = initial_bitmap
+        # Owns the resume file: only the master marks pieces as downloaded
+        # (without a ResumeFile, the bitmap is not saved anywhere)
+        self.resume = resume if resume is not None else resume_mod.ResumeFile(
+            None, initial_bitmap, None
+        )
+        self.bitmap: Bitfield = self.resume.bitmap
         
         self.connections: Dict[Address, ConnectionStatus] = dict()
+
+        # Scheduling indexes, updated incrementally (on PEER_HAS, PIECE and
+        # DISCONNECTED) so that no decision has to look at every peer:
+        # - which PeerManagers are downloading each piece (more than one
+        #   only in endgame)
+        self.scheduled: Dict[int, Set[Address]] = dict()
+        # - which peers have each piece that we miss
+        self.owners: Dict[int, Set[Address]] = dict()
+        # (and the pieces we miss are the zeros of self.bitmap)
+
+        # Policy for choosing the next pieces; knows how many peers have each one
+        self.picker = picker_mod.make_picker(options.get("piece_picker", "rarest"))
+        if options.get("streaming", False):
+            self.start_streaming()
+        # Notified at every new piece (eg. for StreamReaders waiting for it)
+        self.piece_completed = threading.Condition()
+
+        # Endgame: when few blocks are missing, the pieces still in flight
+        # are requested from every peer that has them (the first copy wins,
+        # the others are cancelled), so that a slow peer can't hold back
+        # the end of the download
+        self.endgame = False
+        self.endgame_blocks  = options.get("endgame_blocks", 32)
+        self.blocks_per_piece = math.ceil(metainfo.piece_size / metainfo.block_size)
+
+        # How many seconds of download, at its current rate, are scheduled
+        # ahead for each peer: fast peers keep enough pieces to stay busy,
+        # slow ones don't hoard pieces that others could deliver sooner
+        self.schedule_horizon = options.get("schedule_horizon", 5.0)
+        self.clock = time.monotonic
+
+        # Which peers we upload to: re-decided every round
+        self.choker = choker_mod.Choker(options.get("upload_slots", 4))
+        self.next_choke_round = self.clock() + self.choker.round_interval
+
+        # The pieces the peer managers are filling, block by block: a piece
+        # in flight with blocks nobody requested can be given to more peers
+        self.piece_table = piece_table if piece_table is not None else (
+            piece_table_mod.PieceTable(metainfo.block_size)
+        )
+        
         self.queue_in = Queue()
         self.queue_connection_manager = cm_queue
         
-        # To prohbit concurrent access to the download file
-        self.lock_download_file = threading.Lock()
+        # Reads and writes are positional: no lock needed around them
+        self.storage = storage if storage is not None else storage_mod.open_storage(
+            options.get("storage", "file"),
+            metainfo.download_fpath,
+            metainfo.total_size
+        )
 
         
     def get_master_queue(self) -> Queue:
@@ -74,8 +230,8 @@ class MasterControlUnit:
         """
         Call this when you connect to a new peer.
         """
-        self.connections[peer.address] = ConnectionStatus(peer)
-        self.send_to(peer.address, M_OUR_BITMAP(self.bitmap))
+        self.connections[peer.address] = ConnectionStatus(peer, self.clock())
+        self.send_to(peer.address, M_OUR_BITMAP(self.bitmap.copy()))
         
         
     def send_to(self, address: Address, mex: MasterMex):
@@ -99,32 +255,75 @@ class MasterControlUnit:
         When receiving PIECE message, updates the global bitmap.
         Must also inform all peers of this update!
         """
-        self.bitmap[new_piece] = True
-
-        update_bitmap_file( # in utils.py
-            self.metainfo.download_fpath,
-            self.bitmap
-        )
+        self.resume.mark(new_piece) # saved later, with other pieces
+        with self.piece_completed:
+            self.piece_completed.notify_all()
 
         self.send_all(M_NEW_HAVE(new_piece), peer_from)
         
 
-    def bitmap_to_set(self) -> Set[int]:
-        # TODO: sposta in utils
-        out = set()
-        for i in range(len(self.bitmap)):
-            if self.bitmap[i]:
-                out.add(i)
-        return out
-
-    
     def already_scheduled(self) -> Set[int]:
         """
         Returns all the pieces already scheduled by any peerManager.
         """
-        return set.union(
-            *[state.already_scheduled for state in self.connections.values()]
-        )
+        return set(self.scheduled)
+
+
+    def peer_has(self, address: Address, pieces: List[int]):
+        """
+        Registers the pieces announced by a peer (BITFIELD or HAVE).
+        """
+        state = self.connections[address]
+        new_pieces = state.update_peer_has(pieces)
+        self.picker.peer_has(new_pieces)
+
+        for p in new_pieces:
+            if self.bitmap[p]:
+                continue
+            self.owners.setdefault(p, set()).add(address)
+            if p not in self.scheduled:
+                state.wanted.add(p)
+
+
+    def assign(self, piece: int, address: Address):
+        """
+        Schedules `piece` for the peer `address`: it is no longer a
+        candidate for anyone.
+        """
+        self.scheduled.setdefault(piece, set()).add(address)
+        self.connections[address].already_scheduled.add(piece)
+        self.connections[address].scheduled_at[piece] = self.clock()
+        for owner in self.owners.get(piece, ()):
+            self.connections[owner].wanted.discard(piece)
+
+
+    def unassign(self, piece: int):
+        """
+        The piece was downloaded: forget who was scheduled for it, and who has it.
+        """
+        for address in self.scheduled.pop(piece, ()):
+            if address in self.connections:
+                self.connections[address].completed_piece(piece)
+        for owner in self.owners.pop(piece, ()):
+            self.connections[owner].wanted.discard(piece)
+
+    
+    def schedule_size(self, address: Address, requested: int) -> int:
+        """
+        How many pieces to schedule for a peer, whose peer manager asked
+        for `requested`: enough to keep it busy for schedule_horizon
+        seconds, minus those it has already. Until its rate is known,
+        just what was asked; if it is snubbing us, one piece at most.
+        """
+        state = self.connections[address]
+        if state.snubbed:
+            return max(0, min(requested, 1) - len(state.already_scheduled))
+        if requested <= 0 or state.rate == 0:
+            return requested
+
+        target = math.ceil(state.rate * self.schedule_horizon / self.metainfo.piece_size)
+        target = max(1, min(MAX_SCHEDULE, target))
+        return max(0, target - len(state.already_scheduled))
 
     
     def schedule_for(self, address: Address, n=10) -> List[int]:
@@ -136,66 +335,252 @@ class MasterControlUnit:
 
         # Candidates pieces for peer P are those that:
         # 1. P owns
-        # 2. Were not already assigned to PeerManager for P
-        # 3. Were not already assigned to /any/ peerManager
-        candidates_pieces = (
-            state.not_yet_scheduled() -
-            self.already_scheduled() -
-            self.bitmap_to_set()
-        )
-
-        if len(candidates_pieces) == 0:
-            # print("No candidates found...")
+        # 2. Were not already assigned to /any/ peerManager
+        # 3. We don't have already
+        # that is, state.wanted
+        if n <= 0:
             return []
-        
-        chosen = random.sample(
-            list(candidates_pieces),
-            k = min(n, len(candidates_pieces))
-        )
 
-        state.set_suggested(chosen)
+        if self.endgame:
+            # What P can give us: the candidates first, then the pieces
+            # that the other peer managers are already downloading
+            chosen = (list(state.wanted) + list(self.in_flight_for(address)))[:n]
+        elif len(state.wanted) == 0:
+            # Nothing new to start: P helps filling the pieces in flight
+            # that still have blocks nobody requested
+            chosen = [p for p in self.in_flight_for(address)
+                      if self.piece_table.has_unclaimed(p)][:n]
+        else:
+            chosen = self.picker.pick(state.wanted, n)
+
+        if state.hash_failed:
+            chosen = [p for p in chosen
+                      if p not in state.hash_failed or self.owners.get(p) == {address}]
+            
+        for p in chosen:
+            self.assign(p, address)
         
         return chosen
 
 
-    def redistribute_pieces(self, redistrib_pieces: List[int]) -> Dict[Address, List[int]]:
+    def in_flight_for(self, address: Address) -> Iterator[int]:
+        """
+        The pieces scheduled for other peer managers, that `address` has too.
+        """
+        for p, addresses in self.scheduled.items():
+            if address not in addresses and address in self.owners.get(p, ()):
+                yield p
+
+
+    def remove_connection(self, address: Address) -> Set[int]:
+        """
+        Forgets a peer, and the pieces it had. Returns the pieces that
+        were scheduled for it (now unscheduled).
+        """
+        state = self.connections.pop(address)
+        self.picker.peer_gone(state.peer_has)
+
+        for p in state.peer_has:
+            owners = self.owners.get(p)
+            if owners is not None:
+                owners.discard(address)
+                if len(owners) == 0:
+                    del self.owners[p]
+
+        return self.unschedule(state, address, list(state.already_scheduled))
+
+
+    def unschedule(self, state: ConnectionStatus, address: Address, pieces: Iterable[int]) -> Set[int]:
+        """
+        The peer manager at `address` stopped downloading `pieces`.
+        Returns those that nobody else is downloading.
+        """
+        # In endgame other peer managers may still be downloading the
+        # same pieces: only the others are unscheduled
+        unscheduled = set()
+        for p in pieces:
+            addresses = self.scheduled.get(p)
+            if addresses is None or address not in addresses:
+                continue
+
+            state.already_scheduled.discard(p)
+            state.scheduled_at.pop(p, None)
+            addresses.discard(address)
+            if len(addresses) == 0:
+                del self.scheduled[p]
+                unscheduled.add(p)
+        return unscheduled
+
+    
+    def missing_blocks(self) -> int:
+        """ How many blocks we still have to download (roughly). """
+        return (len(self.bitmap) - self.bitmap.count()) * self.blocks_per_piece
+
+    
+    def start_endgame(self, exclude: Address=None):
+        """
+        Enters endgame mode, and gives to every peer manager the pieces
+        in flight that its peer has too.
+        """
+        self.endgame = True
+        self.piece_table.endgame = True
+        self.logger.info("Entering endgame: %d blocks missing", self.missing_blocks())
+
+        for address, state in self.connections.items():
+            if address == exclude or state.snubbed:
+                continue
+            # All of them, this time
+            duplicates = self.schedule_for(address, n=len(state.wanted) + len(self.scheduled))
+            if duplicates:
+                self.send_to(address, M_SCHEDULE(duplicates))
+
+
+    def redistribute_pieces(self, redistrib_pieces: Iterable[int],
+                            exclude: Address = None) -> Dict[Address, List[int]]:
         """
         The goal is to redistribute the already scheduled pieces of
-        peer P to all the other peers.
+        peer P (who must be already removed, or is `exclude`) to all 
+        the other peers.
         
-        We build a table of possible peers to which redistribute 
-        the pieces; if more than one choice is possible, simply choose
-        randomly.
+        Every piece is assigned to one of the peers that have it,
+        preferring those not snubbing us; if more than one choice is
+        possible, simply choose randomly. Pieces that nobody else has
+        become candidates again (for P too, if still connected) as soon
+        as a peer announces them.
         """
+        new_assignments: Dict[Address, List[int]] = dict()
         
-        # (piece_index da redistribuire) : (possibili peers che ce l'hanno) 
-        table: Dict[int, List[Address]] = {
-            p : [] for p in redistrib_pieces
-        }
-        
-        for peer, p_state in self.connections.items():
-            for common_piece in (p_state.peer_has & redistrib_pieces):
-                table[common_piece].append(peer)
+        for piece in redistrib_pieces:
+            candidate_peers = [a for a in self.owners.get(piece, ()) if a != exclude]
+            if not candidate_peers:
+                for owner in self.owners.get(piece, ()):
+                    self.connections[owner].wanted.add(piece)
+                continue
 
-                
-        new_assignments: Dict[Address, List[int]] = dict()
+            active = [a for a in candidate_peers if not self.connections[a].snubbed]
+            candidate = random.choice(active or candidate_peers)
+            self.assign(piece, candidate)
+            new_assignments.setdefault(candidate, []).append(piece)
+
+        return new_assignments
+
+    
+    def reschedule_elsewhere(self, address: Address, pieces: List[int]):
+        """
+        The peer manager at `address` gave up `pieces`: they are scheduled
+        to other peers (if any has them), and the peer manager gets
+        something else to do.
+        """
+        given_up = self.unschedule(self.connections[address], address, pieces)
+        mapping = self.redistribute_pieces(given_up, exclude=address)
+
+        # Who is still filling the others can now request their
+        # blocks: reminded with the piece, that it has already
+        for p in set(pieces) - given_up:
+            for peer_addr in self.scheduled.get(p, ()):
+                mapping.setdefault(peer_addr, []).append(p)
+
+        for peer_addr, new_scheduled in mapping.items():
+            self.send_to(peer_addr, M_SCHEDULE(new_scheduled))
+
+        self.send_to(address, M_SCHEDULE(self.schedule_for(
+            address, n=self.schedule_size(address, 1)
+        )))
+
+    
+    def start_streaming(self):
+        """
+        Streaming mode: the pieces right after the read cursor come
+        first (the policy chosen with --piece-picker applies to the others).
+        """
+        if isinstance(self.picker, picker_mod.StreamingPicker):
+            return
+
+        self.logger.info("Streaming mode")
+        self.picker = picker_mod.StreamingPicker(
+            self.picker, self.bitmap, self.metainfo.piece_size,
+            window=self.options.get("stream_window", 8)
+        )
+
+
+    def hurry_stream(self):
+        """
+        Makes sure that the pieces in the streaming window are being
+        downloaded: those that nobody is downloading are scheduled to the
+        fastest peer that has them; the overdue ones, to one more peer.
+        """
+        overdue = set(self.picker.overdue(self.clock()))
         
-        for piece, candidate_peers in table.items():
-            if candidate_peers == []:
+        for p in self.picker.window():
+            assigned = self.scheduled.get(p, set())
+            if assigned and p not in overdue:
                 continue
+
+            candidates = self.owners.get(p, set()) - assigned
+            if not candidates:
+                continue
+
+            if assigned:
+                self.logger.debug("Piece %d is overdue", p)
+                self.piece_table.hurry(p)
+                
+            fastest = max(candidates, key=lambda a: (not self.connections[a].snubbed,
+                                                     self.connections[a].rate))
+            self.assign(p, fastest)
+            self.send_to(fastest, M_SCHEDULE([p], urgent=True))
             
-            if len(candidate_peers) == 1:
-                candidate = candidate_peers[0]
-            else:
-                candidate = random.choice(candidate_peers)
+            
+    def set_choking(self, address: Address, choke: bool):
+        """ Tells the peer manager to choke (or unchoke) its peer, if it does not already. """
+        state = self.connections[address]
+        if state.am_choking == choke:
+            return
 
-            new_assignments[candidate] = (
-                new_assignments.get(candidate, []) + [piece]
-            )
+        state.am_choking = choke
+        state.unchoked_at = None if choke else self.clock()
+        self.send_to(address, M_CHOKE() if choke else M_UNCHOKE())
 
-        return new_assignments
+
+    def choke_round(self):
+        """
+        Updates the upload rates (and the download ones of the peers
+        that stopped sending), and lets the choker decide which peers to
+        upload to until the next round.
+        """
+        now = self.clock()
+        for state in self.connections.values():
+            state.update_upload_rate(state.peer.uploaded, now)
+            state.decay_rate(now)
+
+        unchoked = self.choker.round(self.connections, self.bitmap.complete, now)
+        self.logger.debug("Choke round: uploading to %s", unchoked)
+        
+        for address in self.connections:
+            self.set_choking(address, address not in unchoked)
+        self.next_choke_round = now + self.choker.round_interval
 
     
+    def check_endgame(self, exclude: Address=None):
+        """ Starts the endgame, if few blocks are missing now. """
+        if (not self.endgame and not self.bitmap.complete and
+            self.missing_blocks() <= self.endgame_blocks):
+            self.start_endgame(exclude=exclude)
+
+
+    def download_completed(self):
+        """
+        When completed (= we have all the pieces), inform all peers that we
+        have completed the download. The peers will decide if mantaining the
+        connection and seed, or to disconnect
+        """
+        self.resume.flush()
+        self.send_all(M_COMPLETED())
+        self.queue_connection_manager.put(M_COMPLETED())
+        self.tracker_manager.notify_completion()
+
+        print("Completed download!")
+
+
     def write_piece_to_file(self, piece_index: int, data: bytes):
         """
         Writes an entire piece, received from a peer, to the downloaded
@@ -204,77 +589,143 @@ class MasterControlUnit:
         It assumes that the data received where already hash-verified by
         the peer manager! 
         """
-        with self.lock_download_file:
-
-            if not self.metainfo.download_fpath.exists():
-                self.metainfo.download_fpath.touch()
-
-            with open(self.metainfo.download_fpath, "r+b") as f:
-                # TODO: assert su lungehzza data
-                f.seek(piece_index * self.metainfo.piece_size)
-                f.write(data)
-                f.flush()
+        # TODO: assert su lungehzza data
+        self.storage.write(piece_index * self.metainfo.piece_size, data)
 
                     
     def read_piece_from_file(self, piece_index) -> bytes:
         """
         Reads an entire piece from the downloaded file.
         """
-        with self.lock_download_file:
-
-            with open(self.metainfo.download_fpath, "r+b") as f:
-                f.seek(piece_index * self.metainfo.piece_size)
-                return f.read(self.metainfo.piece_size)
+        return self.storage.read(
+            piece_index * self.metainfo.piece_size,
+            self.metainfo.piece_size
+        )
 
 
     def receiver_loop(self):
         while True:
-            mex = self.queue_in.get()
+            if self.clock() >= self.next_choke_round:
+                self.choke_round()
+            
+            try:
+                mex = self.queue_in.get(timeout=max(0, self.next_choke_round - self.clock()))
+            except Empty:
+                continue
 
             assert isinstance(mex, MasterMex), mex
 
+            # A peer manager may still have messages in flight after its
+            # M_DISCONNECTED: the connection is gone, drop them
+            sender = getattr(mex, "sender", None)
+            if sender is not None and sender not in self.connections:
+                self.logger.debug("Dropping %s from disconnected peer %s",
+                                  type(mex).__name__, sender)
+                continue
+
             # When we are informed that a peer 
             if isinstance(mex, M_PEER_HAS):
-                status = self.connections[mex.sender]
-                status.update_peer_has(mex.pieces_index)
+                self.peer_has(mex.sender, mex.pieces_index)
+                self.connections[mex.sender].update_rate(mex.downloaded, self.clock())
 
-                answer = M_SCHEDULE(
-                    self.schedule_for(mex.sender, n=mex.schedule_new_pieces)
-                )
+                answer = M_SCHEDULE(self.schedule_for(
+                    mex.sender, n=self.schedule_size(mex.sender, mex.schedule_new_pieces)
+                ))
                 self.send_to(mex.sender, answer)
 
                 
             elif isinstance(mex, M_PIECE):
-                status = self.connections[mex.sender]
-                status.completed_piece(mex.piece_index)
+                state = self.connections[mex.sender]
+                state.update_rate(mex.downloaded, self.clock())
+                state.update_latency(mex.piece_index, self.clock())
+                
+                if self.bitmap[mex.piece_index]:
+                    # Endgame: another peer manager completed it first
+                    state.completed_piece(mex.piece_index)
+                    self.send_to(mex.sender, M_SCHEDULE(self.schedule_for(
+                        mex.sender, n=self.schedule_size(mex.sender, mex.schedule_new_pieces)
+                    )))
+                    continue
+                
+                self.unassign(mex.piece_index)
 
                 self.write_piece_to_file(mex.piece_index, mex.data)
                 self.update_global_bitmap(mex.piece_index, mex.sender)                
-                self.send_to(mex.sender,
-                             M_SCHEDULE(self.schedule_for(mex.sender, n=mex.schedule_new_pieces)))
-
-                # When completed (= we have all the pieces), inform all peers that we
-                # have completed the download. The peers will decide if mantaining the
-                # connection and seed, or to disconnect
-                if all(self.bitmap):
-                    self.send_all(M_COMPLETED())
-                    self.queue_connection_manager.put(M_COMPLETED())
+
+                self.check_endgame(exclude=mex.sender)
+                    
+                self.send_to(mex.sender, M_SCHEDULE(self.schedule_for(
+                    mex.sender, n=self.schedule_size(mex.sender, mex.schedule_new_pieces)
+                )))
+                self.logger.debug(
+                    "Peer %s: %.1f KiB/s, %s s per piece, %d pieces scheduled",
+                    mex.sender, state.rate / 1024,
+                    "?" if state.piece_latency is None else "{:.2f}".format(state.piece_latency),
+                    len(state.already_scheduled)
+                )
+
+                if self.bitmap.complete:
+                    self.download_completed()
+                    
                     
-                    print("Completed download!")
+            elif isinstance(mex, M_RECHECKED):
+                new_pieces = [p for p in mex.pieces_index if not self.bitmap[p]]
+                for p in new_pieces:
+                    # Peer managers still downloading it will find it
+                    # done, as in endgame
+                    self.unassign(p)
+                    self.update_global_bitmap(p, None)
+
+                if mex.done:
+                    self.resume.save() # next time, quick
+                if new_pieces and self.bitmap.complete:
+                    self.download_completed()
+                elif new_pieces:
+                    self.check_endgame()
                     
                     
+            elif isinstance(mex, M_TIMED_OUT):
+                state = self.connections[mex.sender]
+                state.snubbed = state.snubbed or mex.snubbed
+                self.logger.debug("Peer %s timed out on %s (snubbed: %s)",
+                                  mex.sender, mex.pieces_index, state.snubbed)
+
+                self.reschedule_elsewhere(mex.sender, mex.pieces_index)
+
+                
+            elif isinstance(mex, M_HASH_FAILED):
+                self.logger.warning("Piece %d from %s failed the hash check, rescheduling it",
+                                    mex.piece_index, mex.sender)
+                self.connections[mex.sender].hash_failed.add(mex.piece_index)
+                self.reschedule_elsewhere(mex.sender, [mex.piece_index])
+
+                
+            elif isinstance(mex, M_STREAM_SEEK):
+                self.start_streaming()
+                self.picker.seek(mex.piece_index, self.clock(), mex.rate)
+                self.hurry_stream()
+
+                
+            elif isinstance(mex, M_PEER_INTERESTED):
+                state = self.connections[mex.sender]
+                state.interested = mex.interested
+
+                # Free upload slots are not kept until the next round
+                if not mex.interested:
+                    self.set_choking(mex.sender, True)
+                elif self.choker.has_free_slot(self.connections):
+                    self.set_choking(mex.sender, False)
+
+                
             elif isinstance(mex, M_DISCONNECTED):
                 self.logger.debug("Received disconnect from %s", mex.sender)
                 
-                redistrib_pieces = self.connections[mex.sender].already_scheduled
-                
                 self.send_to(mex.sender, M_KILL())
-                del self.connections[mex.sender]
+                redistrib_pieces = self.remove_connection(mex.sender)
 
                 mapping = self.redistribute_pieces(redistrib_pieces)
 
                 for peer_addr, new_scheduled in mapping.items():
-                    self.connections[peer_addr].set_suggested(new_scheduled)                    
                     self.send_to(peer_addr, M_SCHEDULE(new_scheduled))
 
                 self.queue_connection_manager.put(mex)
@@ -283,8 +734,7 @@ class MasterControlUnit:
             elif isinstance(mex, M_PEER_REQUEST):
                 # TODO: un'idea. Al posto che inviare il pezzo intero sulla queue
                 # (che è pesante, visto che un pezzo può essere anche 1Mb)
-                # invia al peer il Lock usato per scrivere/leggere il file,
-                # self.lock_download_file! 
+                # invia al peer lo storage, da cui leggere direttamente
                 if not self.bitmap[mex.piece_index]:
                     self.send_to(mex.sender, M_ERROR(mex, "We don't have requested piece"))
                     continue
@@ -298,6 +748,8 @@ class MasterControlUnit:
                 # Only debug, or user input
                 self.send_all(M_KILL())
                 self.queue_connection_manager.put(M_KILL())
+                self.resume.close() # flushes the storage: close it after
+                self.storage.close()
                 break
 
 
@@ -1,10 +1,13 @@
+import os
 import bencodepy
 import hashlib
 import ipaddress
 import random
-import requests
-import pathos.multiprocessing as mp
+import threading
+import time
 
+from concurrent.futures import Future, wait
+from dataclasses import dataclass
 from requests.exceptions import Timeout
 from math import log2
 from queue import Queue
@@ -12,9 +15,10 @@ from typing import *
     
 import Fiume.config as config
 import Fiume.utils as utils
+import Fiume.resume as resume_mod
+import Fiume.tracker_client as tracker_client_mod
 
 import logging
-logging.getLogger("urllib3").setLevel(logging.WARNING)
 
 Url = str
 Address = Tuple[str, int] # (ip, port)
@@ -36,7 +40,9 @@ class MetaInfo(dict):
         sha.update(bencodepy.encode(self[b"info"]))
         self.info_hash = sha.digest()
 
-        self.trackers: List[Url]  = self.__gather_trackers()
+        # Tiers of trackers (BEP 12), each one shuffled
+        self.tiers: List[List[Url]] = self.__gather_tiers()
+        self.trackers: List[Url] = [url for tier in self.tiers for url in tier]
 
         self.piece_size: int = self[b"info"][b"piece length"]
         self.block_size: int = 16384 #16kb, standard
@@ -46,27 +52,78 @@ class MetaInfo(dict):
         self.download_fpath: Path = self["output_file"]
         self.human_name: str = self.download_fpath.name[:4] + ".torr"
 
-    def __gather_trackers(self) -> List[Url]:
-        """ Unites all possible trackers in a single list, useless """
-        trackers = [self[b"announce"]]
-        
+    def __gather_tiers(self) -> List[List[Url]]:
+        """
+        The tiers of announce-list, in order, their trackers shuffled;
+        without it, `announce` alone.
+        """
         if b"announce-list" in self:
-            trackers += [l[0] for l in self[b"announce-list"]]
+            tiers = [list(tier) for tier in self[b"announce-list"] if tier]
+            for tier in tiers:
+                random.shuffle(tier)
+            return tiers
 
-        return trackers
+        return [[self[b"announce"]]] if b"announce" in self else []
 
     
     
 ###################
 
 
+# Backoff of a tracker that failed: doubles at every failure in a row
+TRACKER_BACKOFF = 60.0
+MAX_TRACKER_BACKOFF = 3600.0
+# Seconds a tier has to answer, before the next one is tried as well
+# (a dead UDP tracker takes more than a minute to give up)
+TIER_PATIENCE = 10.0
+# Announce interval, when the tracker does not say
+DEFAULT_INTERVAL = 1800
+# A swarm with this many seeders is healthy: regular announces are sent
+# every `interval`. Otherwise, every `min interval` (half the interval,
+# if the tracker does not say), unless a scrape finds it healthy
+HEALTHY_SEEDERS = 5
+# Peers remembered for the next session
+MAX_CACHED_PEERS = 200
+
+
+@dataclass
+class TrackerStatus:
+    url: Url
+    # Failed announces in a row
+    failures: int = 0
+    # Not contacted until then (time.monotonic)
+    retry_at: float = 0.0
+    # False if its scrape URL is unknown, or it failed
+    scrape: bool = True
+
+    def backing_off(self, now: float) -> bool:
+        return now < self.retry_at
+
+
 class TrackerManager:
-    def __init__(self, metainfo: MetaInfo, options: Dict[str, Any]):
+    """
+    Announces a torrent to its trackers, tier by tier (BEP 12): all
+    the trackers of a tier at once, and the first one that answers is
+    moved to the front of its tier. The next tier is tried when all of
+    them failed, or did not answer in TIER_PATIENCE seconds. A tracker
+    that fails is not tried again for a while (doubling at every
+    failure).
+
+    Regular announces follow the `interval` of the tracker, or its `min
+    interval` when the swarm looks unhealthy (few seeders), to find more
+    peers sooner. Before such an early announce, the tracker is scraped:
+    if the swarm became healthy, the announce is postponed.
+    """
+
+    def __init__(self, metainfo: MetaInfo, options: Dict[str, Any],
+                 client: "tracker_client_mod.TrackerClient" = None):
         self.options = options
-        self.bitmap_file = utils.get_bitmap_file(self.options["output_file"])
+        # Set by the ThreadedServer: the pieces we have, kept by the master
+        self.resume: Optional[resume_mod.ResumeFile] = None
         self.metainfo: MetaInfo = metainfo
         
-        self.my_ip = utils.get_external_ip()
+        # The external IP is looked up in background: announces are sent
+        # without it, until it is known
         self.my_port = self.options["port"]
         
         self.logger = logging.getLogger(
@@ -75,7 +132,30 @@ class TrackerManager:
         self.logger.setLevel(options.get("debug_level", logging.DEBUG))
         self.logger.debug("__init__")
 
-        self.working_trackers: List[Tuple[str, utils.RepeatedTimer]] = list()
+        # Sends the announces (of the whole session, if given)
+        self.own_client = client is None
+        self.client = client if client is not None else (
+            tracker_client_mod.TrackerClient(options)
+        )
+
+        self.tiers: List[List[TrackerStatus]] = [
+            [TrackerStatus(url, scrape=tracker_client_mod.can_scrape(url)) for url in tier]
+            for tier in self.metainfo.tiers
+        ]
+        # The last tracker that answered, and what it said
+        self.working: Optional[TrackerStatus] = None
+        self.interval: int = DEFAULT_INTERVAL
+        self.min_interval: Optional[int] = None
+        self.last_announce: Optional[float] = None
+        self.seeders: Optional[int] = None
+        self.leechers: Optional[int] = None
+
+        # Next regular announce
+        self.timer: Optional[threading.Timer] = None
+        self.lock = threading.RLock()
+        self.closed = False
+        # Only one thread at a time writes the peers file
+        self.save_lock = threading.Lock()
 
         self.peer_id = config.CLIENT_INFO + random.randbytes(12)
         self.tracker_ids: Dict[Url, bytes] = dict()
@@ -87,165 +167,387 @@ class TrackerManager:
 
         
         
-    def tell_all_trackers(self, params) -> List[Tuple[Url, requests.Response]]:
+    def announce(self, params: Dict[str, Any],
+                 done: Callable[[Optional[bencodepy.Bencode]], None]):
         """ 
-        Tells something to all trackers in the .torrent file.
-        """        
-        pool    = mp.Pool(16 * mp.cpu_count())
-        results = pool.map(
-            lambda url: self.__tell_tracker(url, params),
-            self.metainfo.trackers
-        )
-        pool.close()
-        return [r for r in results if r is not None]
+        Tells something to the trackers, in background, tier by tier.
+        `done` is called with the first answer (None if none came),
+        after the state of the trackers is updated. The peers of the
+        answers coming later are put in the queue.
+        """
+        now = time.monotonic()
+        with self.lock:
+            tiers = [
+                (tier, [status for status in tier if not status.backing_off(now)])
+                for tier in self.tiers
+            ]
+        tiers = [(tier, candidates) for tier, candidates in tiers if candidates]
+
+        if not tiers:
+            done(None)
+            return
+
+        lock = threading.Lock()
+        # Answers still to come from each tier, and the next tier to try
+        pending = [len(candidates) for _, candidates in tiers]
+        next_tier = 0
+        answered = False
+        timers: List[threading.Timer] = list()
+
+        def try_tier(i: int):
+            nonlocal next_tier, answered
+            with lock:
+                # Past the last tier, the last answer calls done (see on_answer)
+                if answered or next_tier != i or i >= len(tiers):
+                    return
+                closed = answered = self.closed
+                next_tier += 1
+
+                if not closed and i + 1 < len(tiers):
+                    timer = threading.Timer(TIER_PATIENCE, try_tier, (i + 1,))
+                    timer.daemon = True
+                    timers.append(timer)
+                    timer.start()
+
+            if closed:
+                done(None)
+                return
+
+            for status in tiers[i][1]:
+                future = self.client.announce(status.url, self.base_params() | params)
+                future.add_done_callback(lambda f, status=status: on_answer(i, status, f))
+
+        def on_answer(i: int, status: TrackerStatus, future: Future):
+            nonlocal answered
+            tier = tiers[i][0]
+            response_bencode = self.__answer(status.url, future)
+
+            with self.lock:
+                if response_bencode is None:
+                    status.failures += 1
+                    status.retry_at = time.monotonic() + min(
+                        MAX_TRACKER_BACKOFF, TRACKER_BACKOFF * 2**(status.failures - 1)
+                    )
+                    self.logger.debug("%s: %d failures, retrying in %.0fs", status.url,
+                                      status.failures, status.retry_at - time.monotonic())
+                else:
+                    status.failures, status.retry_at = 0, 0.0
+
+            with lock:
+                pending[i] -= 1
+                first = response_bencode is not None and not answered
+                answered = answered or first
+                tier_failed = not answered and pending[i] == 0
+                exhausted = not answered and next_tier == len(tiers) and sum(pending) == 0
+                if first:
+                    for timer in timers:
+                        timer.cancel()
+
+            if first:
+                with self.lock:
+                    # Promoted to the front of its tier
+                    tier.remove(status)
+                    tier.insert(0, status)
+                    self.__update(status, response_bencode)
+                done(response_bencode)
+            elif response_bencode is not None:
+                for addr in self.__new_peers(response_bencode):
+                    self.queue_for_new_peers.put(addr)
+            elif exhausted:
+                done(None)
+            elif tier_failed:
+                try_tier(i + 1)
+
+        try_tier(0)
 
     
-    def __tell_tracker(self, url, params) -> Optional[Tuple[Url, requests.Response]]:
+    def __answer(self, url: Url, future: Future) -> Optional[bencodepy.Bencode]:
         """ 
-        Single iterator for tell_all_trackers.
+        The decoded answer of a tracker, or None if it failed.
         """
         try:
-            response = requests.get(url, params=self.base_params() | params, timeout=2.0)
-            self.logger.debug("%s works!!!", url)
-            return (url, response)
-        except Timeout:
+            response_bencode = future.result()
+        except (Timeout, TimeoutError):
             self.logger.debug("%s has time-outed", url)
             return None
+        except bencodepy.BencodeDecodeError as e:
+            self.logger.debug("%s has returned a non bencode object %s", url, e)
+            return None
         except Exception as e:
             self.logger.debug("%s has failed for some generic reason: %s", url, e) 
             return None
 
+        if b"failure reason" in response_bencode:
+            self.logger.debug("%s has refused: %s", url, response_bencode[b"failure reason"])
+            return None
+
+        self.logger.debug("%s works!!!", url)
+        return response_bencode
+
+
+    def __update(self, status: TrackerStatus, response_bencode: bencodepy.Bencode):
+        """ What a tracker said, for the next announces. """
+        self.working = status
+        self.last_announce = time.monotonic()
+        self.interval = response_bencode.get(b"interval", DEFAULT_INTERVAL)
+        self.min_interval = response_bencode.get(b"min interval")
+
+        if b"complete" in response_bencode:
+            self.seeders = response_bencode[b"complete"]
+        if b"incomplete" in response_bencode:
+            self.leechers = response_bencode[b"incomplete"]
+
+        if b"tracker id" in response_bencode:
+            self.tracker_ids[status.url] = response_bencode[b"tracker id"]
+
+
+    def healthy(self) -> bool:
+        return self.seeders is not None and self.seeders >= HEALTHY_SEEDERS
+
+
+    def next_announce_delay(self) -> float:
+        """ Seconds to the next regular announce. """
+        now = time.monotonic()
+
+        if self.last_announce is None: # no tracker answered, yet
+            retry_at = [
+                status.retry_at for tier in self.tiers for status in tier
+            ]
+            return max(0.0, min(retry_at, default=now) - now)
+
+        if self.healthy():
+            interval = self.interval
+        elif self.min_interval is not None:
+            interval = self.min_interval
+        else:
+            interval = self.interval / 2
+
+        return max(0.0, self.last_announce + interval - now)
+
+
+    def __schedule_next(self):
+        with self.lock:
+            if self.closed:
+                return
+            if self.timer is not None:
+                self.timer.cancel()
+
+            delay = self.next_announce_delay()
+            self.logger.debug("Next announce in %.0fs", delay)
+            self.timer = threading.Timer(delay, self.notify_nothing_important)
+            self.timer.daemon = True
+            self.timer.start()
+
         
     def base_params(self) -> Dict:
         """ 
         Tracker GET request parameters that are always the same. Calculates `downloaded`,
-        `uploaded` and `left` by reading the BITMAP file.
+        `uploaded` and `left` from the bitmap in memory.
         """
 
-        if self.bitmap_file.exists():
-            with open(self.bitmap_file, "r") as f:
-                bitmap = [int(c) for c in f.read().strip()]
-                
-                if bitmap == []:
-                    self.logger.error("Bitmap file is empty and corrupted.")
-                    raise Exception("Bitmap file is empty and corrupted")
+        if self.resume is not None and len(self.resume.bitmap) > 0:
+            bitmap = self.resume.bitmap
 
-                downloaded = sum(bitmap[:-1]) * self.metainfo.piece_size
-                if bitmap[-1]:
-                    downloaded += self.metainfo.total_size % self.metainfo.piece_size
+            downloaded = (bitmap.count() - bitmap[-1]) * self.metainfo.piece_size
+            if bitmap[-1]:
+                downloaded += self.metainfo.total_size - (len(bitmap) - 1) * self.metainfo.piece_size
 
-                uploaded   = 0 # TODO
-                left       = self.metainfo.total_size - downloaded
+            uploaded   = 0 # TODO
+            left       = self.metainfo.total_size - downloaded
         else: # First connection 
             downloaded = 0
             uploaded = 0
             left = self.metainfo.total_size
 
             
-        return {
+        params = {
             "info_hash": self.metainfo.info_hash,
             "peer_id": self.peer_id,
             "port": self.my_port, #50146,
             "compact": "1",
-            "ip": self.my_ip,
             "downloaded": str(downloaded),
             "uploaded": str(uploaded),
             "left": str(left),
         }
+        my_ip = utils.get_external_ip()
+        if my_ip is not None:
+            params["ip"] = my_ip
+        return params
 
     
-    def notify_start(self) -> Tuple[List[Address], Queue]:
-        """ 
-        Inform all the trackers that you are about to start downloading, and
-        hence ask for peers.
+    def start(self):
         """
-        self.logger.debug("Informing trackers I'm starting to download, asking for peers")
-        self.logger.debug("%s", self.base_params())
-        
-        results = self.tell_all_trackers(
-            {"event": "started"}
-        )
-        
-        peers: Set[Address] = set()
-        
-        for tracker_url, __response in results:
-            response = __response.content
+        Inform the trackers that you are about to start downloading, and
+        hence ask for peers. Does not wait for them: all the peers they
+        send are put in the queue.
+        """
+        self.logger.debug("Informing trackers I'm starting to download, in background")
 
+        def done(response_bencode: Optional[bencodepy.Bencode]):
+            if response_bencode is not None:
+                for addr in self.__new_peers(response_bencode):
+                    self.queue_for_new_peers.put(addr)
+            self.__schedule_next()
+
+        self.announce({"event": "started"}, done)
+
+
+    def cached_peers(self) -> List[Address]:
+        """
+        The peers known at the end of the previous session, to connect
+        to before any tracker answers (if trackers send them again, they
+        are not put in the queue).
+        """
+        path = utils.get_peers_file(self.metainfo.download_fpath)
+        try:
+            lines = path.read_text().split()
+        except FileNotFoundError:
+            return list()
+
+        peers = list()
+        for line in lines[:MAX_CACHED_PEERS]:
+            ip, _, port = line.rpartition(":")
             try:
-                response_bencode = bencodepy.decode(response)                
-            except bencodepy.BencodeDecodeError as e:
-                self.logger.debug("%s has returned a non bencode object %s", tracker_url, e)            
+                peers.append((ipaddress.IPv4Address(ip).exploded, int(port)))
+            except ValueError:
                 continue
 
-            # Start regular requests to tracker
-            repeat_notify = utils.RepeatedTimer(
-                self.notify_nothing_important,
-                response_bencode[b"interval"],
-                tracker_url
-            )
-            self.working_trackers.append((tracker_url, repeat_notify))
-            
-            
-            self.tracker_ids[tracker_url] = (
-                response_bencode[b"tracker id"] if b"tracker id" in response_bencode else b""
-            )
+        with self.lock:
+            self.peers |= set(peers)
+        return peers
+
 
-            peers = peers | self.__decode_peer(response_bencode)
+    def __save_peers(self):
+        """
+        Remembers the known peers for the next session (see cached_peers).
+        Not under self.lock: the file is written while the trackers'
+        answers keep being handled.
+        """
+        path = utils.get_peers_file(self.metainfo.download_fpath)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with self.save_lock:
+            with self.lock:
+                peers = list(self.peers)[:MAX_CACHED_PEERS]
+            try:
+                tmp_path.write_text("".join("{}:{}\n".format(ip, port) for ip, port in peers))
+                os.replace(tmp_path, path)
+            except OSError as e:
+                self.logger.warning("Could not save peers in %s: %s", path, e)
 
-        self.peers = peers
-        return list(self.peers), self.queue_for_new_peers
 
-    
     def notify_completion(self):
         """ 
-        Inform all the trackers that you have finished downloading.
+        Inform the trackers that you have finished downloading
+        (in background: does not wait for their answers).
         In theory, you should call this /only/ when reaching 100%.
         """
         self.logger.debug("Notifying trackers of completion...")
-        self.tell_all_trackers(
-            {"event": "completed"}
-        )
+        self.announce({"event": "completed"}, lambda _: None)
 
                 
     def notify_stop(self):
         """
-        Inform all the trackers that you are shutting down gracefully.
+        Inform the tracker that you are shutting down gracefully, waiting
+        for its answer (at most the tracker timeout).
         """
         self.logger.debug("Notifying trackers of graceful shutdown...")
-        self.tell_all_trackers(
-            {"event": "stopped"}
-        )
+        if self.working is not None:
+            wait([self.client.announce(
+                self.working.url, self.base_params() | {"event": "stopped"}
+            )])
+
+
+    def close(self):
+        """ Stops the routine contacts with the trackers. """
+        with self.lock:
+            self.closed = True
+            if self.timer is not None:
+                self.timer.cancel()
+
+        if self.own_client:
+            self.client.close()
 
                 
-    def notify_nothing_important(self, url):
+    def notify_nothing_important(self, scrape_first: bool = True):
         """
-        Inform a tracker, after time=interval (`interval` field found in
+        Inform the trackers, after time=interval (`interval` field found in
         tracker response after a event=started), about my current download
-        status.
+        status. Sooner, if the swarm looks unhealthy: but first the
+        tracker is scraped, to see if it still is.
 
         IRC says: if you haven't completed the download yet, you simply
         send a request with no `event` field and with left=metainfo.total_size.
         """
+        with self.lock:
+            status = self.working
+            early = (
+                self.last_announce is not None and
+                time.monotonic() - self.last_announce < self.interval
+            )
+
+        if scrape_first and early and status is not None and status.scrape:
+            self.__scrape(status)
+            return
+
         params = self.base_params()
         if params["left"] != 0:
             params["left"] = self.metainfo.total_size
-        self.logger.info("Routine contact with tracker %s for new_peers", url)
+        self.logger.info("Routine contact with trackers for new_peers")
+
+        def done(response_bencode: Optional[bencodepy.Bencode]):
+            if response_bencode is not None:
+                for addr in self.__new_peers(response_bencode):
+                    self.queue_for_new_peers.put(addr)
+            self.__schedule_next()
+
+        self.announce(params, done)
 
-        maybe_response = self.__tell_tracker(url, params)
-        if maybe_response is None:
-            return
-        
-        _, response = maybe_response
 
+    def __scrape(self, status: TrackerStatus):
+        """
+        Updates the number of seeders with a scrape: then, announces if
+        the swarm is still unhealthy, or waits for the next announce.
+        """
         try:
-            response_bencode = bencodepy.decode(response.content)
-            
-            peers = self.__decode_peer(response_bencode) - self.peers #only new peers
-            for addr in peers:
-                self.queue_for_new_peers.put(addr)
-                
-        except bencodepy.BencodeDecodeError as e:
-            self.logger.debug("Couldnt' decode peers list because of %s", e)
+            future = self.client.scrape(status.url, [self.metainfo.info_hash])
+        except ValueError: # does not support scrape
+            status.scrape = False
+            self.notify_nothing_important(scrape_first=False)
+            return
+
+        def on_answer(future: Future):
+            try:
+                files = future.result()
+                stats = files[self.metainfo.info_hash]
+            except Exception as e:
+                self.logger.debug("Scrape of %s failed: %s", status.url, e)
+                status.scrape = False
+                self.notify_nothing_important(scrape_first=False)
+                return
+
+            with self.lock:
+                self.seeders = stats.get(b"complete", self.seeders)
+                self.leechers = stats.get(b"incomplete", self.leechers)
+                self.logger.debug("Scrape of %s: %s seeders, %s leechers",
+                                  status.url, self.seeders, self.leechers)
+
+            if self.healthy():
+                self.__schedule_next()
+            else:
+                self.notify_nothing_important(scrape_first=False)
+
+        future.add_done_callback(on_answer)
+
+
+    def __new_peers(self, response_bencode: bencodepy.Bencode) -> Set[Address]:
+        """ The peers in a tracker answer never seen before (saved, for the next session). """
+        decoded = self.__decode_peer(response_bencode)
+        with self.lock:
+            peers = decoded - self.peers
+            self.peers |= peers
+        if peers:
+            self.__save_peers()
+        return peers
 
                 
     def __decode_peer(self, response_bencode: bencodepy.Bencode) -> Set[Address]:
@@ -267,7 +569,7 @@ class TrackerManager:
 
             # BUG: ~secondo me~ SICURAMENTE questo causerà problemi quando l'utente inserirà 0 come
             # my_port
-            if utils.is_unwanted_addr((ip, port), (self.my_ip, self.my_port)):
+            if utils.is_unwanted_addr((ip, port), (utils.get_external_ip(), self.my_port)):
                 continue
             
             peers.add((ip, port))
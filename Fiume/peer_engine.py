@@ -0,0 +1,428 @@
+import asyncio
+import threading
+import logging
+import socket
+
+from typing import *
+
+import Fiume.utils as utils
+import Fiume.framing as framing
+import Fiume.state_machine as sm
+
+# Bytes waiting in the transport of a connection above which no other
+# block is sent: the REQUESTs wait until the peer reads what was sent
+WRITE_HIGH_WATER = 1 << 20
+
+
+class LoopQueue:
+    """
+    Queue-like object that the Master sees as the `queue_in` of an
+    AsyncPeerManager.
+
+    Master runs in its own thread, so every put() is handed over, in
+    a thread-safe way, to the event loop that owns the peer.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, callback: Callable):
+        self.loop = loop
+        self.callback = callback
+
+    def put(self, mex: utils.MasterMex):
+        self.loop.call_soon_threadsafe(self.callback, mex)
+
+
+class AsyncPeerManager(sm.PeerManager):
+    """
+    A PeerManager whose connection is driven by a PeerEngine event loop
+    (asyncio streams) instead of two dedicated threads.
+
+    The protocol logic (handshake, choke, interest, requests...) is the
+    very same of PeerManager; only the I/O changes.
+    """
+
+    def __init__(self, streams: Tuple[asyncio.StreamReader, asyncio.StreamWriter],
+                 address: utils.Address, torrent: "sm.ThreadedServer",
+                 initiator: sm.Initiator, engine: "PeerEngine"):
+
+        self.reader, self.writer = streams
+        self.engine = engine
+        self.sock = self.writer.get_extra_info("socket")
+        self.sock_fd = self.sock.fileno()
+        # asyncio does it only for sockets it creates itself
+        utils.set_nodelay(self.sock)
+        self.closed = False
+        self.timeout_timer: Optional[asyncio.TimerHandle] = None
+        # The transport pauses us at the same mark; uploads resume on drain
+        self.writer.transport.set_write_buffer_limits(high=WRITE_HIGH_WATER)
+        self.drain_task: Optional[asyncio.Task] = None
+        # Pieces are read from storage on the loop's executor, never on
+        # the loop itself, before their blocks are sent
+        self.load_task: Optional[asyncio.Task] = None
+        # The last piece read (index, data): its blocks are sent from it
+        # even if it did not fit in the piece cache
+        self.loaded: Optional[Tuple[int, memoryview]] = None
+
+        super().__init__(
+            (None, address),
+            torrent.metainfo, torrent.tracker_manager,
+            (LoopQueue(engine.loop, self.on_message), torrent.master_queue),
+            torrent.initial_bitmap, torrent.options,
+            initiator,
+            storage=torrent.storage,
+            piece_cache=torrent.piece_cache,
+            piece_table=torrent.piece_table,
+            hasher=torrent.hasher,
+            pex=torrent.pex
+        )
+
+
+    async def run(self, handshake: bytes = None):
+        """
+        Coroutine equivalent of PeerManager.main + message_socket_receiver.
+
+        `handshake` is the HANDSHAKE already read by the engine, when
+        the connection was initiated by the peer.
+        """
+        self.timeout_timer = self.engine.loop.call_later(
+            self.TIMEOUT_CHECK_INTERVAL, self.on_timeout_check
+        )
+
+        try:
+            if self.initiator == sm.Initiator.SELF:
+                self.send_handshake()
+                handshake = await asyncio.wait_for(
+                    self.reader.readexactly(68), self.engine.timeout
+                )
+
+            self.on_message(handshake)
+
+            frames = framing.FrameBuffer(handshake=False)
+
+            while not self.closed:
+                data = await asyncio.wait_for(
+                    self.reader.read(len(frames.writable())), self.engine.timeout
+                )
+                if data == b"":
+                    raise asyncio.IncompleteReadError(b"", None)
+
+                frames.feed(data)
+
+                # Messages are interpreted right away, before the buffer is
+                # reused: blocks of PIECE messages can therefore be copied 
+                # straight from the buffer to their PieceBuffer.
+                # The answers to a batch of messages (eg. many PIECEs, each 
+                # a header and a sendfile) are sent out together, after the
+                # whole batch (a CANCEL in it can still drop a REQUEST)
+                with utils.corked(self.sock):
+                    for mex in frames.messages():
+                        if mex[4] != sm.MexType.PIECE.value:
+                            mex = bytes(mex)
+                        self.on_message(mex)
+                        if self.closed:
+                            break
+
+                    if self.upload_queue and not self.closed:
+                        self.serve_uploads()
+
+        except asyncio.TimeoutError:
+            self.shutdown(reason="Socket time-outed while waiting for messages; disconnecting")
+        except asyncio.IncompleteReadError:
+            self.shutdown(reason="Received empty message from peer!")
+        except ConnectionError as e:
+            self.logger.warning("%s", e)
+            self.shutdown(reason="Generic socket error")
+        except ValueError as e:
+            self.logger.warning("%s", e)
+            self.shutdown(reason="Invalid message from peer")
+
+
+    def on_message(self, mex: Union[bytes, utils.MasterMex]):
+        """
+        Entry point, inside the event loop, for messages coming both
+        from the peer and from the Master.
+        """
+        if self.closed:
+            return
+
+        try:
+            if not self.interpret(mex):
+                self.close()
+        except Exception as e:
+            # A single misbehaving peer must not bring down the loop
+            self.logger.exception(e)
+            self.shutdown(reason=str(e))
+
+
+    def on_timeout_check(self):
+        """
+        Looks for unanswered REQUESTs (and sends PEX messages, when it
+        is time), every TIMEOUT_CHECK_INTERVAL seconds.
+        """
+        if self.closed:
+            return
+
+        try:
+            self.check_timeouts()
+            self.exchange_peers()
+        except Exception as e:
+            self.logger.exception(e)
+            self.shutdown(reason=str(e))
+            return
+
+        self.timeout_timer = self.engine.loop.call_later(
+            self.TIMEOUT_CHECK_INTERVAL, self.on_timeout_check
+        )
+
+
+    def serve_uploads(self, limit: Optional[int] = None):
+        try:
+            super().serve_uploads(limit)
+        except Exception as e:
+            self.logger.exception(e)
+            self.shutdown(reason=str(e))
+            return
+
+        # Kept only while the next block is of the same piece
+        if self.loaded is not None and (
+            not self.upload_queue or next(iter(self.upload_queue))[0] != self.loaded[0]):
+            self.loaded = None
+
+        # Transport full: the rest once the peer has read some
+        if (self.upload_queue and not self.closed and self.drain_task is None and
+            self.writer.transport.get_write_buffer_size() > WRITE_HIGH_WATER):
+            self.drain_task = self.engine.loop.create_task(self.resume_uploads())
+
+
+    async def resume_uploads(self):
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            return # the reader will notice
+        finally:
+            self.drain_task = None
+
+        if self.upload_queue and not self.closed:
+            self.serve_uploads()
+
+
+    async def load_piece(self, piece_index: int):
+        try:
+            data = await self.engine.loop.run_in_executor(None, self.read_data, piece_index)
+            self.loaded = (piece_index, data)
+        except OSError as e:
+            self.logger.warning("%s", e)
+            self.shutdown(reason="Cannot read piece {}".format(piece_index))
+            return
+        finally:
+            self.load_task = None
+
+        if self.upload_queue and not self.closed:
+            self.serve_uploads()
+        else:
+            self.loaded = None
+
+
+    def can_upload(self, piece_index: int) -> bool:
+        if self.writer.transport.get_write_buffer_size() > WRITE_HIGH_WATER:
+            return False
+
+        # Not at hand: read first (it also brings the piece in the page
+        # cache, for sendfile)
+        if (self.storage is not None and
+            (self.loaded is None or self.loaded[0] != piece_index) and
+            (self.metainfo.info_hash, piece_index) not in self.piece_cache):
+            if self.load_task is None:
+                self.load_task = self.engine.loop.create_task(self.load_piece(piece_index))
+            return False
+
+        return True
+
+
+    def send_message(self, mexType: sm.MexType, **kwargs):
+        if self.closed:
+            return
+
+        self.writer.write(self.make_message(mexType, **kwargs))
+
+
+    def send_block(self, piece_index: int, piece_offset: int, length: int):
+        """
+        When nothing is waiting in the transport buffer, the block is
+        written with sendfile directly on the socket, as much as the 
+        socket accepts without blocking; what is left (or the whole block,
+        if the buffer is not empty) goes through the transport, as a copy
+        from the piece read by can_upload (or from the piece cache).
+        """
+        if self.closed:
+            return
+
+        offset = piece_index * self.metainfo.piece_size + piece_offset
+        header = self.make_piece_header(piece_index, piece_offset, length)
+        transport = self.writer.transport
+        sent = 0
+
+        with self.storage.open_file() as f:
+            if (f is not None and self.options.get("sendfile", True) and
+                transport.get_write_buffer_size() == 0):
+
+                transport.write(header)
+                header = b""
+                # The header is in the kernel already, unless the socket
+                # is full: then the payload must follow it in the buffer
+                if transport.get_write_buffer_size() == 0:
+                    sent = utils.sendfile_nowait(self.sock_fd, f.fileno(), offset, length)
+
+        if sent < length:
+            piece_offset += sent
+            if self.loaded is not None and self.loaded[0] == piece_index:
+                data = self.loaded[1][piece_offset:piece_offset + length - sent]
+            else:
+                data = self.read_data(piece_index, piece_offset, length - sent)
+            transport.write(header + data)
+
+
+    def close(self):
+        self.closed = True
+        self.loaded = None
+        if self.timeout_timer is not None:
+            self.timeout_timer.cancel()
+        self.writer.close()
+
+
+    def shutdown(self, reason: Union[str, None] = None):
+        if self.closed:
+            return
+
+        self.logger.warning("Shutdown down for reason: %s", reason)
+        self.release_requests()
+        self.forget_hashing()
+        self.pex.remove(self.address)
+        self.send_to_master(utils.M_DISCONNECTED(self.address, reason))
+        self.close()
+
+
+##################################
+
+
+class PeerEngine:
+    """
+    Runs, on a single asyncio event loop living in its own thread, all
+    the peer connections of one or more ThreadedServers.
+
+    Incoming connections are routed to the right ThreadedServer by
+    looking at the info_hash in their HANDSHAKE, so that a single
+    listening socket can be shared by the whole Fiume session.
+    """
+
+    def __init__(self, options: Dict[str, Any]):
+        self.options = options
+        self.timeout = options.get("timeout", 10)
+        self.backlog = options.get("max_peer_connections", 100)
+
+        self.logger = logging.getLogger("PeerEngine")
+        self.logger.setLevel(options.get("debug_level", logging.DEBUG))
+
+        self.loop = asyncio.new_event_loop()
+        self.thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+        # info_hash -> ThreadedServer
+        self.torrents: Dict[bytes, "sm.ThreadedServer"] = dict()
+        self.served_sockets: Set[socket.socket] = set()
+
+
+    def start(self):
+        """
+        Starts the event loop thread, if not already running.
+        """
+        with self._lock:
+            if self.thread is not None:
+                return
+
+            self.thread = threading.Thread(target=self.loop.run_forever)
+            self.thread.daemon = True
+            self.thread.start()
+
+
+    def submit(self, coro) -> "concurrent.futures.Future":
+        """
+        Schedules a coroutine on the engine loop, from any thread.
+        """
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+
+    def add_torrent(self, torrent: "sm.ThreadedServer"):
+        self.torrents[torrent.metainfo.info_hash] = torrent
+
+
+    def remove_torrent(self, torrent: "sm.ThreadedServer"):
+        self.torrents.pop(torrent.metainfo.info_hash, None)
+
+
+    def serve(self, sock: socket.socket):
+        """
+        Starts accepting connections on `sock`. Serving the same socket
+        twice (eg. from two ThreadedServers of the same session) is a no-op.
+        """
+        with self._lock:
+            if sock in self.served_sockets:
+                return
+            self.served_sockets.add(sock)
+
+        # Wait for the server to be up, so that callers can rely on it
+        self.submit(
+            asyncio.start_server(self.accept, sock=sock, backlog=self.backlog)
+        ).result()
+        self.logger.info("Started listening on %s", sock.getsockname())
+
+
+    def connect(self, torrent: "sm.ThreadedServer", address: utils.Address):
+        """
+        Opens (asynchronously) a connection to a peer on behalf of `torrent`.
+        """
+        return self.submit(self._connect(torrent, address))
+
+
+    async def _connect(self, torrent: "sm.ThreadedServer", address: utils.Address):
+        try:
+            streams = await asyncio.wait_for(
+                asyncio.open_connection(*address), self.timeout
+            )
+        except asyncio.TimeoutError:
+            self.logger.debug("Cannot connect to %s after %d seconds, abort", address, self.timeout)
+            torrent.hibernate_peer(address)
+            return
+        except OSError as e:
+            self.logger.debug("%s: %s", address, e)
+            torrent.hibernate_peer(address)
+            return
+
+        peer = AsyncPeerManager(streams, address, torrent, sm.Initiator.SELF, self)
+        self.logger.info("Connected to: %s:%s", *address)
+
+        torrent.register_peer(peer)
+        await peer.run()
+
+
+    async def accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        address = writer.get_extra_info("peername")[:2]
+        self.logger.info("Received connection request from: %s", address)
+
+        try:
+            handshake = await asyncio.wait_for(reader.readexactly(68), self.timeout)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError) as e:
+            self.logger.debug("No HANDSHAKE from %s: %s", address, e)
+            writer.close()
+            return
+
+        torrent = self.torrents.get(handshake[28:48])
+
+        if torrent is None:
+            self.logger.warning("%s asked for unknown info_hash %s", address, handshake[28:48])
+            writer.close()
+            return
+
+        peer = AsyncPeerManager((reader, writer), address, torrent, sm.Initiator.OTHER, self)
+
+        torrent.register_peer(peer)
+        await peer.run(handshake)
@@ -0,0 +1,117 @@
+import socket
+import threading
+
+from queue import Queue
+from typing import *
+
+import Fiume.utils as utils
+
+Address = Tuple[str, int] # (ip, port)
+
+# Extended message id of ut_pex, as we announce it in our extended handshake
+UT_PEX_ID = 1
+# Seconds between two PEX messages to the same peer (BEP 11: at most one a minute)
+PEX_INTERVAL = 60.0
+# Peers added (and dropped) in a single message, at most
+MAX_PEX_PEERS = 50
+# Flag of added peers: it accepts connections (we connected to it)
+FLAG_REACHABLE = 0x10
+
+
+class PeerExchange:
+    """
+    Peer Exchange (ut_pex, BEP 11) state of a torrent, shared by all its
+    connections.
+
+    Knows the listening address of every connected peer: the ones we
+    connected to, and the ones that told it in their extended handshake
+    (BEP 10). Every PeerManager sends to its peer, once in a while, the
+    peers connected since its last message, and those gone meanwhile.
+
+    The addresses received from peers end up in `new_peers` (the queue
+    where ThreadedServer receives the peers found by trackers), each one
+    only once: `known` are those the ThreadedServer knows already.
+    """
+
+    def __init__(self, new_peers: Queue, port: int, known: Iterable[Address] = ()):
+        self.new_peers = new_peers
+        # Our listening port, told to peers in the extended handshake
+        self.port = port
+
+        self.lock = threading.Lock()
+        # connection address -> (listening address, flags)
+        self.connected: Dict[Address, Tuple[Address, int]] = dict()
+        self.known: Set[Address] = set(known)
+
+
+    def add(self, connection: Address, listening: Address, flags: int = 0):
+        """ A peer is connected, and accepts connections at `listening`. """
+        with self.lock:
+            self.connected[connection] = (listening, flags)
+            self.known.add(listening)
+
+
+    def remove(self, connection: Address):
+        with self.lock:
+            self.connected.pop(connection, None)
+
+
+    def peers(self, but: Address) -> Dict[Address, int]:
+        """
+        Listening address -> flags of the connected peers, except the
+        one connected at `but` (the peer they are going to be sent to).
+        IPv6 peers are left out: they would go in a separate list.
+        """
+        with self.lock:
+            return {
+                listening: flags
+                for connection, (listening, flags) in self.connected.items()
+                if connection != but and is_ipv4(listening[0])
+            }
+
+
+    def learned(self, peers: Iterable[Address]) -> List[Address]:
+        """
+        Peers received from a peer: the ones never seen before are
+        queued for the ThreadedServer, and returned. No more than
+        MAX_PEX_PEERS, whatever the peer sent.
+        """
+        peers = list(dict.fromkeys(peers))[:MAX_PEX_PEERS]
+        with self.lock:
+            new = [address for address in peers if address not in self.known]
+            self.known.update(new)
+
+        for address in new:
+            self.new_peers.put(address)
+        return new
+
+
+def is_ipv4(ip: str) -> bool:
+    try:
+        socket.inet_pton(socket.AF_INET, ip)
+    except (OSError, TypeError):
+        return False
+    return True
+
+
+def encode_peers(peers: Iterable[Address]) -> bytes:
+    """ The compact form of IPv4 addresses: 4 bytes of IP, 2 of port. """
+    return b"".join(socket.inet_aton(ip) + utils.to_bytes(port, 2) for ip, port in peers)
+
+
+def decode_peers(data: bytes) -> List[Address]:
+    if not isinstance(data, bytes):
+        return []
+    return [
+        (socket.inet_ntoa(data[i:i+4]), utils.to_int(data[i+4:i+6]))
+        for i in range(0, len(data) - len(data) % 6, 6)
+    ]
+
+
+def pex_message(added: Dict[Address, int], dropped: List[Address]) -> Dict[bytes, bytes]:
+    """ The (bencoded) payload of a ut_pex message. """
+    return {
+        b"added": encode_peers(added),
+        b"added.f": bytes(added.values()),
+        b"dropped": encode_peers(dropped),
+    }
@@ -0,0 +1,144 @@
+import heapq
+import random
+
+from collections import Counter
+from typing import *
+
+
+class PiecePicker:
+    """
+    Chooses which pieces to download next, among the candidates for a
+    peer (pieces it has, that we don't have and nobody is downloading).
+
+    Keeps how many connected peers have each piece (the availability),
+    updated when peers announce pieces (BITFIELD, HAVE) and when they
+    disconnect.
+    """
+
+    def __init__(self):
+        self.availability: Counter = Counter()
+
+
+    def peer_has(self, pieces: Iterable[int]):
+        """ A peer announced `pieces` (each must be counted only once per peer). """
+        self.availability.update(pieces)
+
+
+    def peer_gone(self, pieces: Iterable[int]):
+        """ A peer that had `pieces` disconnected. """
+        availability = self.availability
+        for p in pieces:
+            availability[p] -= 1
+            if availability[p] <= 0:
+                del availability[p]
+
+
+    def pick(self, candidates: Collection[int], n: int) -> List[int]:
+        raise NotImplementedError
+
+
+class RandomPicker(PiecePicker):
+    def pick(self, candidates: Collection[int], n: int) -> List[int]:
+        return random.sample(list(candidates), k=min(n, len(candidates)))
+
+
+class RarestFirstPicker(PiecePicker):
+    """
+    The pieces that fewer peers have come first, so that they are
+    replicated before their last owners leave; ties are broken at random,
+    so that peers who see the same availability pick different pieces.
+    """
+
+    def pick(self, candidates: Collection[int], n: int) -> List[int]:
+        availability, rand = self.availability, random.random
+        return heapq.nsmallest(n, candidates, key=lambda p: (availability[p], rand()))
+
+
+class SequentialPicker(PiecePicker):
+    """ The first pieces of the file first (eg. to play it while downloading). """
+
+    def pick(self, candidates: Collection[int], n: int) -> List[int]:
+        return heapq.nsmallest(n, candidates)
+
+
+class StreamingPicker(PiecePicker):
+    """
+    For downloads that are read while downloading: the first `window`
+    missing pieces from a read cursor come first, the most urgent
+    first; outside of the window, `fallback` decides.
+
+    Every piece in the window has a deadline: when the reader, at the
+    cursor, consumes `rate` bytes/sec, piece p is needed in
+    (p - cursor) * piece_size / rate seconds (the piece at the cursor,
+    right away, even if the rate is not known). The master asks the
+    overdue pieces to more peers.
+    """
+
+    def __init__(self, fallback: PiecePicker, bitmap: "Bitfield", piece_size: int, window=8):
+        super().__init__()
+        # The same availability counts of the fallback
+        self.availability = fallback.availability
+        self.fallback = fallback
+
+        self.bitmap = bitmap
+        self.piece_size = piece_size
+        self.window_size = window
+        self.cursor = 0
+        self.deadlines: Dict[int, float] = dict()
+
+
+    def seek(self, cursor: int, now: float, rate: float = 0.0):
+        """ The reader moved to piece `cursor`, and reads at `rate` bytes/sec. """
+        self.cursor = cursor
+        self.deadlines = dict()
+        for p in self.window():
+            if rate > 0:
+                self.deadlines[p] = now + (p - cursor) * self.piece_size / rate
+            elif p == cursor:
+                self.deadlines[p] = now
+
+
+    def window(self) -> List[int]:
+        """ The first missing pieces from the cursor on. """
+        bitmap = self.bitmap
+        while self.cursor < len(bitmap) and bitmap[self.cursor]:
+            self.cursor += 1
+
+        window, p = list(), self.cursor
+        while p < len(bitmap) and len(window) < self.window_size:
+            if not bitmap[p]:
+                window.append(p)
+            p += 1
+        return window
+
+
+    def overdue(self, now: float) -> List[int]:
+        """ Pieces past their deadline, and still missing. """
+        return [p for p, deadline in self.deadlines.items()
+                if deadline <= now and not self.bitmap[p]]
+
+
+    def pick(self, candidates: Collection[int], n: int) -> List[int]:
+        chosen = sorted(
+            (p for p in self.window() if p in candidates),
+            key=lambda p: (self.deadlines.get(p, float("inf")), p)
+        )[:n]
+
+        if len(chosen) < n:
+            taken = set(chosen)
+            rest = [p for p in candidates if p not in taken] if taken else candidates
+            chosen += self.fallback.pick(rest, n - len(chosen))
+        return chosen
+
+
+PICKERS = {
+    "random": RandomPicker,
+    "rarest": RarestFirstPicker,
+    "sequential": SequentialPicker,
+}
+
+def make_picker(kind: str) -> PiecePicker:
+    """ Returns the picker of the given kind (one of PICKERS). """
+    if kind not in PICKERS:
+        raise ValueError("Unknown piece picker {}".format(kind))
+    return PICKERS[kind]()
@@ -0,0 +1,117 @@
+import hashlib
+import math
+import threading
+
+from typing import *
+
+
+class PieceBuffer:
+    """
+    A piece being downloaded.
+
+    Its memory is allocated once, with the final size of the piece, and
+    every block is copied straight to its place: blocks can therefore
+    arrive in any order (and from any peer), and when the last one lands
+    `data` is the whole piece, ready to be hashed and written to disk
+    with no further copies.
+
+    The SHA-1 of the piece is computed as the blocks arrive: the blocks
+    received in order, from the start of the piece, can be hashed at any
+    time (by the Hasher's workers), and only what is left is hashed when
+    the piece is complete.
+    """
+
+    def __init__(self, index: int, size: int, block_size: int):
+        self.index = index
+        self.size = size
+        self.block_size = block_size
+
+        self.data = bytearray(size)
+        self.view = memoryview(self.data)
+
+        # received[i] == 1 <=> block at offset i*block_size is here
+        self.received = bytearray(math.ceil(size / block_size))
+        self.missing = len(self.received)
+
+        # The first `hashed` bytes of the piece are in `sha` already
+        self.sha = hashlib.sha1()
+        self.hashed = 0
+        self.hash_lock = threading.Lock()
+        # A Hasher's worker is about to extend the hash
+        self.hash_pending = False
+
+
+    def __repr__(self):
+        return "<PieceBuffer {} {}/{} blocks>".format(
+            self.index, len(self.received) - self.missing, len(self.received)
+        )
+
+
+    def block_length(self, offset: int) -> int:
+        """
+        Length of the block starting at `offset` (the last one may be shorter).
+        """
+        return min(self.block_size, self.size - offset)
+
+
+    def write(self, offset: int, payload: Union[bytes, memoryview]) -> bool:
+        """
+        Copies a block in place. Returns False (writing nothing) if the
+        block was already received or does not fit the piece.
+        """
+        if offset % self.block_size != 0 or offset >= self.size:
+            return False
+        if len(payload) != self.block_length(offset):
+            return False
+
+        block = offset // self.block_size
+        if self.received[block]:
+            return False
+
+        self.view[offset:offset+len(payload)] = payload
+        self.received[block] = 1
+        self.missing -= 1
+        return True
+
+
+    def is_complete(self) -> bool:
+        return self.missing == 0
+
+
+    def missing_offsets(self) -> Iterator[int]:
+        """
+        Offsets of the blocks not yet received, in order.
+        """
+        for block, here in enumerate(self.received):
+            if not here:
+                yield block * self.block_size
+
+
+    def can_hash(self) -> bool:
+        """ True if the block right after the hashed prefix has arrived. """
+        block = self.hashed // self.block_size
+        return block < len(self.received) and self.received[block] == 1
+
+
+    def hash_prefix(self) -> int:
+        """
+        Extends the hash over the blocks received, in order, after the
+        hashed prefix. Returns how many bytes are hashed.
+        """
+        with self.hash_lock:
+            end = self.hashed // self.block_size
+            while end < len(self.received) and self.received[end]:
+                end += 1
+
+            stop = min(end * self.block_size, self.size)
+            if stop > self.hashed:
+                self.sha.update(self.view[self.hashed:stop])
+                self.hashed = stop
+            return self.hashed
+
+
+    def digest(self) -> bytes:
+        """ SHA-1 of the whole piece, which must be complete. """
+        assert self.is_complete(), self
+        self.hash_prefix()
+        return self.sha.digest()
@@ -0,0 +1,115 @@
+import threading
+
+from collections import OrderedDict
+from typing import *
+
+Key = Hashable # eg. (info_hash, piece_index)
+
+
+class PieceCache:
+    """
+    Pieces recently read from storage to answer REQUESTs, shared by all
+    the peer connections of a torrent (or of a whole session: keys
+    contain the info_hash).
+
+    The least recently used pieces are evicted as soon as the total
+    size goes over `budget` bytes. When many connections ask at once for
+    the same missing piece, only one of them reads it from storage, and
+    the others wait for it.
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.size = 0
+
+        self.lock = threading.Lock()
+        self.pieces: "OrderedDict[Key, bytes]" = OrderedDict()
+        # Pieces being read right now, by some other thread
+        self.loading: Dict[Key, threading.Event] = dict()
+
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+
+    def __len__(self):
+        return len(self.pieces)
+
+    def __contains__(self, key: Key):
+        return key in self.pieces
+
+    def __repr__(self):
+        return "<PieceCache {} pieces, {}/{} bytes, hits={} misses={} evictions={}>".format(
+            len(self.pieces), self.size, self.budget, self.hits, self.misses, self.evictions
+        )
+
+
+    def stats(self) -> Dict[str, int]:
+        return {"pieces": len(self.pieces), "size": self.size, "budget": self.budget,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+    def get(self, key: Key) -> Optional[bytes]:
+        with self.lock:
+            data = self.pieces.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.pieces.move_to_end(key)
+            return data
+
+
+    def put(self, key: Key, data: bytes):
+        with self.lock:
+            self._put(key, data)
+
+
+    def get_or_load(self, key: Key, load: Callable[[], bytes]) -> bytes:
+        """
+        Returns the piece, calling `load` to read it if it is not cached.
+        """
+        while True:
+            with self.lock:
+                data = self.pieces.get(key)
+                if data is not None:
+                    self.hits += 1
+                    self.pieces.move_to_end(key)
+                    return data
+
+                loading = self.loading.get(key)
+                if loading is None:
+                    # Tocca a noi leggerlo
+                    self.misses += 1
+                    loading = self.loading[key] = threading.Event()
+                    break
+
+            # Someone else is reading it: wait, then look again (if it was
+            # too big for the cache, or failed, we will read it ourselves)
+            loading.wait()
+
+        try:
+            data = load()
+            with self.lock:
+                self._put(key, data)
+            return data
+        finally:
+            with self.lock:
+                del self.loading[key]
+            loading.set()
+
+
+    def _put(self, key: Key, data: bytes):
+        old = self.pieces.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+
+        if len(data) > self.budget:
+            return
+
+        self.pieces[key] = data
+        self.size += len(data)
+
+        while self.size > self.budget:
+            _, evicted = self.pieces.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
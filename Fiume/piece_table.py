@@ -0,0 +1,184 @@
+import itertools
+import threading
+
+from collections import Counter
+from typing import *
+
+import Fiume.piece_buffer as pb
+
+Block = Tuple[int, int] # (piece_index, piece_offset)
+
+
+class PieceTable:
+    """
+    The pieces being downloaded, shared by all the peer connections of
+    a torrent.
+
+    A piece does not belong to a single connection: every connection the
+    master scheduled it to claims the blocks that nobody requested yet,
+    so that several peers can fill the same piece in parallel. Blocks are
+    copied in place in the PieceBuffer of the piece; the connection that
+    receives the last one takes the whole piece, to hash it and write it
+    out, once.
+
+    In endgame (set by the master), and for urgent pieces (eg. overdue
+    while streaming), blocks already requested from some peer can be
+    claimed again by other connections.
+    """
+
+    def __init__(self, block_size: int):
+        self.block_size = block_size
+        self.endgame = False
+        self.urgent: Set[int] = set()
+
+        self.lock = threading.Lock()
+        self.pieces: Dict[int, pb.PieceBuffer] = dict()
+        # piece_index -> offset -> how many connections requested that block
+        self.requested: Dict[int, Counter] = dict()
+        # Pieces taken by the connection that completed them
+        self.completed: Set[int] = set()
+
+
+    def __len__(self):
+        return len(self.pieces)
+
+    def __contains__(self, index: int):
+        return index in self.pieces
+
+    def __repr__(self):
+        return "<PieceTable {} pieces in progress, {} completed>".format(
+            len(self.pieces), len(self.completed)
+        )
+
+
+    def start(self, index: int, size: int) -> bool:
+        """
+        Joins the download of a piece, starting it if nobody did yet.
+        Returns False if the piece was completed already.
+        """
+        with self.lock:
+            if index in self.completed:
+                return False
+            if index not in self.pieces:
+                self.pieces[index] = pb.PieceBuffer(index, size, self.block_size)
+                self.requested[index] = Counter()
+            return True
+
+
+    def get(self, index: int) -> Optional[pb.PieceBuffer]:
+        """ The buffer of a piece in progress, if any. """
+        with self.lock:
+            return self.pieces.get(index)
+
+
+    def has_unclaimed(self, index: int) -> bool:
+        """
+        True if some block of the piece was neither received nor
+        requested (as is the case for pieces not started yet).
+        """
+        with self.lock:
+            piece = self.pieces.get(index)
+            if piece is None:
+                return index not in self.completed
+
+            requested = self.requested[index]
+            return any(requested[o] == 0 for o in piece.missing_offsets())
+
+
+    def claim(self, index: int, n: int, mine: Container[Block] = ()) -> List[int]:
+        """
+        Takes up to `n` blocks of the piece to request: the missing ones
+        that no connection requested and, in endgame or if urgent, also
+        the requested ones (except those in `mine`, already requested by the caller).
+        Returns their offsets.
+        """
+        with self.lock:
+            piece = self.pieces.get(index)
+            if piece is None or n <= 0:
+                return []
+
+            requested = self.requested[index]
+            claimed = list(itertools.islice(
+                (o for o in piece.missing_offsets() if requested[o] == 0), n
+            ))
+
+            if (self.endgame or index in self.urgent) and len(claimed) < n:
+                claimed += itertools.islice(
+                    (o for o in piece.missing_offsets()
+                     if requested[o] > 0 and (index, o) not in mine),
+                    n - len(claimed)
+                )
+
+            for o in claimed:
+                requested[o] += 1
+            return claimed
+
+
+    def hurry(self, index: int):
+        """ The piece is urgent: its blocks can be requested from more peers. """
+        with self.lock:
+            if index not in self.completed:
+                self.urgent.add(index)
+
+
+    def release(self, blocks: Iterable[Block]):
+        """
+        Blocks requested that will not arrive anymore (eg. CANCELed, or
+        the peer choked us or disconnected): others can claim them.
+        """
+        with self.lock:
+            for (index, offset) in blocks:
+                self._unrequest(index, offset)
+
+
+    def write(self, index: int, offset: int, payload: Union[bytes, memoryview]) -> bool:
+        """
+        Copies a requested block in its piece. Returns False (writing
+        nothing) if the piece is not in progress, or the block is a
+        duplicate or does not fit the piece.
+        """
+        with self.lock:
+            self._unrequest(index, offset)
+
+            piece = self.pieces.get(index)
+            if piece is None:
+                return False
+            return piece.write(offset, payload)
+
+
+    def complete(self, index: int) -> Optional[pb.PieceBuffer]:
+        """
+        If all the blocks of the piece arrived, removes it from the table
+        and returns it: only one caller gets it.
+        """
+        with self.lock:
+            piece = self.pieces.get(index)
+            if piece is None or not piece.is_complete():
+                return None
+
+            del self.pieces[index]
+            del self.requested[index]
+            self.urgent.discard(index)
+            self.completed.add(index)
+            return piece
+
+
+    def drop(self, index: int):
+        """
+        Forgets a piece (eg. its hash did not match): it must be
+        downloaded again from scratch.
+        """
+        with self.lock:
+            self.pieces.pop(index, None)
+            self.requested.pop(index, None)
+            self.completed.discard(index)
+
+
+    def _unrequest(self, index: int, offset: int):
+        requested = self.requested.get(index)
+        if requested is None or requested[offset] == 0:
+            return
+
+        requested[offset] -= 1
+        if requested[offset] == 0:
+            del requested[offset]
@@ -0,0 +1,139 @@
+import math
+import time
+
+from typing import *
+
+Block = Tuple[int, int] # (piece_index, piece_offset)
+
+
+class RequestPipeline:
+    """
+    The REQUESTs sent to a single peer and not yet answered.
+
+    Keeping many requests in flight is what allows a connection to go
+    faster than block_size/RTT. How many is decided by the bandwidth-delay
+    product of the connection: (download rate) x (base RTT), measured
+    on the blocks actually received, plus some headroom so that the
+    estimate can grow when the peer can go faster.
+    """
+
+    # Every how many seconds rate and RTT estimates are updated
+    WINDOW = 1.0
+    # Weight of the newest window in the rate EWMA
+    ALPHA = 0.5
+    # Queue this much more than the estimated bandwidth-delay product
+    HEADROOM = 1.5
+
+    def __init__(self, block_size: int, max_depth=64, min_depth=2,
+                 initial_depth=4, clock=time.monotonic):
+        self.block_size = block_size
+        self.max_depth = max(1, max_depth)
+        self.min_depth = min(min_depth, self.max_depth)
+        self.depth = max(self.min_depth, min(initial_depth, self.max_depth))
+        self.clock = clock
+
+        # (piece_index, piece_offset) -> when it was requested
+        self.outstanding: Dict[Block, float] = dict()
+
+        self.rate: float = 0.0                # bytes/sec, EWMA
+        self.min_rtt: Optional[float] = None  # seconds, base RTT
+
+        # When the last block arrived
+        self.last_received = self.clock()
+
+        self._window_start = self.clock()
+        self._window_bytes = 0
+        self._window_min_rtt: Optional[float] = None
+
+
+    def __len__(self):
+        return len(self.outstanding)
+
+    def __contains__(self, block: Block):
+        return block in self.outstanding
+
+
+    def free_slots(self) -> int:
+        """
+        How many new REQUESTs can be sent right now.
+        """
+        return max(0, self.depth - len(self.outstanding))
+
+
+    def sent(self, piece_index: int, piece_offset: int):
+        now = self.clock()
+        if self.outstanding == {} and self._window_bytes == 0:
+            self._window_start = now # do not count idle time in the rate
+
+        self.outstanding[(piece_index, piece_offset)] = now
+
+
+    def received(self, piece_index: int, piece_offset: int, length: int) -> bool:
+        """
+        Registers the arrival of a block. Returns False if that block
+        was never requested (or was already received/discarded).
+        """
+        requested_at = self.outstanding.pop((piece_index, piece_offset), None)
+        if requested_at is None:
+            return False
+
+        now = self.clock()
+        latency = now - requested_at
+        self.last_received = now
+
+        self._window_bytes += length
+        if self._window_min_rtt is None or latency < self._window_min_rtt:
+            self._window_min_rtt = latency
+
+        if now - self._window_start >= self.WINDOW:
+            self._close_window(now)
+
+        return True
+
+
+    def discard(self, piece_index: Optional[int] = None) -> List[Block]:
+        """
+        Forgets the outstanding requests for a piece (or all of them, eg.
+        when the peer chokes us, which implicitly drops our requests).
+        Returns the blocks forgotten.
+        """
+        if piece_index is None:
+            blocks = list(self.outstanding)
+            self.outstanding.clear()
+            return blocks
+
+        blocks = [b for b in self.outstanding if b[0] == piece_index]
+        for block in blocks:
+            del self.outstanding[block]
+        return blocks
+
+
+    def expired(self, timeout: float) -> List[Block]:
+        """ The outstanding requests sent more than `timeout` seconds ago. """
+        now = self.clock()
+        return [b for b, sent_at in self.outstanding.items() if now - sent_at >= timeout]
+
+
+    def _close_window(self, now: float):
+        elapsed = now - self._window_start
+        window_rate = self._window_bytes / elapsed
+
+        self.rate = (window_rate if self.rate == 0 else
+                     self.ALPHA * window_rate + (1 - self.ALPHA) * self.rate)
+
+        # Base RTT: the smallest latency ever seen. The minimum (and not
+        # the average) is used, because the average also contains the time
+        # our requests spend queued at the peer, which grows with depth; 
+        # for the same reason, it is never allowed to grow again.
+        if self.min_rtt is None or self._window_min_rtt < self.min_rtt:
+            self.min_rtt = self._window_min_rtt
+
+        bdp = self.rate * self.min_rtt / self.block_size
+        self.depth = max(
+            self.min_depth,
+            min(self.max_depth, math.ceil(self.HEADROOM * bdp) + 1)
+        )
+
+        self._window_start = now
+        self._window_bytes = 0
+        self._window_min_rtt = None
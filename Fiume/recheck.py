@@ -0,0 +1,107 @@
+import os
+import mmap
+import hashlib
+
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import *
+
+from Fiume.bitfield import Bitfield
+
+# Pieces verified by a worker in a single task: large enough that the
+# overhead of a task is negligible, small enough to balance the workers
+PIECES_PER_TASK = 16
+
+
+def file_stat(path: Path) -> Optional[Tuple[int, int]]:
+    """ (size, mtime in ns) of a file, or None if it does not exist. """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def recheck(path: Path, piece_size: int, pieces_hash: List[bytes], total_size: int,
+            workers: Optional[int] = None, pool: Optional[Executor] = None,
+            found: Optional[Callable[[List[int]], None]] = None) -> Bitfield:
+    """
+    Which pieces of the download file at `path` are there already, ie.
+    match their hash in the metainfo.
+
+    The file is mmap-ed, and read in order (the kernel reads ahead),
+    while a pool of `workers` threads (default: one per CPU) hashes it:
+    hashlib releases the GIL on large buffers, so they run in parallel.
+    Pieces past the end of the file are missing.
+
+    With `pool` (eg. the one of the session Hasher, with `workers`
+    threads) no pool is created, and only a few tasks at a time are
+    queued in it: the pieces being downloaded are not held back until
+    the whole file is hashed. `found(pieces)` is called, in order, as
+    the present pieces are found.
+    """
+    num_pieces = len(pieces_hash)
+    bitmap = Bitfield(num_pieces)
+
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return bitmap
+
+    try:
+        size = os.fstat(fd).st_size
+        if size == 0:
+            return bitmap
+
+        with mmap.mmap(fd, size, access=mmap.ACCESS_READ) as m:
+            if hasattr(m, "madvise"):
+                m.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(m)
+
+            def check(first: int) -> List[int]:
+                present = list()
+                for i in range(first, min(first + PIECES_PER_TASK, num_pieces)):
+                    start = i * piece_size
+                    end = min(start + piece_size, total_size)
+                    if end > size:
+                        break
+                    if hashlib.sha1(view[start:end]).digest() == pieces_hash[i]:
+                        present.append(i)
+                return present
+
+            workers = workers or os.cpu_count() or 1
+            tasks = iter(range(0, num_pieces, PIECES_PER_TASK))
+            in_flight = deque()
+
+            def run(pool: Executor):
+                for first in tasks:
+                    in_flight.append(pool.submit(check, first))
+                    if len(in_flight) < 2 * workers:
+                        continue
+                    collect(in_flight.popleft().result())
+                while in_flight:
+                    collect(in_flight.popleft().result())
+
+            def collect(present: List[int]):
+                for i in present:
+                    bitmap[i] = True
+                if present and found is not None:
+                    found(present)
+
+            try:
+                if pool is not None:
+                    run(pool)
+                else:
+                    with ThreadPoolExecutor(workers) as own_pool:
+                        run(own_pool)
+            finally:
+                # No worker must be left reading the mapping
+                for future in in_flight:
+                    future.cancel()
+                wait(in_flight)
+                view.release()
+    finally:
+        os.close(fd)
+
+    return bitmap
@@ -0,0 +1,275 @@
+import os
+import time
+import struct
+import logging
+import threading
+
+from pathlib import Path
+from typing import *
+
+import Fiume.utils as utils
+import Fiume.recheck as recheck_mod
+import Fiume.storage as storage_mod
+from Fiume.bitfield import Bitfield
+
+# magic, version, number of pieces, info_hash, size and mtime (ns) of
+# the download file when saved; then the bitfield, as sent in BITFIELD
+# messages. Version 1 had no size and mtime.
+MAGIC = b"FIUMERES"
+VERSION = 2
+HEADER = struct.Struct(">8sBI20sQq")
+HEADER_V1 = struct.Struct(">8sBI20s")
+# Saved when the download file is not known
+NO_STAT = (0, 0)
+
+FileStat = Tuple[int, int] # (size, mtime_ns)
+
+
+class ResumeFile:
+    """
+    Which pieces of a torrent we have, saved on disk to resume the
+    download in a later session.
+
+    The bitmap in memory is the authoritative one, and only the owner of
+    the ResumeFile (the master) changes it, with `mark`. Changes are
+    saved together, by a timer thread: when `flush_every` pieces are
+    waiting, or at most `flush_interval` seconds after the first of them.
+    The file is
+    rewritten in a temporary file then renamed over the old one, so that
+    a crash leaves either the old or the new version, never half of it
+    (and, at most, some pieces to download again).
+
+    Along with the bitmap, the size and mtime of the download file
+    (`data_path`) are saved: if they did not change when the torrent is
+    opened again, the bitmap can be trusted without rehashing the file.
+    The `storage` the pieces are written to, if set, is flushed first:
+    the bitmap never claims pieces still in the page cache.
+
+    With path None nothing is saved.
+    """
+
+    def __init__(self, path: Optional[Path], bitmap: Bitfield, info_hash: bytes,
+                 flush_interval: float = 5.0, flush_every: int = 64,
+                 data_path: Optional[Path] = None,
+                 storage: Optional["storage_mod.Storage"] = None):
+        self.path = path
+        self.bitmap = bitmap
+        self.info_hash = info_hash
+        self.data_path = data_path
+        self.storage = storage
+
+        self.flush_interval = flush_interval
+        self.flush_every = flush_every
+
+        self.lock = threading.Lock()
+        self.dirty = 0 # pieces marked, but not yet saved
+        self.last_flush = time.monotonic()
+        self.timer: Optional[threading.Timer] = None
+        self.flush_at = 0.0 # when the timer fires
+        # Held while writing, not to block mark
+        self.write_lock = threading.Lock()
+        self.flushes = 0
+        # The saved bitmap could not be trusted: the pieces in the download
+        # file are still to be found (see recheck_file)
+        self.needs_recheck = False
+
+
+    def mark(self, piece_index: int):
+        """
+        Records that we have `piece_index`. Never waits for the disk:
+        the changes are saved by a timer thread.
+        """
+        with self.lock:
+            if self.bitmap[piece_index]:
+                return
+            self.bitmap[piece_index] = True
+
+            if self.path is None:
+                return
+
+            self.dirty += 1
+            now = time.monotonic()
+            elapsed = now - self.last_flush
+            if self.dirty >= self.flush_every or elapsed >= self.flush_interval:
+                delay = 0.0
+            else:
+                delay = self.flush_interval - elapsed
+
+            if self.timer is not None:
+                if self.flush_at <= now + delay:
+                    return
+                self.timer.cancel() # sooner than that
+
+            self.flush_at = now + delay
+            self.timer = threading.Timer(delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+
+    def flush(self):
+        """ Saves the pending changes, if any. """
+        self._flush(force=False)
+
+
+    def save(self):
+        """ Saves the bitmap, even if nothing changed. """
+        self._flush(force=True)
+
+
+    def close(self):
+        self.flush()
+
+
+    def _flush(self, force: bool):
+        # A copy of the bitmap is taken under the lock; the disk is
+        # waited for without it (mark goes on), one flush at a time
+        with self.write_lock:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+
+                if (self.dirty == 0 and not force) or self.path is None:
+                    return
+
+                bitmap = self.bitmap.copy()
+                self.dirty = 0
+                self.last_flush = time.monotonic()
+
+            # Pieces are written to the file before being marked: once it is
+            # on disk, the file can only be newer than this bitmap
+            if self.storage is not None:
+                self.storage.flush()
+            stat = None if self.data_path is None else recheck_mod.file_stat(self.data_path)
+            size, mtime_ns = stat if stat is not None else NO_STAT
+
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            with open(tmp_path, "wb") as f:
+                f.write(HEADER.pack(MAGIC, VERSION, len(bitmap), self.info_hash, size, mtime_ns))
+                f.write(bitmap.view())
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self.flushes += 1
+
+
+def load_bitmap(path: Path, num_pieces: int, info_hash: bytes) -> Optional[Bitfield]:
+    """
+    The bitmap saved in `path`, or None if it is missing or does not
+    belong to this torrent.
+    """
+    loaded = load_resume(path, num_pieces, info_hash)
+    return None if loaded is None else loaded[0]
+
+
+def load_resume(path: Path, num_pieces: int,
+                info_hash: bytes) -> Optional[Tuple[Bitfield, Optional[FileStat]]]:
+    """
+    The bitmap saved in `path`, and the size and mtime of the download
+    file when it was saved (None if unknown); None if the file is
+    missing or does not belong to this torrent.
+    """
+    try:
+        raw = path.read_bytes()
+    except FileNotFoundError:
+        return None
+
+    if raw[:len(MAGIC)] == MAGIC:
+        if len(raw) < HEADER_V1.size:
+            return None
+
+        _, version, saved_pieces, saved_hash = HEADER_V1.unpack_from(raw)
+        if saved_pieces != num_pieces or saved_hash != info_hash:
+            return None
+
+        stat, header_size = None, HEADER_V1.size
+        if version == VERSION:
+            if len(raw) < HEADER.size:
+                return None
+            stat, header_size = HEADER.unpack_from(raw)[4:], HEADER.size
+            if stat == NO_STAT:
+                stat = None
+        elif version != 1:
+            return None
+
+        try:
+            return Bitfield(num_pieces, raw[header_size:]), stat
+        except ValueError:
+            return None
+
+    # Vecchio formato: una stringa "0101...", un carattere per pezzo
+    text = raw.strip()
+    if len(text) == num_pieces and set(text) <= set(b"01"):
+        return Bitfield.from_string(text.decode("ascii")), None
+
+    return None
+
+
+def open_resume(metainfo, options: Dict[str, Any]) -> ResumeFile:
+    """
+    The ResumeFile of a torrent, with the pieces we have already.
+
+    How they are found depends on options["recheck"]:
+    - "quick": the bitmap saved in a previous session, if the download
+      file did not change since (same size and mtime); otherwise the
+      file is rechecked, hashing it
+    - "full": the file is always rechecked
+    - "off": the saved bitmap, if any, is trusted
+
+    The file is not hashed here, it may take minutes: when it must be,
+    the bitmap is empty and `needs_recheck` is set. The owner of the
+    ResumeFile then runs recheck_file, and marks the pieces it finds.
+    """
+    logger = logging.getLogger("Resume - {}".format(metainfo.human_name))
+    logger.setLevel(options.get("debug_level", logging.DEBUG))
+
+    path = utils.get_bitmap_file(metainfo.download_fpath)
+    data_path = metainfo.download_fpath
+    mode = options.get("recheck", "quick")
+    if options.get("storage", "file") == "memory":
+        mode = "off" # nothing on disk to recheck
+
+    loaded, bitmap = None, None
+    # Se il file scaricato non esiste (magari perché è stato eliminato)
+    # si ricomincia da capo, anche se c'è il file di resume
+    stat = recheck_mod.file_stat(data_path)
+    if stat is not None:
+        loaded = load_resume(path, metainfo.num_pieces, metainfo.info_hash)
+        if loaded is None and path.exists():
+            logger.warning("Resume file %s is not valid for this torrent, ignored", path)
+
+    if loaded is not None and (mode == "off" or (mode == "quick" and loaded[1] == stat)):
+        bitmap = loaded[0]
+
+    resume = ResumeFile(
+        path, bitmap if bitmap is not None else Bitfield(metainfo.num_pieces),
+        metainfo.info_hash,
+        flush_interval=options.get("resume_flush_interval", 5.0),
+        flush_every=options.get("resume_flush_pieces", 64),
+        data_path=data_path
+    )
+    resume.needs_recheck = bitmap is None and stat is not None and mode != "off"
+    return resume
+
+
+def recheck_file(metainfo, options: Dict[str, Any], hasher=None,
+                 found: Optional[Callable[[List[int]], None]] = None) -> Bitfield:
+    """
+    Hashes the download file of a torrent, on the pool of `hasher` (a
+    Fiume.hasher.Hasher) if given: the pieces present, passed to `found`
+    as they are found too.
+    """
+    logger = logging.getLogger("Resume - {}".format(metainfo.human_name))
+    logger.setLevel(options.get("debug_level", logging.DEBUG))
+
+    logger.info("Rechecking %s (%d pieces)", metainfo.download_fpath, metainfo.num_pieces)
+    start = time.monotonic()
+    bitmap = recheck_mod.recheck(
+        metainfo.download_fpath, metainfo.piece_size, metainfo.pieces_hash, metainfo.total_size,
+        workers=options.get("hash_workers") if hasher is None else hasher.workers,
+        pool=None if hasher is None else hasher.pool,
+        found=found
+    )
+    logger.info("Rechecked in %.1fs: %d/%d pieces present",
+                time.monotonic() - start, bitmap.count(), len(bitmap))
+    return bitmap
@@ -4,17 +4,31 @@ import threading
 import logging
 import enum
 import random
+import math
 import pathlib 
 import sys
 
-from queue import Queue
+from queue import Queue, Empty
 from typing.io import *
 from typing import *
 
 import Fiume.utils as utils
 import Fiume.master as master
-import Fiume.ttl as ttl
+import Fiume.ttl_cond as ttl
+import Fiume.pipeline as pipeline
+import Fiume.piece_table as piece_table_mod
+import Fiume.hasher as hasher_mod
+import Fiume.framing as framing
+import Fiume.storage as storage_mod
+import Fiume.piece_cache as piece_cache_mod
+import Fiume.bitfield as bitfield
+import Fiume.resume as resume_mod
+import Fiume.picker as picker_mod
+import Fiume.streaming as streaming
 import Fiume.config as config
+import Fiume.pex as pex_mod
+
+import bencodepy
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -35,11 +49,24 @@ class MexType(enum.Enum):
     PIECE = 7
     CANCEL = 8
     PORT = 9 # NOT USED
+    EXTENDED = 20 # BEP 10
 
 class Initiator(enum.Enum):
     SELF = 0
     OTHER = 1
 
+# REQUESTs for larger blocks are refused (as most clients do)
+MAX_REQUEST_LENGTH = 1 << 17
+# REQUESTs of a peer waiting to be served, at most: the others are dropped
+MAX_QUEUED_REQUESTS = 256
+# Blocks uploaded after each message, while other messages are waiting
+UPLOAD_BATCH = 4
+
+# Reserved bytes of the HANDSHAKE: we support the extension protocol (BEP 10)
+RESERVED = bytes([0, 0, 0, 0, 0, 0x10, 0, 0])
+# Extended message id of the extended handshake
+EXTENDED_HANDSHAKE = 0
+
 
 #############################################
 
@@ -55,16 +82,26 @@ class PeerManager:
     a central coordination is needed. Communications with the MasterControlUnit
     happen through a Queue.
     """
+
+    # Every how many seconds unanswered REQUESTs are looked for
+    TIMEOUT_CHECK_INTERVAL = 1.0
     
     def __init__(self, socket: Tuple,
                  metainfo, tracker_manager,
                  master_queues: Tuple[Queue, Queue],
-                 initial_bitmap: List[bool],
+                 initial_bitmap: bitfield.Bitfield,
                  options: Dict[str, Any],
-                 initiator: Initiator):
+                 initiator: Initiator,
+                 storage: "storage_mod.Storage" = None,
+                 piece_cache: "piece_cache_mod.PieceCache" = None,
+                 piece_table: "piece_table_mod.PieceTable" = None,
+                 hasher: "hasher_mod.Hasher" = None,
+                 pex: "pex_mod.PeerExchange" = None):
         
         # Peer socket
         self.socket, self.address = socket
+        if self.socket is not None:
+            utils.set_nodelay(self.socket)
         self.peer_ip, self.peer_port = self.address
                 
         self.metainfo = metainfo
@@ -90,29 +127,92 @@ class PeerManager:
         self.initiator: Initiator = initiator
         self.received_handshake, self.sent_handshake = False, False
 
+        # Extension protocol (BEP 10): whether the peer supports it, and
+        # the extended messages it understands (name -> its id for them)
+        self.peer_supports_extensions = False
+        self.peer_extensions: Dict[bytes, int] = dict()
+
+        # Peer Exchange (BEP 11), shared with the other connections.
+        # The address the peer accepts connections at, if known, and
+        # the peers we told it about (address -> flags)
+        self.pex = pex if pex is not None else (
+            pex_mod.PeerExchange(Queue(), self.options.get("port", 0))
+        )
+        self.pex_interval = self.options.get("pex_interval", pex_mod.PEX_INTERVAL)
+        self.peer_listening: Optional[utils.Address] = None
+        self.pex_sent: Dict[utils.Address, int] = dict()
+        # When to send the next PEX message (None: the peer does not want them)
+        self.next_pex: Optional[float] = None
+        # When the peer sent its last one
+        self.last_pex_received: Optional[float] = None
+
         # Queues for inter-thread communication
         self.queue_in, self.queue_to_master = master_queues
 
         # Bitmaps of my/other pieces
-        self.my_bitmap = initial_bitmap
-        self.peer_bitmap: List[bool] = utils.empty_bitmap(self.metainfo.num_pieces)
+        # (a copy: the master's bitmap must be updated only by the master)
+        self.my_bitmap = initial_bitmap.copy()
+        self.peer_bitmap = bitfield.Bitfield(self.metainfo.num_pieces)
 
         # Output file
         self.out_fpath: pathlib.Path = self.initialize_file(self.options["output_file"])
 
+        # The Master's storage. When available, REQUESTs are answered
+        # directly from here; otherwise through the Master (who writes
+        # the completed pieces, in any case)
+        self.storage = storage
+
+        # Pieces read to answer REQUESTs, shared with the other connections
+        self.piece_cache = piece_cache if piece_cache is not None else (
+            piece_cache_mod.PieceCache(self.options.get("cache_size", 64) * 2**20)
+        )
+
         # Blocks that I don't have but my peer has
         self.am_interested_in: List[int] = list()
         self.peer_interested_in: List[int] = list()
 
         self.scheduled: List[int] = list()
-        
-        self.my_progresses: Dict[int, Tuple[bytes, int]] = dict()
+
+        # Pieces being downloaded, shared with the other connections (who
+        # may be filling the same pieces), and those we are contributing to
+        self.piece_table = piece_table if piece_table is not None else (
+            piece_table_mod.PieceTable(self.metainfo.block_size)
+        )
+        self.my_progresses: Set[int] = set()
+
+        # Completed pieces, waiting for the Hasher to verify them
+        self.hasher = hasher if hasher is not None else hasher_mod.Hasher(1)
+        self.hashing: Dict[int, "piece_table_mod.pb.PieceBuffer"] = dict()
         self.peer_progresses: Dict[int, Tuple[int, int]] = dict()
 
-        self.cache_pieces: Dict[int, bytes] = dict()
-        self.deferred_peer_requests: Dict[int, Tuple[int, int]] = dict()
+        # piece_index -> REQUESTs (offset, length) waiting for the piece from the master
+        self.deferred_peer_requests: Dict[int, List[Tuple[int, int]]] = dict()
+
+        # REQUESTs received and not yet served, (index, offset, length) in
+        # order of arrival: they are served after the whole batch of
+        # messages they came with, so that a CANCEL can still remove them
+        self.upload_queue: Dict[Tuple[int, int, int], None] = dict()
+        
+        # Bytes received since the last message to the master, who
+        # estimates from them the download rate of this peer
+        self.downloaded = 0
+        # Bytes sent to the peer, ever (read by the master's choker)
+        self.uploaded = 0
         
-        self.max_concurrent_pieces = 4
+        # REQUESTs sent and not yet answered
+        self.pipeline = pipeline.RequestPipeline(
+            self.metainfo.block_size,
+            max_depth=self.options.get("request_queue_depth", 64)
+        )
+
+        # REQUESTs unanswered for request_timeout seconds are given up, and
+        # left to other peers; if, meanwhile, the peer sent nothing at all
+        # for snub_timeout seconds (while unchoking us), it is snubbing us
+        self.request_timeout = self.options.get("request_timeout", 5.0)
+        self.snub_timeout = self.options.get("snub_timeout", 8.0)
+        self.snubbed = False
+        self.peer_unchoked_at = self.pipeline.clock()
+        self.next_timeout_check = self.pipeline.clock() + self.TIMEOUT_CHECK_INTERVAL
     
         self.old_messages: List[Tuple[str, bytes]] = list()
         self.completed = False
@@ -151,8 +251,7 @@ class PeerManager:
         self.send_message(MexType.HANDSHAKE)
         self.sent_handshake = True
         if self.received_handshake:
-            self.logger.info("Sending BITFIELD")
-            self.send_message(MexType.BITFIELD)
+            self.handshake_done()
 
 
     def receive_handshake(self, mex):
@@ -164,67 +263,78 @@ class PeerManager:
             return
         
         self.received_handshake = True
+        self.peer_supports_extensions = bool(mex[25] & RESERVED[5])
         self.logger.info("Received HANDSHAKE")
         
         if self.sent_handshake:
-            self.logger.info("Sending BITFIELD")
-            self.send_message(MexType.BITFIELD)
+            self.handshake_done()
         else:
             self.send_handshake()        
 
 
-    def initialize_file(self, fpath: pathlib.Path):
-        """ Initialize the download file """
-        if not fpath.exists():
-            # Es. se path è /a/b/c/d.jpg ma b,c,d non
-            # esistono, creale
-            if not fpath.parent.exists():
-                fpath.parent.mkdir(parents=True)
+    def handshake_done(self):
+        """
+        Both HANDSHAKEs were exchanged: sends our BITFIELD and, if the
+        peer supports the extension protocol, our extended handshake.
+        """
+        self.logger.info("Sending BITFIELD")
+        self.send_message(MexType.BITFIELD)
+
+        if self.peer_supports_extensions:
+            self.send_extended_handshake()
+
+        # We connected to it: it accepts connections at this address
+        if self.initiator == Initiator.SELF:
+            self.peer_listening = self.address
+            self.pex.add(self.address, self.address, pex_mod.FLAG_REACHABLE)
+
 
-            fpath.touch()
+    def send_extended_handshake(self):
+        """
+        Tells the peer the extended messages we understand (only
+        ut_pex, unless disabled) and our listening port (BEP 10).
+        """
+        extensions = {b"ut_pex": pex_mod.UT_PEX_ID} if self.pex_interval > 0 else dict()
+        payload = {b"m": extensions, b"v": b"Fiume"}
+        if self.pex.port:
+            payload[b"p"] = self.pex.port
 
-            with open(fpath, "wb") as f:
-                f.write(bytes(self.metainfo.num_pieces))
+        self.send_message(MexType.EXTENDED, extended_id=EXTENDED_HANDSHAKE, payload=payload)
 
-            return fpath
 
+    def initialize_file(self, fpath: pathlib.Path):
+        """ Initialize the download file """
+        storage_mod.initialize_file(
+            self.options.get("storage", "file"), fpath, self.metainfo.total_size
+        )
         return fpath
 
                                      
     # Thread a sé stante
     def message_socket_receiver(self):        
-        try:
-            handshake_mex = self.socket.recv(68)
-            self.queue_in.put(handshake_mex)
+        """
+        Reads from the socket, in large chunks, and passes every message
+        received (HANDSHAKE included) to the interpreter thread.
+        """
+        frames = framing.FrameBuffer()
 
+        try:
             while True:
-                raw_length = self.socket.recv(4)
-                length = int.from_bytes(raw_length, byteorder="big", signed=False)
-
-                if length == 0:
+                if frames.recv_from(self.socket) == 0:
+                    # Connection closed by peer
                     self.queue_in.put(b"")
-                    break
+                    return
 
-                raw_mex = bytes()
-                while length != 0:
-                    data = self.socket.recv(length)
+                # The buffer is reused by the next recv: copy each message
+                # once, to hand it over to the other thread
+                for mex in frames.messages():
+                    self.queue_in.put(bytes(mex))
+
+        except ValueError as e:
+            self.logger.warning("%s", e)
+            self.shutdown(reason="Invalid message from peer")
+            return
 
-                    # Otherwise, if a b"" happens while in this loop you have a terrible
-                    # infinite loop!
-                    if len(data) == 0:
-                        self.queue_in.put(b"")
-                        return
-                
-                    raw_mex += data
-                    length -= len(data)
-                    if length < 0:
-                        breakpoint()
-                        _ = 0
-                    if length != 0 and self.debug:
-                        print(f"Still waiting for {length} bytes...")
-
-                self.queue_in.put(raw_length + raw_mex)
-                
         except socket.timeout as e:
             self.logger.warning("%s", e)
             self.shutdown(reason="Socket time-outed while waiting for messages; disconnecting")
@@ -240,43 +350,60 @@ class PeerManager:
             
     def shutdown(self, reason:Union[str, None] = None):
         self.logger.warning("Shutdown down for reason: %s", reason)
+        self.release_requests()
+        self.forget_hashing()
+        self.pex.remove(self.address)
         self.send_to_master(utils.M_DISCONNECTED(self.address, reason))
+        # The peer sees the connection closed, and the receiver thread
+        # (if it is not this one) returns from recv
+        if self.socket is not None:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
         sys.exit(0)
 
     
-    def try_unchoke_peer(self):
+    def unchoke_peer(self):
+        """ Starts uploading to the peer (as decided by the master's choker). """
         if not self.am_choking:
-            self.logger.debug("Asked if could unchoke peer, but it is already unchoked")
+            self.logger.debug("Asked to unchoke peer, but it is already unchoked")
             return
 
-        if not self.peer_interested:
-            self.logger.debug("Asked if could unchoke peer, but peer is not interested")
-            return
-
-        # TODO: scrivere una funzione per valutare oggettivamente se ci sono
-        # contrindicazioni nell'unchokare il peer. Per ora assumo si possa
-        # sempre fare.
         self.am_choking = False
         self.send_message(MexType.UNCHOKE)
 
+
+    def choke_peer(self):
+        """ Stops uploading to the peer: its pending REQUESTs are dropped. """
+        if self.am_choking:
+            return
+
+        self.am_choking = True
+        self.send_message(MexType.CHOKE)
+
+        self.upload_queue.clear()
+        for requests in self.deferred_peer_requests.values():
+            requests.clear()
+
             
-    def read_data(self, piece_index, piece_offset=0, piece_length=0) -> bytes:
+    def read_data(self, piece_index, piece_offset=0, piece_length=0) -> memoryview:
         """
-        Reads data at a given offset from the cache. Used when peer
-        asks me for a piece.
-
-        If piece is not in cache, raise an exception (it should never happen! 
-        every time you call read_data, data must be entered in cache!)
+        Reads data at a given offset of a piece, through the piece cache
+        (the whole piece is read from storage, if not there). Used when
+        peer asks me for a piece.
         """
         if piece_length == 0:
             piece_length = self.get_piece_size(piece_index)
 
-        if piece_index not in self.cache_pieces:
-            breakpoint()
-            raise Exception(f"Don't have piece {piece_index} in cache!")
-
-        piece = self.cache_pieces[piece_index]
-        return piece[piece_offset:piece_offset+piece_length]
+        piece = self.piece_cache.get_or_load(
+            (self.metainfo.info_hash, piece_index),
+            lambda: self.storage.read(
+                piece_index * self.metainfo.piece_size,
+                self.get_piece_size(piece_index)
+            )
+        )
+        return memoryview(piece)[piece_offset:piece_offset+piece_length]
 
     
     #######
@@ -288,83 +415,117 @@ class PeerManager:
         """
 
         while True:
-            mex = self.queue_in.get()
+            try:
+                mex = self.queue_in.get(timeout=self.TIMEOUT_CHECK_INTERVAL)
+            except Empty:
+                mex = None
 
-            if isinstance(mex, utils.MasterMex):
-                
-                # catch early a KILL message from MASTER
-                if isinstance(mex, utils.M_KILL):
-                    self.logger.debug("[MASTER] Received KILL")
-                    self.send_to_master(utils.M_DEBUG("Got KILLED", self.address))
-                    return
+            if mex is not None and not self.interpret(mex):
+                return
 
-                # If otherwise is any other MASTER mex, dispatch to this function
-                self.control_message_interpreter(mex)
-                continue
+            if self.pipeline.clock() >= self.next_timeout_check:
+                self.next_timeout_check = self.pipeline.clock() + self.TIMEOUT_CHECK_INTERVAL
+                self.check_timeouts()
+                self.exchange_peers()
+
+            # Answer the REQUESTs: all of them if nothing else arrived
+            # meanwhile, otherwise a few (a peer sending us PIECEs keeps
+            # the queue busy, and its REQUESTs would wait forever)
+            if self.upload_queue:
+                self.serve_uploads(limit=None if self.queue_in.empty() else UPLOAD_BATCH)
 
             
-            # Empty message from peer == peer has disconnected
-            if mex == b"":
-                self.shutdown(reason="Received empty message from peer!")
-                break
-            
-            try:
-                mex_type = MexType(mex[4])
-            except Exception as e:
-                breakpoint()
-                raise e
-
-            self.logger.debug("Received message %s", str(mex_type))
-
-            if mex_type == MexType.HANDSHAKE:
-                self.receive_handshake(mex)
-
-            elif mex_type == MexType.KEEP_ALIVE:
-                self.send_message(MexType.KEEP_ALIVE)
-
-            elif mex_type == MexType.CHOKE:
-                self.peer_chocking = True
-            elif mex_type == MexType.UNCHOKE:
-                self.peer_chocking = False
-                if self.am_interested:
-                    # TODO: ricevuto unchoke, questa istruzione che segue
-                    # richiede UN solo pezzo, invece che max_concurrent_pieces
-                    self.try_ask_for_piece() 
-            elif mex_type == MexType.INTERESTED:
-                self.peer_interested = True
-                self.try_unchoke_peer()
-            elif mex_type == MexType.NOT_INTERESTED:
-                self.peer_interested = False
-                if not self.am_choking:
-                    self.send_message(MexType.CHOKE)
-
-            elif mex_type == MexType.HAVE:
-                self.manage_received_have(utils.to_int(mex[5:9]))
-
-            elif mex_type == MexType.BITFIELD:
-                self.interpret_received_bitfield(mex[5:])
-
-            elif mex_type == MexType.REQUEST:
-                piece_index  = utils.to_int(mex[5:9]) 
-                piece_offset = utils.to_int(mex[9:13]) 
-                piece_length = utils.to_int(mex[13:17]) 
-                self.manage_request(piece_index, piece_offset, piece_length)
-
-            elif mex_type == MexType.PIECE:
-                piece_index  = utils.to_int(mex[5:9]) 
-                piece_offset = utils.to_int(mex[9:13])
-                piece_payload = mex[13:]
-                self.manage_received_piece(piece_index, piece_offset, piece_payload)
-
-            elif mex_type == MexType.CANCEL:
-                self.logger.error("CANCEL not implemented")
-
-            elif mex_type == MexType.PORT:
-                self.logger.error("PORT message not implemented")
+    def interpret(self, mex: Union[bytes, utils.MasterMex]) -> bool:
+        """
+        Reacts to a single message, coming either from the Master or
+        from the peer. 
+
+        Returns False when the connection must not process any other
+        message (eg. after a KILL from Master).
+        """
+        if isinstance(mex, utils.MasterMex):
+
+            # catch early a KILL message from MASTER
+            if isinstance(mex, utils.M_KILL):
+                self.logger.debug("[MASTER] Received KILL")
+                self.send_to_master(utils.M_DEBUG("Got KILLED", self.address))
+                return False
+
+            # If otherwise is any other MASTER mex, dispatch to this function
+            self.control_message_interpreter(mex)
+            return True
+
 
+        # Empty message from peer == peer has disconnected
+        if mex == b"":
+            self.shutdown(reason="Received empty message from peer!")
+            return False
+
+        try:
+            mex_type = MexType(mex[4])
+        except ValueError:
+            self.logger.error("Received unknown message type %d", mex[4])
+            return True
+
+        self.logger.debug("Received message %s", str(mex_type))
+
+        if mex_type == MexType.HANDSHAKE:
+            self.receive_handshake(mex)
+
+        elif mex_type == MexType.KEEP_ALIVE:
+            self.send_message(MexType.KEEP_ALIVE)
+
+        elif mex_type == MexType.CHOKE:
+            self.peer_chocking = True
+            # A choking peer discards all our pending requests
+            self.release_requests()
+        elif mex_type == MexType.UNCHOKE:
+            self.peer_chocking = False
+            self.peer_unchoked_at = self.pipeline.clock()
+            if self.am_interested:
+                self.try_ask_for_piece()
+        elif mex_type == MexType.INTERESTED:
+            self.peer_interested = True
+            # Whether to unchoke it is up to the master's choker
+            self.send_to_master(utils.M_PEER_INTERESTED(self.address, True))
+        elif mex_type == MexType.NOT_INTERESTED:
+            self.peer_interested = False
+            self.send_to_master(utils.M_PEER_INTERESTED(self.address, False))
+
+        elif mex_type == MexType.HAVE:
+            self.manage_received_have(utils.to_int(mex[5:9]))
+
+        elif mex_type == MexType.BITFIELD:
+            self.interpret_received_bitfield(mex[5:])
+
+        elif mex_type == MexType.REQUEST:
+            piece_index  = utils.to_int(mex[5:9]) 
+            piece_offset = utils.to_int(mex[9:13]) 
+            piece_length = utils.to_int(mex[13:17]) 
+            self.manage_request(piece_index, piece_offset, piece_length)
+
+        elif mex_type == MexType.PIECE:
+            piece_index  = utils.to_int(mex[5:9]) 
+            piece_offset = utils.to_int(mex[9:13])
+            piece_payload = memoryview(mex)[13:]
+            self.manage_received_piece(piece_index, piece_offset, piece_payload)
+
+        elif mex_type == MexType.CANCEL:
+            piece_index  = utils.to_int(mex[5:9]) 
+            piece_offset = utils.to_int(mex[9:13]) 
+            piece_length = utils.to_int(mex[13:17]) 
+            self.manage_cancel(piece_index, piece_offset, piece_length)
+
+        elif mex_type == MexType.PORT:
+            self.logger.error("PORT message not implemented")
+
+        elif mex_type == MexType.EXTENDED:
+            if len(mex) < 6:
+                self.logger.warning("EXTENDED message without extended id, dropped")
             else:
-                self.logger.error("Received unknown message")
-                breakpoint()
+                self.manage_extended(mex[5], mex[6:])
+
+        return True
 
             
     def control_message_interpreter(self, mex: utils.MasterMex):
@@ -384,7 +545,14 @@ class PeerManager:
             
         if isinstance(mex, utils.M_SCHEDULE):
             self.logger.debug("[MASTER] Received SCHEDULE message from master: %s", mex.pieces_index)
-            self.scheduled += mex.pieces_index
+            # (pieces already scheduled are just a reminder to go on with them)
+            new_pieces = [p for p in mex.pieces_index if p not in self.scheduled]
+            if mex.urgent:
+                # Streaming: these come before anything else
+                self.scheduled[:0] = new_pieces
+                self.start_urgent_pieces(mex.pieces_index)
+            else:
+                self.scheduled += new_pieces
             # Avoids deadlock:
             # if no pieces are currently downloaded, try_ask_for_piece will
             # start downloading the received piece(s);
@@ -400,17 +568,25 @@ class PeerManager:
             self.logger.debug("[MASTER] Received NEW_HAVE message from master: %s", mex.piece_index)
             self.my_bitmap[mex.piece_index] = True
             self.send_message(MexType.HAVE, piece_index=mex.piece_index)
+
+            # Endgame: another peer completed a piece we were downloading too
+            if mex.piece_index in self.scheduled:
+                self.logger.debug("Abandoning piece %d, completed elsewhere", mex.piece_index)
+                self.abandon_piece(mex.piece_index)
+                if mex.piece_index in self.am_interested_in:
+                    self.am_interested_in.remove(mex.piece_index)
+                self.try_ask_for_piece()
             return        
 
         # M_Piece has a bit complicated workflow.
         # If we receive a M_PIECE, it means that in the past we requested to the
         # master, on behalf of the peer, a piece N.
-        # We put the entire piece N in a cache.
+        # We put the entire piece N in the (shared) cache.
         # Then we resume the deferred request, 
         if isinstance(mex, utils.M_PIECE):
             self.logger.debug("Received piece %d from master", mex.piece_index)
             
-            self.cache_pieces[mex.piece_index] = mex.data
+            self.piece_cache.put((self.metainfo.info_hash, mex.piece_index), mex.data)
 
             if mex.piece_index not in self.deferred_peer_requests:
                 # Should not happen
@@ -420,19 +596,30 @@ class PeerManager:
                 )
                 return
 
-            # Resume request worfflow
-            return self.manage_request(
-                mex.piece_index,
-                *self.deferred_peer_requests[mex.piece_index],
-                deferred=True #important!
-            )        
+            # Resume request worfflow, for every block asked meanwhile
+            for (offset, length) in self.deferred_peer_requests.pop(mex.piece_index):
+                self.upload_block(mex.piece_index, offset, length, data=mex.data)
+            return
 
         if isinstance(mex, utils.M_COMPLETED):
             self.logger.info("Received COMPLETED message from Master")
             return
 
-        breakpoint()
-        raise Exception("unknown message")
+        if isinstance(mex, utils.M_UNCHOKE):
+            self.logger.debug("[MASTER] Received UNCHOKE message from master")
+            self.unchoke_peer()
+            return
+
+        if isinstance(mex, utils.M_CHOKE):
+            self.logger.debug("[MASTER] Received CHOKE message from master")
+            self.choke_peer()
+            return
+
+        if isinstance(mex, utils.M_HASHED):
+            self.manage_hashed_piece(mex.piece_index, mex.ok)
+            return
+
+        self.logger.error("Received unknown message from master: %s", mex)
         
         
     def send_message(self, mexType: MexType, **kwargs):
@@ -452,6 +639,45 @@ class PeerManager:
             self.logger.warning("Shutting down after peer abroupt disconnection")
             self.shutdown()
         
+    def send_block(self, piece_index: int, piece_offset: int, length: int):
+        """
+        Sends a PIECE message reading the block straight from the storage.
+        If the data lives in a file, the payload is copied by the kernel
+        from the file to the socket (sendfile), never passing through Python.
+        """
+        offset = piece_index * self.metainfo.piece_size + piece_offset
+        header = self.make_piece_header(piece_index, piece_offset, length)
+
+        try:
+            with self.storage.open_file() as f:
+                if f is None or not self.options.get("sendfile", True):
+                    self.socket.sendall(header + self.read_data(piece_index, piece_offset, length))
+                    return
+
+                # MSG_MORE: the header waits for the payload, in the kernel
+                self.socket.sendall(header, getattr(socket, "MSG_MORE", 0))
+                sent = utils.sendfile_nowait(
+                    self.socket.fileno(), f.fileno(), offset, length
+                )
+                if sent < length:
+                    # Socket buffer full: socket.sendfile waits for it
+                    # (and falls back to send() if there is no sendfile)
+                    self.socket.sendfile(f, offset + sent, length - sent)
+
+        except IOError as e:
+            self.logger.warning("%s", e)
+            self.logger.warning("Shutting down after peer abroupt disconnection")
+            self.shutdown()
+
+
+    def make_piece_header(self, piece_index: int, piece_offset: int, length: int) -> bytes:
+        """ The PIECE message, without the payload. """
+        return (utils.to_bytes(9 + length, length=4) + 
+                utils.to_bytes(MexType.PIECE.value) +
+                utils.to_bytes(piece_index, length=4) +
+                utils.to_bytes(piece_offset, length=4))
+
+
     def make_message(self, mexType: MexType, **kwargs) -> bytes:
         """
         Builds a peer message of a given type (without sending it!)
@@ -464,7 +690,7 @@ class PeerManager:
         elif mexType == MexType.HANDSHAKE:
             mex = (utils.to_bytes(19) +
                     b"BitTorrent protocol" +
-                    bytes(8) +
+                    RESERVED +
                     self.metainfo.info_hash +
                     utils.generate_peer_id(seed=self.peer_port))
         
@@ -478,32 +704,39 @@ class PeerManager:
                     utils.to_bytes(kwargs["piece_index"], length=4))
         
         elif mexType == MexType.BITFIELD:
-            bitmap = utils.bool_to_bitmap(self.my_bitmap)
+            bitmap = self.my_bitmap.view()
 
-            mex = (utils.to_bytes(1 + len(bitmap), length=4) + 
-                    utils.to_bytes(mexType.value) +
-                    bitmap)
+            mex = b"".join((utils.to_bytes(1 + len(bitmap), length=4),
+                            utils.to_bytes(mexType.value),
+                            bitmap))
 
-        elif mexType == MexType.REQUEST:
+        elif mexType in (MexType.REQUEST, MexType.CANCEL):
             mex = (utils.to_bytes(13, length=4) + 
                     utils.to_bytes(mexType.value) +
                     utils.to_bytes(kwargs["piece_index"], length=4) +
                     utils.to_bytes(kwargs["piece_offset"], length=4) +
                     utils.to_bytes(kwargs["piece_length"], length=4))
 
-        elif mexType == MexType.PIECE:
-            payload = self.read_data(
-                kwargs["piece_index"],
-                kwargs["piece_offset"],
-                kwargs["piece_length"]
-            )
-            
-            mex = (utils.to_bytes(9 + len(payload), length=4) + 
+        elif mexType == MexType.EXTENDED:
+            payload = bencodepy.encode(kwargs["payload"])
+            mex = (utils.to_bytes(2 + len(payload), length=4) +
                     utils.to_bytes(mexType.value) +
-                    utils.to_bytes(kwargs["piece_index"], length=4) +
-                    utils.to_bytes(kwargs["piece_offset"], length=4) +
+                    utils.to_bytes(kwargs["extended_id"]) +
                     payload)
 
+        elif mexType == MexType.PIECE:
+            payload = kwargs.get("payload")
+            if payload is None:
+                payload = self.read_data(
+                    kwargs["piece_index"],
+                    kwargs["piece_offset"],
+                    kwargs["piece_length"]
+                )
+            
+            mex = self.make_piece_header(
+                kwargs["piece_index"], kwargs["piece_offset"], len(payload)
+            ) + payload
+
         if mex is None:
             raise Exception("Messaggio impossibile da costruire")
 
@@ -516,10 +749,12 @@ class PeerManager:
         """
 
         # Sets peer_bitmap according to the mex received
-        self.peer_bitmap = utils.bitmap_to_bool(
-            mex_payload,
-            num_pieces=self.metainfo.num_pieces
-        )
+        try:
+            self.peer_bitmap = bitfield.Bitfield(self.metainfo.num_pieces, mex_payload)
+        except ValueError as e:
+            self.logger.warning("Invalid BITFIELD: %s", e)
+            self.shutdown("invalid BITFIELD")
+            return
 
         if len(self.my_bitmap) < 120:
             utils.pprint_bitmap(self.my_bitmap, "self")
@@ -529,9 +764,7 @@ class PeerManager:
         assert len(self.my_bitmap) == len(self.peer_bitmap)
 
         # Identify (if any) pieces that my peer has but I have not.
-        for i, (m,p) in enumerate(zip(self.my_bitmap, self.peer_bitmap)):
-            if not m and p:
-                self.am_interested_in.append(i)
+        self.am_interested_in.extend((self.peer_bitmap - self.my_bitmap).indices())
 
         # Informs master of peer's bitmap
         self.logger.debug(
@@ -540,9 +773,10 @@ class PeerManager:
         )
         self.send_to_master(
             utils.M_PEER_HAS(
-                self.am_interested_in,
+                list(self.am_interested_in), # a copy: we keep changing ours
                 self.address,
                 self.max_concurrent_pieces+1, #TODO: migliorabile!
+                downloaded=self.take_downloaded()
             )
         )
         
@@ -595,30 +829,53 @@ class PeerManager:
 
     def ask_for_single_piece(self, piece_idx: int):
         """
-        Low-level routine that sends the request for a piece to the peer.
+        Low-level routine that starts the download of a new piece (or
+        joins other connections already downloading it), requesting
+        its free blocks.
         """
         self.logger.debug("Asking for new piece, number %d", piece_idx)
-            
+
+        # self.get_piece_size serve per gestire len irregolare dell'ultimo piece
+        if not self.piece_table.start(piece_idx, self.get_piece_size(piece_idx)):
+            self.logger.debug("Piece %d was just completed by another connection", piece_idx)
+            return
+        
+        self.my_progresses.add(piece_idx)
+        self.request_missing_blocks(piece_idx)
+
+
+    def request_block(self, piece_idx: int, offset: int):
+        """
+        Sends a REQUEST for the block at `offset`, and remembers it
+        among the outstanding ones.
+        """
         piece_length = min(
             self.metainfo.block_size,
-            self.get_piece_size(piece_idx)
+            self.get_piece_size(piece_idx) - offset
+        )
+
+        self.send_message(
+            MexType.REQUEST,
+            piece_index=piece_idx,
+            piece_offset=offset,
+            piece_length=piece_length
+        )
+        self.pipeline.sent(piece_idx, offset)
+
+
+    @property
+    def max_concurrent_pieces(self) -> int:
+        """
+        How many pieces can be downloaded at the same time. At least
+        --max-concurrent-pieces, but more if they're not enough to keep
+        the request pipeline full (eg. with very small pieces).
+        """
+        blocks_per_piece = math.ceil(self.metainfo.piece_size / self.metainfo.block_size)
+        return max(
+            self.options.get("max_concurrent_pieces", 5),
+            math.ceil(self.pipeline.depth / blocks_per_piece)
         )
-        
-        try:    
-            self.send_message(
-                MexType.REQUEST,
-                piece_index=piece_idx,
-                piece_offset=0,
-                piece_length=piece_length
-            )
-        except Exception as e:
-            breakpoint()
-            raise e
-        
-        # self.get_piece_size serve per gestire len irregolare dell'ultimo piece
-        self.my_progresses[piece_idx] = (b"", self.get_piece_size(piece_idx))
 
-        
         
     def ask_for_new_pieces(self):
         """ 
@@ -646,34 +903,13 @@ class PeerManager:
             self.logger.debug("Wanted to ask a new piece, but am choked")    
             return
 
-        not_yet_started = set(self.am_interested_in) - set(self.my_progresses.keys())
-        not_yet_started = not_yet_started & set(self.scheduled)
-        
-        # Se tutti i pieces sono già stati avviati o completati
-        if len(not_yet_started) == 0:
-            self.logger.debug("No NEW pieces are requestable; abort")
-            return
-
-        # Se sto già scaricando il numero max di pieces contemporaneamente
-        if len(self.my_progresses) > self.max_concurrent_pieces:
-            self.logger.debug("Already downloading at the fullest")
-            return
-
-        
-        random_piece = random.sample(
-            list(not_yet_started), #non si può fare random choice su set()
-            k=min(self.max_concurrent_pieces - len(self.my_progresses),
-                  len(not_yet_started))
-        )
-
-        for piece in random_piece:
-            self.ask_for_single_piece(piece)
+        self.fill_pipeline()
 
     
     def try_ask_for_piece(self, suggestion=None):
         """ 
-        Requests for an already-started-but-not-completely-downloaded
-        piece.
+        Requests blocks for already-started-but-not-completely-downloaded
+        pieces, until the pipeline is full.
 
         If no half-downloaded piece exists, then asks for a completely
         new piece (reverts to ask_for_new_pieces).
@@ -686,37 +922,149 @@ class PeerManager:
             self.ask_for_new_pieces()
             return
             
-        if len(self.my_progresses) > self.max_concurrent_pieces:
-            self.logger.debug("Already topping max concurrent requests")
-            return
-
         if not self.am_interested:
-            self.logger.warning("Want to ask piece %d, but am not interested; sending INTERESTED")
+            self.logger.warning("Want to ask piece, but am not interested; sending INTERESTED")
             self.am_interested = True
             self.send_message(MexType.INTERESTED)
             if self.peer_chocking:
                 return
+
+        self.fill_pipeline(suggestion)
+
+
+    def fill_pipeline(self, suggestion=None):
+        """
+        Sends REQUESTs until the pipeline depth is reached: first for the
+        pieces already in progress (`suggestion` first), then starting
+        new scheduled pieces.
+        """
+        # In the order they were scheduled (urgent pieces first)
+        in_progress = [p for p in self.scheduled if p in self.my_progresses]
+        if suggestion in self.my_progresses:
+            in_progress.remove(suggestion)
+            in_progress.insert(0, suggestion)
+
+        for piece_idx in in_progress:
+            self.request_missing_blocks(piece_idx)
+            if self.pipeline.free_slots() == 0:
+                return
+
+        interested_in = set(self.am_interested_in)
+        not_yet_started = [p for p in self.scheduled
+                           if p in interested_in and p not in self.my_progresses]
+
+        for piece_idx in not_yet_started:
+            if self.pipeline.free_slots() == 0:
+                return
             
-        if suggestion is not None:
-            piece_idx = suggestion
-        else:
-            piece_idx = random.choice(list(self.my_progresses.keys()))
+            # Se sto già scaricando il numero max di pieces contemporaneamente
+            if len(self.my_progresses) >= self.max_concurrent_pieces:
+                self.logger.debug("Already downloading at the fullest")
+                return
+
+            self.ask_for_single_piece(piece_idx)
+
+
+    def start_urgent_pieces(self, pieces: List[int]):
+        """
+        Starts the given pieces right away, even beyond max_concurrent_pieces.
+        """
+        if self.peer_chocking or not self.am_interested:
+            return
+
+        for piece_idx in pieces:
+            if piece_idx not in self.my_progresses and not self.my_bitmap[piece_idx]:
+                self.ask_for_single_piece(piece_idx)
 
-        (data_already_downloaded, total_len) = self.my_progresses[piece_idx]
-        offset_start = len(data_already_downloaded)
-        self.logger.debug("Will continue with piece %d from offset %d", piece_idx, offset_start)
         
-        self.send_message(
-            MexType.REQUEST, 
-            piece_index=piece_idx,
-            piece_offset=offset_start,
-            piece_length=min(self.metainfo.block_size, total_len - offset_start)
-        )
+    def request_missing_blocks(self, piece_idx: int):
+        """
+        Requests the blocks of a piece in progress that are neither
+        received nor requested by any connection, as long as the 
+        pipeline has free slots.
+        """
+        # Dropped meanwhile (eg. its hash did not match): start it over
+        if not self.piece_table.start(piece_idx, self.get_piece_size(piece_idx)):
+            return
         
+        offsets = self.piece_table.claim(piece_idx, self.pipeline.free_slots(), mine=self.pipeline)
+
+        for offset in offsets:
+            self.logger.debug("Will continue with piece %d from offset %d", piece_idx, offset)
+            self.request_block(piece_idx, offset)
+
 
+    def take_downloaded(self) -> int:
+        """ Bytes received since the last call (reported to the master). """
+        downloaded, self.downloaded = self.downloaded, 0
+        return downloaded
+
+
+    def release_requests(self, piece_idx: Optional[int] = None) -> List[pipeline.Block]:
+        """
+        Forgets the outstanding requests for a piece (or all of them), so
+        that other connections can claim their blocks. Returns them.
+        """
+        blocks = self.pipeline.discard(piece_idx)
+        self.piece_table.release(blocks)
+        return blocks
+        
+
+    def abandon_piece(self, piece_idx: int):
+        """
+        Stops downloading a piece (eg. completed by someone else in
+        endgame, or timed out), CANCELing the blocks still requested.
+        The blocks received so far stay in the piece table.
+        """
+        for (_, offset) in self.release_requests(piece_idx):
+            self.send_message(
+                MexType.CANCEL,
+                piece_index=piece_idx,
+                piece_offset=offset,
+                piece_length=min(self.metainfo.block_size, self.get_piece_size(piece_idx) - offset)
+            )
+
+        self.my_progresses.discard(piece_idx)
+        if piece_idx in self.scheduled:
+            self.scheduled.remove(piece_idx)
+
+
+    def check_timeouts(self):
+        """
+        Gives up the pieces with REQUESTs unanswered for request_timeout
+        seconds (all the scheduled ones, if the peer is snubbing us), so
+        that other connections can request their blocks. The connection
+        stays open: the master is told, and schedules the pieces to
+        other peers (and few of them, if any, to this one).
+        """
+        expired = self.pipeline.expired(self.request_timeout)
+        if not expired:
+            return
+
+        now = self.pipeline.clock()
+        silent_since = max(self.pipeline.last_received, self.peer_unchoked_at)
+        self.snubbed = now - silent_since >= self.snub_timeout
+
+        pieces = {p for (p, _) in expired}
+        if self.snubbed:
+            pieces |= set(self.scheduled)
+
+        self.logger.warning(
+            "REQUESTs timed out%s: giving up pieces %s",
+            " (peer is snubbing us)" if self.snubbed else "", sorted(pieces)
+        )
+        for piece_idx in pieces:
+            self.abandon_piece(piece_idx)
+
+        self.send_to_master(utils.M_TIMED_OUT(sorted(pieces), self.address, snubbed=self.snubbed))
+        self.try_ask_for_piece()
+
+        
     def manage_received_have(self, piece_index: int):
         self.logger.debug("Acknowledging that peer has new piece %d", piece_index)
         self.peer_bitmap[piece_index] = True
+        if not self.my_bitmap[piece_index] and piece_index not in self.am_interested_in:
+            self.am_interested_in.append(piece_index)
         self.logger.debug(
             "[MASTER] Sending M_PEER_HAS %d to master, ask schedule %d pieces",
             piece_index, 1
@@ -726,12 +1074,20 @@ class PeerManager:
             utils.M_PEER_HAS(
                 [piece_index],
                 self.address,
-                schedule_new_pieces=1
+                schedule_new_pieces=1,
+                downloaded=self.take_downloaded()
             )
         )
 
         
     def manage_received_piece(self, piece_index, piece_offset, piece_payload):
+        if not self.pipeline.received(piece_index, piece_offset, len(piece_payload)):
+            self.logger.warning(
+                "Received fragment of piece %d offset %d, but never requested it (len: %d)",
+                piece_index, piece_offset, len(piece_payload)
+            )
+            return
+
         if self.my_bitmap[piece_index]:
             self.logger.warning(
                 "Received fragment of piece %d offset %d, but I have piece it already (len: %d)",
@@ -740,116 +1096,326 @@ class PeerManager:
             return
 
         
-        # Aggiorna my_progersses
-        old_data, piece_size = self.my_progresses[piece_index]
-
-        if piece_offset < len(old_data):
-            self.logger.warning("Duplicate block, received offset %d but expecting %d",
-                                piece_offset, len(old_data))
-            return
-                                
+        # Aggiorna la piece table: il blocco viene copiato al suo posto,
+        # in qualunque ordine arrivi (e da qualunque peer)
         self.logger.debug("Received payload for piece %d offset %d length %d: %s...%s",
                           piece_index, piece_offset, len(piece_payload),
-                          piece_payload[:4], piece_payload[-4:])
-                                
-        new_data = old_data + piece_payload
-        
-        if len(new_data) >= piece_size:
-            if len(new_data) > piece_size:
-                self.logger.error(
-                    "Received more data then the expected size: %d, while expected %d",
-                    len(new_data), piece_size
-                )
-                
-            self.logger.info("Completed download of piece %d", piece_index)
-            
-            if not self.verify_hash(piece_index, new_data):
-                self.logger.critical("Hashes for %d don't match", piece_index)
-                raise Exception("Hashes not matching") #TODO
-
-            self.logger.info("Downloaded: {:.1f}%".format(
-                100 * (1 + sum(int(x) for x in self.my_bitmap)) / len(self.my_bitmap)
-            ))
-                  
-            del self.my_progresses[piece_index]
-
-            self.logger.debug("Sending HAVE for piece %d to peer", piece_index)
-            self.send_message(MexType.HAVE, piece_index=piece_index)
-            
-            self.logger.debug("Setting my bitfield for piece %d as PRESENT", piece_index)
-            self.update_my_bitmap(piece_index, True)
-            self.am_interested_in.remove(piece_index)
+                          bytes(piece_payload[:4]), bytes(piece_payload[-4:]))
 
-            # M_PIECE richiede anche un nuovo pezzo al Master
-            self.scheduled.remove(piece_index)
-            self.logger.debug("[MASTER] Sending M_PIECE for %d", piece_index)
-            self.send_to_master(utils.M_PIECE(piece_index, new_data, self.address))
+        if not self.piece_table.write(piece_index, piece_offset, piece_payload):
+            self.logger.warning(
+                "Discarding block of piece %d offset %d (len: %d): duplicate, out of bounds or completed",
+                piece_index, piece_offset, len(piece_payload)
+            )
+            self.try_ask_for_piece(suggestion=piece_index)
+            return
 
-            # Finito un pezzo, iniziane uno NUOVO
-            self.ask_for_new_pieces()
+        self.downloaded += len(piece_payload)
+        self.snubbed = False
+
+        # Only the connection that wrote the last block gets the piece
+        piece = self.piece_table.complete(piece_index)
+        if piece is None:
+            # Meanwhile, the blocks arrived in order can be hashed
+            buffer = self.piece_table.get(piece_index)
+            if buffer is not None:
+                self.hasher.update(buffer)
+            self.try_ask_for_piece(suggestion=piece_index)
             return
-                              
-        self.my_progresses[piece_index] = (new_data, piece_size)
-        self.try_ask_for_piece(suggestion=piece_index)
+
+        self.logger.info("Completed download of piece %d", piece_index)
+
+        # Nothing else to request for it: the piece waits for its hash
+        # (see manage_hashed_piece), while we go on with the others
+        self.my_progresses.discard(piece_index)
+        self.am_interested_in.remove(piece_index)
+        self.scheduled.remove(piece_index)
+        self.hashing[piece_index] = piece
+
+        self.hasher.verify(
+            piece, self.metainfo.pieces_hash[piece_index],
+            lambda piece, ok: self.queue_in.put(utils.M_HASHED(piece.index, ok))
+        )
+        self.ask_for_new_pieces()
+
+
+    def manage_hashed_piece(self, piece_index: int, ok: bool):
+        """
+        The Hasher verified a piece we completed: if its hash matches, it
+        is written out and announced; otherwise it is discarded, and the
+        master schedules it again (to some other peer, if possible).
+        """
+        piece = self.hashing.pop(piece_index, None)
+        if piece is None:
+            return
+
+        if not ok:
+            self.logger.warning("Hashes for piece %d DO NOT MATCH! Discarding it", piece_index)
+            self.piece_table.drop(piece_index)
+            if self.peer_bitmap[piece_index] and piece_index not in self.am_interested_in:
+                self.am_interested_in.append(piece_index)
+            self.send_to_master(utils.M_HASH_FAILED(piece_index, self.address))
+            return
+
+        self.logger.debug("Calculated hash for piece %d matches with metainfo", piece_index)
+        self.logger.info("Downloaded: {:.1f}%".format(
+            100 * (1 + self.my_bitmap.count()) / len(self.my_bitmap)
+        ))
+
+        self.logger.debug("Sending HAVE for piece %d to peer", piece_index)
+        self.send_message(MexType.HAVE, piece_index=piece_index)
+
+        # The master writes it (disk I/O stays off the peer's thread, or
+        # the event loop). M_PIECE richiede anche nuovi pezzi al Master,
+        # abbastanza da tenere la pipeline piena
+        self.logger.debug("[MASTER] Sending M_PIECE for %d", piece_index)
+        self.send_to_master(utils.M_PIECE(
+            piece_index, piece.data, self.address,
+            schedule_new_pieces=max(1, self.max_concurrent_pieces + 1 - len(self.scheduled)),
+            downloaded=self.take_downloaded()
+        ))
+
+        # Must come after M_PIECE: if both us and the peer are now
+        # complete, this shuts down the connection
+        self.logger.debug("Setting my bitfield for piece %d as PRESENT", piece_index)
+        self.update_my_bitmap(piece_index, True)
+
+        # Finito un pezzo, iniziane uno NUOVO
+        self.ask_for_new_pieces()
+
+
+    def forget_hashing(self):
+        """
+        The connection is closing: the pieces waiting for their hash
+        will never be written, they must be downloaded again.
+        """
+        for piece_index in self.hashing:
+            self.piece_table.drop(piece_index)
+        self.hashing.clear()
 
 
         
-    def manage_request(self, p_index, p_offset, p_length, deferred=False):
-        """ Responds to a REQUEST message from the peer. """
+    def manage_request(self, p_index, p_offset, p_length):
+        """ 
+        Responds to a REQUEST message from the peer: if valid, the block
+        is queued, and sent by serve_uploads.
+        """
         if self.am_choking:
             self.logger.warning("Received REQUEST but am choking.")
             return
 
-        log_str = "Resuming deferred " if deferred else "Received "
-        self.logger.debug(log_str + "REQUEST for piece %d offset %d length %d",
+        self.logger.debug("Received REQUEST for piece %d offset %d length %d",
                           p_index, p_offset, p_length)
 
         if not self.peer_interested:
             self.logger.warning("Was asked for piece %d, but to me peer is not interested", p_index)
-            breakpoint()
             return
-        
-        if self.peer_chocking:
-            self.logger.debug("Was asked for piece %d, but peer is chocking me", p_index)
-            # breakpoint()
-            # return
 
         if not self.my_bitmap[p_index]:
             self.logger.warning("Was asked for piece %d, but I don't have it", p_index)
-            breakpoint()
             return
 
-        # 1. Controlla se il pezzo è in cache_pieces
-        # 2. Se sì, fai come al solito ma leggendo dalla cache_pieces
-        # 3. Se no, chiedi pezzo al master; archivia il messaggio di REQUEST
-        # in self.deferred_requests, quindi quando dal master arriva un messaggio
-        # M_PIECE, finalmente rispondi al Peer
+        if p_length > MAX_REQUEST_LENGTH or p_offset + p_length > self.get_piece_size(p_index):
+            self.logger.warning("Invalid REQUEST for piece %d offset %d length %d",
+                                p_index, p_offset, p_length)
+            return
 
-        if not p_index in self.cache_pieces:
-            self.debug("[MASTER] Deferred response to REQUEST piece %d", p_index)
-            self.send_to_master(
-                utils.M_PEER_REQUEST(p_index, self.address)
-            )
-            self.deferred_peer_requests[p_index] = (p_offset, p_length)
+        if len(self.upload_queue) >= MAX_QUEUED_REQUESTS:
+            self.logger.warning("Too many REQUESTs queued, dropping piece %d offset %d",
+                                p_index, p_offset)
             return
 
-        if deferred:
-            offs, length = self.deferred_peer_requests[p_index]
-            if offs != p_offset or length != p_length:
-                self.logger.error("Resuming deferred piece %d, but couldn't find deferred request!",
-                                  p_index)
-                breakpoint()
-                raise Exception("Deferentiationalitation error")
+        self.upload_queue[(p_index, p_offset, p_length)] = None
 
-            del self.deferred_peer_requests[p_index]
-            
+
+    def manage_cancel(self, p_index, p_offset, p_length):
+        """
+        Responds to a CANCEL message: the block is not sent, if still
+        queued (or waiting for the piece from the master).
+        """
+        self.logger.debug("Received CANCEL for piece %d offset %d length %d",
+                          p_index, p_offset, p_length)
+
+        self.upload_queue.pop((p_index, p_offset, p_length), None)
+
+        deferred = self.deferred_peer_requests.get(p_index, [])
+        if (p_offset, p_length) in deferred:
+            deferred.remove((p_offset, p_length))
+
+
+    def manage_extended(self, extended_id: int, payload: bytes):
+        """
+        Responds to an EXTENDED message (BEP 10): either the extended
+        handshake, or one of the messages we announced in ours.
+        """
+        try:
+            mex = bencodepy.decode(payload)
+        except bencodepy.BencodeDecodeError as e:
+            self.logger.warning("Invalid EXTENDED message %d: %s", extended_id, e)
+            return
+
+        if not isinstance(mex, dict):
+            self.logger.warning("Invalid EXTENDED message %d: not a dictionary", extended_id)
+            return
+
+        if extended_id == EXTENDED_HANDSHAKE:
+            self.receive_extended_handshake(mex)
+        elif extended_id == pex_mod.UT_PEX_ID and self.pex_interval > 0:
+            self.manage_pex(mex)
+        else:
+            self.logger.debug("Received unknown EXTENDED message %d", extended_id)
+
+
+    def receive_extended_handshake(self, mex: Dict[bytes, Any]):
+        extensions = mex.get(b"m", dict())
+        if isinstance(extensions, dict):
+            # (id 0 means that the peer does not support it anymore)
+            self.peer_extensions = {
+                name: extended_id for name, extended_id in extensions.items()
+                if isinstance(extended_id, int) and 0 < extended_id < 256
+            }
+        self.logger.debug("Peer supports extensions: %s", list(self.peer_extensions))
+
+        port = mex.get(b"p")
+        if self.peer_listening is None and isinstance(port, int) and 0 < port < 65536:
+            self.peer_listening = (self.peer_ip, port)
+            self.pex.add(self.address, self.peer_listening)
+
+        if b"ut_pex" not in self.peer_extensions or self.pex_interval <= 0:
+            self.next_pex = None
+        elif self.next_pex is None:
+            # The first one at once, with all the peers we are connected to
+            self.next_pex = self.pipeline.clock()
+
+
+    def manage_pex(self, mex: Dict[bytes, Any]):
+        """
+        Responds to a ut_pex message (BEP 11): the peers it connected
+        to are given to the ThreadedServer, the ones it never heard of.
+
+        A peer must not make us contact arbitrary hosts: a message with
+        more than MAX_PEX_PEERS peers closes the connection, and messages
+        sent more often than we send ours (well, twice as often) are
+        ignored.
+        """
+        added = pex_mod.decode_peers(mex.get(b"added", b""))
+        if len(added) > pex_mod.MAX_PEX_PEERS:
+            self.shutdown(reason="PEX message with {} peers".format(len(added)))
+            return
+
+        now = self.pipeline.clock()
+        if (self.last_pex_received is not None and
+            now - self.last_pex_received < self.pex_interval / 2):
+            self.logger.warning("PEX messages too frequent, ignored")
+            return
+        self.last_pex_received = now
+
+        new_peers = self.pex.learned(added)
+        if new_peers:
+            self.logger.info("Received %d new peers from PEX", len(new_peers))
+
+
+    def exchange_peers(self):
+        """
+        Every pex_interval seconds, tells the peer (if it wants to know)
+        the peers we connected to since the last time, and the ones we
+        are not connected to anymore.
+        """
+        if self.next_pex is None or self.pipeline.clock() < self.next_pex:
+            return
+        self.next_pex = self.pipeline.clock() + self.pex_interval
+
+        connected = self.pex.peers(but=self.address)
+        added = {
+            address: flags for address, flags in connected.items()
+            if address not in self.pex_sent
+        }
+        dropped = [address for address in self.pex_sent if address not in connected]
+
+        # Whatever does not fit goes in the next ones
+        added = dict(list(added.items())[:pex_mod.MAX_PEX_PEERS])
+        dropped = dropped[:pex_mod.MAX_PEX_PEERS]
+        if not added and not dropped:
+            return
+
+        self.pex_sent.update(added)
+        for address in dropped:
+            del self.pex_sent[address]
+
+        self.logger.debug("Sending PEX: %d added, %d dropped", len(added), len(dropped))
         self.send_message(
-            MexType.PIECE,
-            piece_index=p_index,
-            piece_offset=p_offset,
-            piece_length=p_length
+            MexType.EXTENDED, extended_id=self.peer_extensions[b"ut_pex"],
+            payload=pex_mod.pex_message(added, dropped)
         )
 
+
+    def serve_uploads(self, limit: Optional[int] = None):
+        """
+        Sends the blocks of the queued REQUESTs (`limit` of them, at
+        most), as long as the connection can take them (see can_upload).
+        """
+        while self.upload_queue and not self.am_choking and limit != 0:
+            (p_index, p_offset, p_length) = next(iter(self.upload_queue))
+            if not self.can_upload(p_index):
+                break
+            del self.upload_queue[(p_index, p_offset, p_length)]
+            self.upload_block(p_index, p_offset, p_length)
+            if limit is not None:
+                limit -= 1
+
+
+    def can_upload(self, piece_index: int) -> bool:
+        """
+        Whether a block of this piece can be sent now. Always, here:
+        sendall blocks until the socket takes the previous ones, and
+        reading from storage blocks only this connection.
+        """
+        return True
+
+
+    def upload_block(self, p_index, p_offset, p_length, data: bytes = None):
+        """
+        Sends a block to the peer.
+
+        `data` is the whole piece, when already at hand (eg. received from 
+        master to resume a deferred REQUEST).
+        """
+        if self.storage is not None:
+            self.send_block(p_index, p_offset, p_length)
+
+        else:
+            # Senza storage:
+            # 1. Controlla se il pezzo è nella cache
+            # 2. Se sì, fai come al solito ma leggendo dalla cache
+            # 3. Se no, chiedi pezzo al master; archivia il messaggio di REQUEST
+            # in self.deferred_requests, quindi quando dal master arriva un messaggio
+            # M_PIECE, finalmente rispondi al Peer
+            if data is None:
+                data = self.piece_cache.get((self.metainfo.info_hash, p_index))
+
+            if data is None:
+                # Only the first REQUEST for a piece asks the master for it;
+                # the following ones wait along with it
+                if p_index not in self.deferred_peer_requests:
+                    self.logger.debug("[MASTER] Deferred response to REQUEST piece %d", p_index)
+                    self.send_to_master(
+                        utils.M_PEER_REQUEST(p_index, self.address)
+                    )
+                    self.deferred_peer_requests[p_index] = list()
+
+                self.deferred_peer_requests[p_index].append((p_offset, p_length))
+                return
+
+            self.send_message(
+                MexType.PIECE,
+                piece_index=p_index,
+                piece_offset=p_offset,
+                piece_length=p_length,
+                payload=memoryview(data)[p_offset:p_offset+p_length]
+            )
+
+        self.uploaded += p_length
+
         # TODO: rendile una funzione, da chiamare ad ogni invio di piece
         if p_index in self.peer_progresses:
             (old_partial, old_total) = self.peer_progresses[p_index]
@@ -866,32 +1432,17 @@ class PeerManager:
 
 
     def update_my_bitmap(self, piece_index, val: bool):
+        # Only in memory: the master saves it in the resume file
         self.my_bitmap[piece_index] = val
-        with open(utils.get_bitmap_file(self.out_fpath), "w") as f:
-            f.write("".join(["1" if piece else "0" for piece in self.my_bitmap]))
 
-        if all(self.my_bitmap):
+        if self.my_bitmap.complete:
             self.logger.info("Download completed!")
             self.completed = True
             # If peers has too all the pieces, shutdown
-            if all(bool(int(x)) for x in self.peer_bitmap):
+            if self.peer_bitmap.complete:
                 self.shutdown()
 
         
-    def verify_hash(self, piece_index: int, data: bytes):
-        sha = utils.sha1(data)
-
-        are_equal = sha == self.metainfo.pieces_hash[piece_index]
-
-        if are_equal:
-            self.logger.debug("Calculated hash for piece %d matches with metainfo", piece_index)
-        else:
-            self.logger.warning("Hashes for piece %d DO NOT MATCH!", piece_index)
-            breakpoint()
-
-        return are_equal
-
-
 #################################ÀÀ
 
 
@@ -899,8 +1450,10 @@ class PeerManager:
 # Ogni nuova connessione viene assegnata ad un oggetto TorrentPeer,
 # il quale si occuperà di gestire lo scambio di messaggi
 class ThreadedServer:
-    def __init__(self, metainfo, tracker_manager, socket=None, **options):
-        self.host, self.public_ip = "localhost", utils.get_external_ip()
+    def __init__(self, metainfo, tracker_manager, listen_sock=None, engine=None,
+                 piece_cache: "piece_cache_mod.PieceCache" = None,
+                 hasher: "hasher_mod.Hasher" = None, **options):
+        self.host = "localhost"
         self.peer = None
         self.options = options
 
@@ -912,7 +1465,7 @@ class ThreadedServer:
         self.logger.debug("__init__")
 
         
-        if socket is None:
+        if listen_sock is None:
             port = options["port"]
             self.logger.info("Server is binding at %s", (self.host, port))
 
@@ -924,50 +1477,111 @@ class ThreadedServer:
             if port == 0:
                 self.logger.info("Self port: %d", self.port)
         else:
-            self.sock = socket
+            self.sock = listen_sock
             self.port = self.sock.getsockname()[1]
             self.logger.info("Received socket for %s", self.sock.getsockname())
 
             
-        # self.peers = self.options.get("suggested_peers", [])
-        self.peers, self.peers_queue_in = self.tracker_manager.notify_start()        
-
         # La bitmap iniziale, quando il programma viene avviato.
-        # Viene letta da un file salvato in sessioni precedenti, oppure
-        # creata ad hoc.
-        # TODO: serve davvero, qui? Spostare in metainfo?
-        self.initial_bitmap: List[bool] = utils.data_to_bitmap(
-            self.options["output_file"],
-            num_pieces=self.metainfo.num_pieces
-        )
+        # Viene letta dal resume file salvato in sessioni precedenti, oppure
+        # creata ad hoc. From now on the master updates it (and saves it).
+        # If the download file must be rechecked, it starts empty (see main)
+        self.resume = resume_mod.open_resume(self.metainfo, self.options)
+        self.initial_bitmap: bitfield.Bitfield = self.resume.bitmap
+        # Announces compute `left` from it, not from the file
+        self.tracker_manager.resume = self.resume
+
+        # Peers of the previous session: connected to at once, while the
+        # trackers are contacted in background (see main). Trackers will
+        # keep putting new peers in this queue, which is also the one
+        # used by master to talk to us
+        self.peers = self.tracker_manager.cached_peers()
+        self.ts_queue_in = self.tracker_manager.queue_for_new_peers
+
+        # Connected peers tell each other the peers they know (PEX):
+        # those new to us end up in ts_queue_in too
+        self.pex = pex_mod.PeerExchange(self.ts_queue_in, self.port, known=self.peers)
 
         self.timeout = self.options["timeout"]
         # self.sock.settimeout(self.timeout)
 
         self.max_peer_connections = self.options["max_peer_connections"]
         self.active_connections = set()
-        self.is_completed = all(bool(int(x)) for x in self.initial_bitmap)
+        self.is_completed = self.initial_bitmap.complete
+
+        # Shared by the master and all the peer managers
+        self.storage = storage_mod.open_storage(
+            self.options.get("storage", "file"),
+            self.metainfo.download_fpath,
+            self.metainfo.total_size
+        )
+        # Flushed before every save of the resume file (opened earlier:
+        # opening the storage may create the file, and change its stat)
+        self.resume.storage = self.storage
+
+        # Pieces being downloaded, filled in parallel by the peer managers
+        self.piece_table = piece_table_mod.PieceTable(self.metainfo.block_size)
 
-        self.ts_queue_in = Queue()
         self.mcu = master.MasterControlUnit(
             self.metainfo, self.initial_bitmap,
             self.ts_queue_in, self.tracker_manager,
-            self.options
+            self.options, storage=self.storage, resume=self.resume,
+            piece_table=self.piece_table
+        )
+
+        # Pieces read from storage to answer REQUESTs, shared by all the
+        # peers of this torrent (or of the whole session, if given)
+        self.piece_cache = piece_cache if piece_cache is not None else (
+            piece_cache_mod.PieceCache(self.options.get("cache_size", 64) * 2**20)
+        )
+        # Verifies the hashes of the pieces downloaded (of the whole session, if given)
+        self.hasher = hasher if hasher is not None else (
+            hasher_mod.Hasher(self.options.get("hash_workers"))
         )
         self.master_queue = self.mcu.get_master_queue()
 
         self.ttl_peer_table = ttl.TTL_table(self.timeout)
 
+        # With the asyncio engine, every peer connection is a coroutine
+        # on a single event loop (possibly shared by the whole session,
+        # see Fiume.fiume); otherwise, fallback to two threads per peer.
+        self.engine = None
+        if self.options.get("peer_engine", "asyncio") == "asyncio":
+            import Fiume.peer_engine as peer_engine
+            
+            self.engine = engine if engine is not None else peer_engine.PeerEngine(self.options)
+            self.engine.add_torrent(self)
+
+        
+    def recheck(self):
+        """ Hashes the download file, on the pool of the Hasher. """
+        resume_mod.recheck_file(
+            self.metainfo, self.options, hasher=self.hasher,
+            found=lambda pieces: self.master_queue.put(utils.M_RECHECKED(pieces))
+        )
+        self.master_queue.put(utils.M_RECHECKED([], done=True))
+
         
-    def main(self):       
-        socket_listen_t = threading.Thread(target=self.listen)
-        socket_listen_t.daemon = True
-        socket_listen_t.start()
+    def main(self):
+        if self.engine is None:
+            socket_listen_t = threading.Thread(target=self.listen)
+            socket_listen_t.daemon = True
+            socket_listen_t.start()
+        else:
+            self.engine.serve(self.sock)
         
         self.mcu.main()
+
+        # Already listening: the pieces of the previous session are
+        # announced by the master as the recheck finds them
+        if self.resume.needs_recheck:
+            threading.Thread(target=self.recheck, daemon=True).start()
+
+        # Peers from trackers will arrive in ts_queue_in
+        self.tracker_manager.start()
         
         self.logger.debug("Available peers: %s", self.peers)
-        if self.peers == set():
+        if not self.peers:
             self.logger.info("No peers currently available")
 
         # Connects to every peer who allows me to connect
@@ -977,88 +1591,85 @@ class ThreadedServer:
                 self.connect_as_client(ip, port, queues)
             
             
+        # Every event this loop cares about ends up in ts_queue_in:
+        # disconnections, completion and kills (from master), and new
+        # peers (from trackers, and from other peers). The only other thing to wait for is the
+        # expiration of a hibernated peer, which gives the timeout.
         while not self.is_completed:
-            # Peek in the queue, to see if any peer has disconnected
-            # or we have completed
-            while not self.ts_queue_in.empty():
-                mex = self.ts_queue_in.get()
+            try:
+                mex = self.ts_queue_in.get(timeout=self.ttl_peer_table.next_expiry())
+            except Empty:
+                mex = None # some hibernated peer is ready
 
-                if isinstance(mex, utils.M_DISCONNECTED):
-                    self.logger.info("Disconnected peer %s", mex.sender)
-                    self.active_connections.remove(mex.sender)
+            if isinstance(mex, utils.M_DISCONNECTED):
+                self.logger.info("Disconnected peer %s (%s)", mex.sender, mex.reason)
+                self.active_connections.discard(mex.sender)
 
-                    new_ttl = self.ttl_peer_table.add(mex.sender) # TODO timeout
+                try:
+                    new_ttl = self.ttl_peer_table.add(mex.sender)
                     self.logger.info("Inserting %s in ttl table with ttl=%d",
-                                      mex.sender, new_ttl)
-                    
-                    # try to connect to any known peer, which did not
-                    # recently disconnected from us
-                    if self.ttl_peer_table.any_ready():
-                        [(new_ip, new_port)] = self.ttl_peer_table.extract(n=1)
-                        self.connect_as_client(
-                            new_ip, new_port,
-                            (Queue(), self.master_queue)
-                        )
-
-                elif isinstance(mex, utils.M_COMPLETED):
-                    self.logger.info("Completed download!")
-                    self.is_completed = True
-                    
-                elif isinstance(mex, utils.M_KILL): #coming from fiume/cli
-                    self.logger.info("Received KILL message, closing.")
-                    sys.exit(0)
+                                     mex.sender, new_ttl)
+                except ttl.AlreadyPresent:
+                    pass
 
-
-                        
-            # If completed dowload, this loop ends; the thread listening
-            # for new connections however will remain alive
-            if self.is_completed:
-                self.tracker_manager.notify_completion()
+            elif isinstance(mex, utils.M_COMPLETED):
+                self.logger.info("Completed download!")
+                self.is_completed = True
                 break
 
+            elif isinstance(mex, utils.M_KILL): #coming from fiume/cli
+                self.logger.info("Received KILL message, closing.")
+                self.logger.info("Piece cache: %s", self.piece_cache.stats())
+                self.tracker_manager.close()
+                if self.engine is not None:
+                    self.engine.remove_torrent(self)
+                sys.exit(0)
+
+            elif isinstance(mex, tuple): # coming from trackers, or PEX
+                (new_ip, new_port) = mex
+                self.logger.info("Received new peer, %s", (new_ip, new_port))
+                self.connect_as_client(
+                    new_ip, new_port,
+                    (Queue(), self.master_queue)
+                )
 
-            if not self.peers_queue_in.empty():
-                while not self.peers_queue_in.empty():
-                    (new_ip, new_port) = self.peers_queue_in.get()
-                    self.logger.info("Received new peer from trackers, %s", (new_ip, new_port))
-                    self.connect_as_client(
-                        new_ip, new_port,
-                        (Queue(), self.master_queue)
-                    )
-                time.sleep(2)
-                continue
-
-                
-            if len(self.active_connections) == 0:
-                
-                if self.ttl_peer_table.any_ready():
-                    [(new_ip, new_port)] = self.ttl_peer_table.extract(n=1)
-                    self.logger.info("Found a peer to wake in TTL, %s", (new_ip, new_port))
-                    self.connect_as_client(
-                        new_ip, new_port,
-                        (Queue(), self.master_queue)
-                    )
-                    time.sleep(1)
-                    continue
-                
-                        
-                else:
-                    self.logger.debug("No active connections while download is incomplete; 5 second sleep")
-                    time.sleep(5)
-                    continue
-                    
-            else:
-                time.sleep(1)
+            # Try to connect to any known peer, which did not
+            # recently disconnected from us
+            ready_peers = self.ttl_peer_table.extract(
+                n=len(self.ttl_peer_table.not_yet_extracted),
+                timeout=0, accontentati=True
+            )
+            for (new_ip, new_port) in ready_peers:
+                self.logger.info("Found a peer to wake in TTL, %s", (new_ip, new_port))
+                self.connect_as_client(
+                    new_ip, new_port,
+                    (Queue(), self.master_queue)
+                )
                     
         self.logger.info("Completed download, now in seed-listening phase") 
 
         # socket_listen_t.join()
         
             
+    def open_stream(self, timeout: Optional[float] = None) -> "streaming.StreamReader":
+        """
+        Returns a file-like reader of the torrent, usable while it downloads
+        (and switches the download to streaming mode).
+        """
+        return streaming.StreamReader(self.mcu, timeout=timeout)
+
+    
     def connect_as_client(self, ip, port, queues: Tuple[Queue, Queue]):
         if (ip, port) in self.active_connections:
             self.logger.warning("%s:%s already in active_connections, bypass", ip, port)
             return
+
+        if self.engine is not None:
+            # The engine will call register_peer (or hibernate_peer)
+            # once the connection attempt is over
+            self.active_connections.add((ip, port))
+            self.engine.connect(self, (ip, port))
+            return
         
         try:
             new_socket = socket.create_connection((ip, port))
@@ -1069,34 +1680,53 @@ class ThreadedServer:
                 self.metainfo, self.tracker_manager,
                 queues,
                 self.initial_bitmap, self.options,
-                Initiator.SELF)
+                Initiator.SELF,
+                storage=self.storage,
+                piece_cache=self.piece_cache,
+                piece_table=self.piece_table,
+                hasher=self.hasher,
+                pex=self.pex)
             
             self.logger.info("Connected to: %s:%s", ip, port)
             
         except socket.timeout:
-            self.logger.debug("Cannot connect to %s after %d seconds, abort", (ip, port), self.timeout)
-            new_ttl = self.ttl_peer_table.add((ip, port))
-            self.logger.debug("Hybernating %s with TTL=%d", (ip, port), new_ttl)
+            self.hibernate_peer((ip, port), "Timeout after {} seconds".format(self.timeout))
             return
         
         except ConnectionRefusedError as e:
-            self.logger.debug("%s: %s", (ip, port), e)
-            new_ttl = self.ttl_peer_table.add((ip, port))
-            self.logger.debug("Hybernating %s with TTL=%d", (ip, port), new_ttl)
+            self.hibernate_peer((ip, port), str(e))
             return
         
         except Exception as e:
             self.logger.error("%s: %s", (ip, port), e)
-            new_ttl = self.ttl_peer_table.add((ip, port))
-            self.logger.debug("Hybernating %s with TTL=%d", (ip, port), new_ttl)
+            self.hibernate_peer((ip, port), str(e))
             raise e
 
+        # Registered first: the master must know the peer before its
+        # first message arrives
+        self.register_peer(new_peer)
+
         t = threading.Thread(target = new_peer.main)
         t.daemon = True
         t.start()
+
+
+    def register_peer(self, peer: PeerManager):
+        """
+        Call this when a new connection with a peer is established,
+        no matter who initiated it.
+        """
+        self.active_connections.add(peer.address)
+        self.mcu.add_connection_to(peer)
+
         
-        self.active_connections.add((ip, port))
-        self.mcu.add_connection_to(new_peer)
+    def hibernate_peer(self, address: utils.Address, reason: str = "Connection failed"):
+        """
+        Call this (from any thread) when a connection attempt failed; 
+        the peer will be contacted again after its TTL expires.
+        """
+        self.logger.debug("Hybernating %s: %s", address, reason)
+        self.ts_queue_in.put(utils.M_DISCONNECTED(address, reason))
 
     
     def listen(self):
@@ -1117,11 +1747,15 @@ class ThreadedServer:
                 (Queue(), self.master_queue),
                 self.initial_bitmap,
                 self.options,
-                Initiator.OTHER
+                Initiator.OTHER,
+                storage=self.storage,
+                piece_cache=self.piece_cache,
+                piece_table=self.piece_table,
+                hasher=self.hasher,
+                pex=self.pex
             )
 
-            self.active_connections.add(address)
-            self.mcu.add_connection_to(new_peer)
+            self.register_peer(new_peer)
             
             t = threading.Thread(target = new_peer.main)
             t.daemon = True
@@ -1131,7 +1765,6 @@ class ThreadedServer:
 ###############################
 
 import Fiume.metainfo_decoder as md
-import bencodepy
 import argparse
 
 def parser(s=None):
@@ -1174,6 +1807,127 @@ def parser(s=None):
                         dest="max_concurrent_pieces",
                         help="max num of concurrent pieces downloaded from/to peer")
     
+    parser.add_argument("--request-queue-depth",
+                        action="store",
+                        default=64,
+                        type=int,
+                        dest="request_queue_depth",
+                        help="max num of block requests in flight to a single peer (actual depth is tuned on the measured bandwidth-delay product)")
+
+    parser.add_argument("--peer-engine",
+                        action="store",
+                        default="asyncio",
+                        choices=["asyncio", "threads"],
+                        dest="peer_engine",
+                        help="how to drive peer connections: a single event loop, or two threads per peer")
+    
+    parser.add_argument("--storage",
+                        action="store",
+                        default="file",
+                        choices=storage_mod.STORAGES,
+                        dest="storage",
+                        help="how to store downloaded data: file (pread/pwrite), mmap, or memory (nothing is saved to disk)")
+
+    parser.add_argument("--cache-size",
+                        action="store",
+                        default=64,
+                        type=int,
+                        dest="cache_size",
+                        help="memory (MiB) for the pieces read from disk to be sent to peers, shared by all torrents")
+
+    parser.add_argument("--no-sendfile",
+                        action="store_false",
+                        dest="sendfile",
+                        help="when seeding, read blocks and send them, instead of using sendfile")
+
+    parser.add_argument("--hash-workers",
+                        action="store",
+                        default=0,
+                        type=int,
+                        help="threads verifying the hashes of downloaded pieces, shared by all torrents (0: one per CPU)")
+
+    parser.add_argument("--piece-picker",
+                        action="store",
+                        default="rarest",
+                        choices=list(picker_mod.PICKERS),
+                        help="which pieces to download first: the rarest in the swarm, random ones, or in order")
+
+    parser.add_argument("--endgame-blocks",
+                        action="store",
+                        default=32,
+                        type=int,
+                        help="when this many blocks are missing, request them from every peer that has them")
+
+    parser.add_argument("--schedule-horizon",
+                        action="store",
+                        default=5.0,
+                        type=float,
+                        help="schedule to each peer the pieces it can download in this many seconds, at its rate")
+
+    parser.add_argument("--upload-slots",
+                        action="store",
+                        default=4,
+                        type=int,
+                        help="how many peers to upload to at the same time (one of them chosen at random)")
+
+    parser.add_argument("--streaming",
+                        action="store_true",
+                        default=False,
+                        help="download first the pieces to be read next, to use the file while it downloads")
+
+    parser.add_argument("--stream-window",
+                        action="store",
+                        default=8,
+                        type=int,
+                        help="how many pieces ahead of the read cursor are downloaded first, when streaming")
+
+    parser.add_argument("--request-timeout",
+                        action="store",
+                        default=5.0,
+                        type=float,
+                        help="seconds after which an unanswered block request is given up, and the piece downloaded from other peers")
+
+    parser.add_argument("--snub-timeout",
+                        action="store",
+                        default=8.0,
+                        type=float,
+                        help="a peer that unchoked us and sent no data for this many seconds is snubbing us: it is given few pieces, and no reciprocation")
+
+    parser.add_argument("--pex-interval",
+                        action="store",
+                        default=pex_mod.PEX_INTERVAL,
+                        type=float,
+                        help="seconds between two Peer Exchange (PEX) messages to the same peer, telling it the peers we are connected to; 0 disables PEX")
+
+    parser.add_argument("--external-ip",
+                        action="store",
+                        default=None,
+                        help="public IP to announce to trackers (looked up once, in background, if not given)")
+
+    parser.add_argument("--tracker-timeout",
+                        action="store",
+                        default=5.0,
+                        type=float,
+                        help="seconds to wait for the answer of a single tracker")
+
+    parser.add_argument("--recheck",
+                        action="store",
+                        default="quick",
+                        choices=["quick", "full", "off"],
+                        help="on startup, verify the hashes of the data already downloaded: if the file changed since the last session (quick), always (full), or never (off)")
+
+    parser.add_argument("--resume-flush-interval",
+                        action="store",
+                        default=5.0,
+                        type=float,
+                        help="max seconds between a downloaded piece and the update of the resume file")
+
+    parser.add_argument("--resume-flush-pieces",
+                        action="store",
+                        default=64,
+                        type=int,
+                        help="update the resume file at least every this many downloaded pieces")
+
     parser.add_argument("-t", "--timeout",
                         action="store",
                         default=10,
@@ -0,0 +1,254 @@
+import io
+import os
+import mmap
+import threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import *
+
+
+class Storage:
+    """
+    Where the downloaded data lives.
+
+    Reads and writes are positional (an offset in the torrent data):
+    implementations must allow concurrent calls from different threads.
+    """
+
+    def read(self, offset: int, length: int) -> bytes:
+        """ Reads up to `length` bytes (less at the end of the data). """
+        raise NotImplementedError
+
+    def write(self, offset: int, data: Union[bytes, bytearray, memoryview]):
+        raise NotImplementedError
+
+    def flush(self):
+        """ Returns when the data written so far is on disk. """
+        pass
+
+    @contextmanager
+    def open_file(self) -> Iterator[Optional[BinaryIO]]:
+        """
+        A file object on the underlying file, for sendfile (which only
+        needs its descriptor, and an offset). None if the data does not
+        live in a file.
+        """
+        yield None
+
+    def close(self):
+        pass
+
+
+class FileHandlePool:
+    """
+    Keeps open the most recently used files, so that they are not
+    reopened for every piece.
+
+    File descriptors are used only with os.pread/os.pwrite, which do
+    not move a shared seek position: the same descriptor can be used by
+    many threads at once, and the lock only protects the pool itself.
+    """
+
+    def __init__(self, max_open: int = 64):
+        self.max_open = max_open
+        self.lock = threading.Lock()
+
+        # path -> [fd, how many are using it right now, to be closed]
+        self.handles: "OrderedDict[Path, List]" = OrderedDict()
+
+
+    @contextmanager
+    def handle(self, path: Path) -> Iterator[int]:
+        with self.lock:
+            if path in self.handles:
+                self.handles.move_to_end(path)
+            else:
+                self.handles[path] = [os.open(path, os.O_RDWR | os.O_CREAT, 0o644), 0, False]
+                self._evict()
+
+            entry = self.handles[path]
+            entry[1] += 1
+
+        try:
+            yield entry[0]
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0 and entry[2]:
+                    os.close(entry[0])
+
+
+    def close(self, path: Path):
+        """
+        Closes the file as soon as nobody is using it: a pread/pwrite
+        in flight must not find its descriptor closed (or, worse,
+        reused for another file). The next handle() opens it again.
+        """
+        with self.lock:
+            entry = self.handles.pop(path, None)
+            if entry is None:
+                return
+            if entry[1] == 0:
+                os.close(entry[0])
+            else:
+                entry[2] = True
+
+
+    def _evict(self):
+        # Closes the least recently used files, but never one in use
+        for path in list(self.handles):
+            if len(self.handles) <= self.max_open:
+                return
+            fd, users, _ = self.handles[path]
+            if users == 0:
+                os.close(fd)
+                del self.handles[path]
+
+# Shared by all the torrents of the process
+default_pool = FileHandlePool()
+
+
+class FileStorage(Storage):
+    """ Reads and writes the file with os.pread/os.pwrite. """
+
+    def __init__(self, path: Path, pool: FileHandlePool = None):
+        self.path = Path(path)
+        self.pool = pool if pool is not None else default_pool
+
+
+    def read(self, offset: int, length: int) -> bytes:
+        with self.pool.handle(self.path) as fd:
+            return os.pread(fd, length, offset)
+
+
+    def write(self, offset: int, data: Union[bytes, bytearray, memoryview]):
+        with self.pool.handle(self.path) as fd:
+            view = memoryview(data)
+            while len(view) > 0:
+                written = os.pwrite(fd, view, offset)
+                view, offset = view[written:], offset + written
+
+
+    def flush(self):
+        with self.pool.handle(self.path) as fd:
+            os.fsync(fd)
+
+
+    @contextmanager
+    def open_file(self) -> Iterator[Optional[BinaryIO]]:
+        with self.pool.handle(self.path) as fd:
+            yield io.FileIO(fd, "r", closefd=False)
+
+
+    def close(self):
+        self.pool.close(self.path)
+
+
+class MmapStorage(Storage):
+    """
+    The file (extended to its final size) is mapped in memory; reads and
+    writes are plain slice copies, and the kernel writes dirty pages back.
+    """
+
+    def __init__(self, path: Path, size: int):
+        self.path = Path(path)
+        self.size = size
+
+        # The descriptor is kept open for sendfile: the page cache is
+        # the same of the mapping, so it sees the writes right away
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.mmap = mmap.mmap(self.fd, size) if size > 0 else None
+
+
+    def read(self, offset: int, length: int) -> bytes:
+        if self.mmap is None:
+            return b""
+        return self.mmap[offset:min(offset+length, self.size)]
+
+
+    def write(self, offset: int, data: Union[bytes, bytearray, memoryview]):
+        if offset + len(data) > self.size:
+            raise ValueError("Writing past the end of {}".format(self.path))
+        self.mmap[offset:offset+len(data)] = data
+
+
+    def flush(self):
+        if self.mmap is not None:
+            self.mmap.flush() # msync, synchronous
+
+
+    @contextmanager
+    def open_file(self) -> Iterator[Optional[BinaryIO]]:
+        yield io.FileIO(self.fd, "r", closefd=False)
+
+
+    def close(self):
+        if self.fd is None:
+            return
+
+        if self.mmap is not None:
+            self.mmap.flush()
+            self.mmap.close()
+            self.mmap = None
+
+        os.close(self.fd)
+        self.fd = None
+
+
+class MemoryStorage(Storage):
+    """ Keeps everything in memory: for tests and benchmarks. """
+
+    def __init__(self, size: int = 0):
+        self.data = bytearray(size)
+        self.lock = threading.Lock() # a write may need to grow the bytearray
+
+
+    def read(self, offset: int, length: int) -> bytes:
+        return bytes(self.data[offset:offset+length])
+
+
+    def write(self, offset: int, data: Union[bytes, bytearray, memoryview]):
+        with self.lock:
+            if offset + len(data) > len(self.data):
+                self.data.extend(bytes(offset + len(data) - len(self.data)))
+            self.data[offset:offset+len(data)] = data
+
+
+STORAGES = ["file", "mmap", "memory"]
+
+def open_storage(kind: str, path: Path, size: int) -> Storage:
+    """
+    Returns the storage of the given kind (one of STORAGES) for the
+    download file `path` of `size` bytes.
+    """
+    if kind == "file":
+        return FileStorage(path)
+    if kind == "mmap":
+        return MmapStorage(path, size)
+    if kind == "memory":
+        return MemoryStorage(size)
+
+    raise ValueError("Unknown storage {}".format(kind))
+
+
+def initialize_file(kind: str, path: Path, size: int):
+    """
+    Creates (if missing) the download file, with its final size: the
+    file is sparse, so no space is actually written.
+    """
+    if kind == "memory":
+        return
+
+    # Es. se path è /a/b/c/d.jpg ma b,c,d non esistono, creale
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if os.fstat(fd).st_size < size:
+            os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
@@ -0,0 +1,111 @@
+import io
+import time
+
+from typing import *
+
+import Fiume.utils as utils
+
+
+class StreamReader(io.RawIOBase):
+    """
+    A read-only, file-like view of a torrent that is still downloading.
+
+    Reads block until the pieces they need are downloaded, and only those:
+    the reader tells the master where it is (and how fast it reads), so
+    that the pieces right after the cursor are downloaded first (see
+    MasterControlUnit.start_streaming). Wrap it in an io.BufferedReader
+    for small reads.
+
+    `timeout` is how many seconds a read may wait for a piece (None: forever);
+    after that, TimeoutError.
+    """
+
+    # While waiting for a piece, the master is reminded every this many seconds
+    REMIND_INTERVAL = 1.0
+
+    def __init__(self, mcu: "master.MasterControlUnit", timeout: Optional[float] = None):
+        super().__init__()
+        self.mcu = mcu
+        self.metainfo = mcu.metainfo
+        self.timeout = timeout
+
+        self.position = 0
+        self.last_piece: Optional[int] = None
+
+        # Read rate, for the deadlines of the next pieces
+        self.started_at = time.monotonic()
+        self.bytes_read = 0
+
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.metainfo.total_size + offset
+        else:
+            raise ValueError("Invalid whence {}".format(whence))
+
+        if position < 0:
+            raise ValueError("Negative seek position {}".format(position))
+        self.position = position
+        return position
+
+
+    def readinto(self, b) -> int:
+        if self.closed:
+            raise ValueError("I/O operation on closed StreamReader")
+        if self.position >= self.metainfo.total_size:
+            return 0
+
+        piece_size = self.metainfo.piece_size
+        piece = self.position // piece_size
+        self.wait_for(piece)
+
+        # Up to the end of the piece, at most
+        length = min(len(b), (piece + 1) * piece_size - self.position,
+                     self.metainfo.total_size - self.position)
+        b[:length] = self.mcu.storage.read(self.position, length)
+
+        self.position += length
+        self.bytes_read += length
+        return length
+
+
+    def rate(self) -> float:
+        """ Bytes read per second, since the reader was opened. """
+        elapsed = time.monotonic() - self.started_at
+        return self.bytes_read / elapsed if elapsed > 0 else 0.0
+
+
+    def wait_for(self, piece: int):
+        """ Blocks until `piece` is downloaded. """
+        if piece != self.last_piece:
+            self.last_piece = piece
+            self.mcu.queue_in.put(utils.M_STREAM_SEEK(piece, self.rate()))
+
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        bitmap = self.mcu.bitmap
+
+        with self.mcu.piece_completed:
+            while not bitmap[piece]:
+                wait = self.REMIND_INTERVAL
+                if deadline is not None:
+                    wait = min(wait, deadline - time.monotonic())
+                    if wait <= 0:
+                        raise TimeoutError("Piece {} not downloaded in time".format(piece))
+
+                if not self.mcu.piece_completed.wait(wait):
+                    # Still missing: now overdue, maybe
+                    self.mcu.queue_in.put(utils.M_STREAM_SEEK(piece, self.rate()))
@@ -0,0 +1,224 @@
+import threading
+import logging
+
+from collections import deque
+
+from concurrent.futures import ThreadPoolExecutor, Future
+from urllib.parse import urlsplit
+from typing import *
+
+import bencodepy
+import requests
+from requests.adapters import HTTPAdapter
+
+import Fiume.udp_tracker as udp_tracker_mod
+
+logging.getLogger("urllib3").setLevel(logging.WARNING)
+
+Url = str
+
+# Announces in flight at the same time, to all trackers of all torrents
+MAX_ANNOUNCES = 32
+# Keep-alive connections kept open to a single tracker: announces of
+# all torrents to that host take turns on them
+CONNECTIONS_PER_HOST = 2
+# Hosts whose connections are kept open
+MAX_HOSTS = 64
+# Retransmissions of a UDP request, waiting twice as much every time
+# (BEP 15 goes up to 8, which is more than an hour)
+UDP_RETRIES = 3
+
+
+class TrackerClient:
+    """
+    Sends the announces of all the torrents of a session (or of a single
+    torrent) to HTTP and UDP trackers.
+
+    Announces run on a pool of threads, each one with its own timeout:
+    `announce` returns a Future at once. HTTP ones go through a single
+    requests.Session, which keeps the connections to every tracker open
+    between announces. Torrents announcing to the same host share its
+    connections: at most CONNECTIONS_PER_HOST requests to a host are
+    given to the pool at once, the others wait in a queue of that host
+    (so that a slow tracker cannot take all the threads). Identical
+    announces still in flight are sent only once. UDP ones
+    share a socket, and the connection IDs of the trackers (see
+    Fiume.udp_tracker).
+    """
+
+    def __init__(self, options: Dict[str, Any]):
+        self.timeout = options.get("tracker_timeout", 5.0)
+        self.debug_level = options.get("debug_level", logging.DEBUG)
+
+        self.logger = logging.getLogger("TrackerClient")
+        self.logger.setLevel(self.debug_level)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=MAX_HOSTS, pool_maxsize=CONNECTIONS_PER_HOST)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.pool = ThreadPoolExecutor(max_workers=MAX_ANNOUNCES, thread_name_prefix="Tracker")
+
+        self.lock = threading.Lock()
+        self.udp_lock = threading.Lock()
+        self.host_lock = threading.Lock()
+        # host -> requests given to the pool, and requests waiting
+        self.host_active: Dict[str, int] = dict()
+        self.host_waiting: Dict[str, Deque[Tuple[Future, Callable, Tuple]]] = dict()
+        self.in_flight: Dict[Tuple, Future] = dict()
+        # Created at the first udp:// tracker
+        self.udp: Optional[udp_tracker_mod.UdpTracker] = None
+
+
+    def announce(self, url: Url, params: Dict[str, Any]) -> Future:
+        """
+        Announces to `url` with the (HTTP) `params`, in background. The
+        Future gives the decoded answer of the tracker, or raises (eg.
+        requests.Timeout, TimeoutError).
+        """
+        key = (url, tuple(sorted(params.items())))
+
+        with self.lock:
+            if key in self.in_flight:
+                return self.in_flight[key]
+
+            if self._scheme(url) == "udp":
+                future = self.pool.submit(self._udp().announce, self._str(url), params)
+            else:
+                future = self._submit_to_host(urlsplit(self._str(url)).netloc, self._get, url, params)
+            self.in_flight[key] = future
+
+        future.add_done_callback(lambda _: self._done(key))
+        return future
+
+
+    def scrape(self, url: Url, info_hashes: List[bytes]) -> Future:
+        """
+        Asks a tracker about some torrents, in background: the Future
+        gives, for each info_hash, a dict with the number of seeders
+        (b"complete"), leechers (b"incomplete") and completed downloads.
+        Raises ValueError if the tracker does not support scrape.
+        """
+        if self._scheme(url) == "udp":
+            return self.pool.submit(self._udp().scrape, self._str(url), info_hashes)
+
+        scrape = scrape_url(self._str(url))
+        if scrape is None:
+            raise ValueError("{} does not support scrape".format(url))
+        return self._submit_to_host(urlsplit(scrape).netloc, self._get_scrape, scrape, info_hashes)
+
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+        self.session.close()
+        if self.udp is not None:
+            self.udp.close()
+
+
+    def _get(self, url: Url, params: Dict[str, Any]) -> bencodepy.Bencode:
+        response = self.session.get(url, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return bencodepy.decode(response.content)
+
+
+    def _get_scrape(self, url: str, info_hashes: List[bytes]) -> Dict[bytes, Dict[bytes, int]]:
+        response = self.session.get(url, params={"info_hash": info_hashes}, timeout=self.timeout)
+        response.raise_for_status()
+        return bencodepy.decode(response.content).get(b"files", dict())
+
+
+    def _udp(self) -> udp_tracker_mod.UdpTracker:
+        with self.udp_lock:
+            if self.udp is None:
+                self.udp = udp_tracker_mod.UdpTracker(
+                    base_timeout=self.timeout, max_retries=UDP_RETRIES,
+                    debug_level=self.debug_level
+                )
+            return self.udp
+
+
+    def _scheme(self, url: Url) -> str:
+        return urlsplit(self._str(url)).scheme
+
+
+    def _str(self, url: Url) -> str:
+        # URLs in the metainfo are bytes
+        return url.decode() if isinstance(url, bytes) else url
+
+
+    def _submit_to_host(self, host: str, fn: Callable, *args) -> Future:
+        """
+        Runs `fn(*args)` on the pool as soon as `host` has a free slot.
+        """
+        future: Future = Future()
+        with self.host_lock:
+            if self.host_active.get(host, 0) < CONNECTIONS_PER_HOST:
+                self.host_active[host] = self.host_active.get(host, 0) + 1
+            else:
+                self.host_waiting.setdefault(host, deque()).append((future, fn, args))
+                return future
+
+        self._start(host, future, fn, args)
+        return future
+
+
+    def _start(self, host: str, future: Future, fn: Callable, args: Tuple):
+        try:
+            running = self.pool.submit(fn, *args)
+        except RuntimeError as e: # closed
+            future.set_exception(e)
+            self._next(host)
+            return
+
+        running.add_done_callback(lambda _: self._finished(host, running, future))
+
+
+    def _finished(self, host: str, running: Future, future: Future):
+        if running.exception() is not None:
+            future.set_exception(running.exception())
+        else:
+            future.set_result(running.result())
+        self._next(host)
+
+
+    def _next(self, host: str):
+        """ A request to `host` is over: its slot goes to the next one waiting. """
+        with self.host_lock:
+            waiting = self.host_waiting.get(host)
+            if not waiting:
+                self.host_active[host] -= 1
+                self.host_waiting.pop(host, None)
+                return
+            future, fn, args = waiting.popleft()
+
+        self._start(host, future, fn, args)
+
+
+    def _done(self, key: Tuple):
+        with self.lock:
+            self.in_flight.pop(key, None)
+
+
+def scrape_url(url: Url) -> Optional[str]:
+    """
+    The scrape URL of a tracker: the announce URL with "announce"
+    replaced by "scrape" in its last component. None if it cannot be
+    found (the tracker does not support scrape), or for UDP trackers
+    (which use the same address).
+    """
+    if isinstance(url, bytes):
+        url = url.decode()
+    if url.startswith("udp://"):
+        return None
+
+    head, _, last = url.rpartition("/")
+    if not last.startswith("announce"):
+        return None
+    return head + "/scrape" + last[len("announce"):]
+
+
+def can_scrape(url: Url) -> bool:
+    if isinstance(url, bytes):
+        url = url.decode()
+    return url.startswith("udp://") or scrape_url(url) is not None
@@ -0,0 +1,117 @@
+from typing import *
+from queue import Empty
+import heapq
+import itertools
+import time
+import threading
+
+Timestamp = float
+TTL = float
+
+class AlreadyPresent(KeyError):
+    pass
+
+class TTL_table:
+    """
+    Same interface of Fiume.ttl.TTL_table, but without a Timer thread
+    for every object: expirations are kept in a heap, and consumers
+    wait on a Condition.
+
+    Consumers that have other things to wait on (eg. ThreadedServer)
+    can use `next_expiry` as the timeout of their own blocking call.
+    """
+    def __init__(self, default_ttl: float):
+        self.default_ttl = default_ttl
+
+        # Objs che sono stati aggiunti ma non ancora estratti: (ttl, scadenza)
+        self.not_yet_extracted: Dict[Hashable, Tuple[TTL, Timestamp]] = dict()
+        # Objs già estratti ma ancora in fase di expiration: (ttl, oblio)
+        self.recently_extracted: Dict[Hashable, Tuple[TTL, Timestamp]] = dict()
+
+        # (scadenza, contatore, obj), ordinati per scadenza
+        self._heap: List[Tuple[Timestamp, int, Hashable]] = list()
+        self._counter = itertools.count()
+
+        self._cond = threading.Condition()
+
+
+    def add(self, obj: Hashable) -> TTL:
+        """
+        Adds an object to the TTL table.
+
+        Returns the TTL for the added object.
+        """
+        with self._cond:
+            if obj in self.not_yet_extracted:
+                raise AlreadyPresent()
+
+            now = time.monotonic()
+            ttl = self.default_ttl
+
+            if obj in self.recently_extracted:
+                old_ttl, forget_at = self.recently_extracted.pop(obj)
+                if now < forget_at:
+                    ttl = old_ttl * 2
+
+            self.not_yet_extracted[obj] = (ttl, now + ttl)
+            heapq.heappush(self._heap, (now + ttl, next(self._counter), obj))
+            self._cond.notify_all()
+
+        return ttl
+
+
+    def any_ready(self) -> bool:
+        """
+        Returns whether there is any available (aka. expired) object.
+        """
+        with self._cond:
+            return self._heap != [] and self._heap[0][0] <= time.monotonic()
+
+
+    def next_expiry(self) -> Optional[float]:
+        """
+        Seconds until the next object becomes available (0 if one is
+        already available); None if the table is empty.
+        """
+        with self._cond:
+            if self._heap == []:
+                return None
+            return max(0, self._heap[0][0] - time.monotonic())
+
+
+    def extract(self, n=1, timeout=None, accontentati=False) -> List[Any]:
+        """
+        Extracts n objects from the expired set.
+
+        Timeout is the timeout for an object when our queue is empty. None means forever.
+
+        Accontentati is used when you request the extraction of `n` objects,
+        but only `m` (`m` < `n`) are inside the queue. If Accontentati is True,
+        you return only `m` objects; otherwise, wait for `n` objects.
+        """
+        out = list()
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self._cond:
+            while len(out) < n:
+                now = time.monotonic()
+
+                if self._heap != [] and self._heap[0][0] <= now:
+                    _, _, obj = heapq.heappop(self._heap)
+                    ttl, _ = self.not_yet_extracted.pop(obj)
+                    self.recently_extracted[obj] = (ttl, now + ttl)
+                    out.append(obj)
+                    continue
+
+                wait = None if self._heap == [] else self._heap[0][0] - now
+
+                if deadline is not None:
+                    if now >= deadline:
+                        if accontentati:
+                            return out
+                        raise Empty()
+                    wait = deadline - now if wait is None else min(wait, deadline - now)
+
+                self._cond.wait(wait)
+
+        return out
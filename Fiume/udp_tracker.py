@@ -0,0 +1,248 @@
+import socket
+import struct
+import random
+import threading
+import time
+import logging
+
+from queue import Queue, Empty
+from urllib.parse import urlsplit
+from typing import *
+
+Address = Tuple[str, int] # (ip, port)
+
+PROTOCOL_ID = 0x41727101980
+CONNECT, ANNOUNCE, SCRAPE, ERROR = 0, 1, 2, 3
+EVENTS = {"": 0, "completed": 1, "started": 2, "stopped": 3}
+
+# A connection ID can be used for a minute after it was received
+CONNECTION_ID_TTL = 60.0
+# info_hashes in a single scrape, to fit in a datagram
+MAX_SCRAPE = 74
+
+CONNECT_REQUEST = struct.Struct(">QII")         # protocol_id, action, transaction_id
+CONNECT_RESPONSE = struct.Struct(">IIQ")        # action, transaction_id, connection_id
+ANNOUNCE_REQUEST = struct.Struct(">QII20s20sQQQIIIiH")
+ANNOUNCE_RESPONSE = struct.Struct(">IIIII")     # action, transaction_id, interval, leechers, seeders
+SCRAPE_REQUEST = struct.Struct(">QII")          # connection_id, action, transaction_id
+SCRAPE_ENTRY = struct.Struct(">III")            # seeders, completed, leechers
+HEADER = struct.Struct(">II")                   # action, transaction_id
+
+
+class TrackerError(Exception):
+    """ The tracker answered with an error message. """
+    pass
+
+
+class UdpTracker:
+    """
+    Client of the UDP tracker protocol (BEP 15), for all the UDP
+    trackers of a session: a single socket, whose answers are handed to
+    the waiting requests by a receiver thread.
+
+    Requests block the calling thread (see TrackerClient, which runs
+    them on a pool). A request not answered in `base_timeout * 2^n`
+    seconds is sent again, for n = 0 .. `max_retries`, as BEP 15 asks
+    (with base_timeout 15 and max_retries 8). Connection IDs are kept
+    for a minute, and shared by all the requests to a tracker.
+
+    Answers have the same form as the bencoded ones of HTTP trackers.
+    """
+
+    def __init__(self, base_timeout: float = 15.0, max_retries: int = 8,
+                 debug_level=logging.DEBUG):
+        self.base_timeout = base_timeout
+        self.max_retries = max_retries
+
+        self.logger = logging.getLogger("UdpTracker")
+        self.logger.setLevel(debug_level)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("0.0.0.0", 0))
+        self.sock.settimeout(0.5) # to notice close()
+
+        self.key = random.getrandbits(32)
+
+        self.lock = threading.Lock()
+        self.pending: Dict[int, Tuple[Address, Queue]] = dict()
+        # tracker -> (connection_id, when it was received)
+        self.connection_ids: Dict[Address, Tuple[int, float]] = dict()
+        self.connects = 0
+
+        self.closed = False
+        self.receiver = threading.Thread(target=self._receive, name="UdpTracker", daemon=True)
+        self.receiver.start()
+
+
+    def announce(self, url: str, params: Dict[str, Any]) -> Dict[bytes, Any]:
+        """
+        Announces to the tracker at `url`, with the params of an HTTP
+        announce (info_hash, peer_id, port, downloaded, left, uploaded,
+        event).
+        """
+        tracker = self._resolve(url)
+
+        def request(connection_id: int, transaction_id: int) -> bytes:
+            return ANNOUNCE_REQUEST.pack(
+                connection_id, ANNOUNCE, transaction_id,
+                params["info_hash"], params["peer_id"],
+                int(params.get("downloaded", 0)), int(params.get("left", 0)),
+                int(params.get("uploaded", 0)), EVENTS[params.get("event", "")],
+                0, # IP: the one the datagram comes from
+                self.key, -1, int(params["port"])
+            )
+
+        answer = self._request(tracker, ANNOUNCE, request)
+        if len(answer) < ANNOUNCE_RESPONSE.size:
+            raise TrackerError("announce answer too short ({} bytes)".format(len(answer)))
+
+        _, _, interval, leechers, seeders = ANNOUNCE_RESPONSE.unpack_from(answer)
+        peers = answer[ANNOUNCE_RESPONSE.size:]
+        return {
+            b"interval": interval,
+            b"incomplete": leechers,
+            b"complete": seeders,
+            b"peers": peers[:len(peers) - len(peers) % 6],
+        }
+
+
+    def scrape(self, url: str, info_hashes: List[bytes]) -> Dict[bytes, Dict[bytes, int]]:
+        """
+        Seeders (complete), leechers (incomplete) and completed downloads
+        (downloaded) of each torrent, as in the b"files" of an HTTP scrape.
+        """
+        tracker = self._resolve(url)
+        files = dict()
+
+        for start in range(0, len(info_hashes), MAX_SCRAPE):
+            chunk = info_hashes[start:start+MAX_SCRAPE]
+
+            def request(connection_id: int, transaction_id: int) -> bytes:
+                return SCRAPE_REQUEST.pack(connection_id, SCRAPE, transaction_id) + b"".join(chunk)
+
+            answer = self._request(tracker, SCRAPE, request)
+            for i, info_hash in enumerate(chunk):
+                offset = HEADER.size + i * SCRAPE_ENTRY.size
+                if offset + SCRAPE_ENTRY.size > len(answer):
+                    break
+                seeders, completed, leechers = SCRAPE_ENTRY.unpack_from(answer, offset)
+                files[info_hash] = {
+                    b"complete": seeders, b"downloaded": completed, b"incomplete": leechers
+                }
+
+        return files
+
+
+    def close(self):
+        self.closed = True
+        self.receiver.join()
+        self.sock.close()
+
+
+    def _resolve(self, url: str) -> Address:
+        parts = urlsplit(url)
+        if parts.port is None:
+            raise ValueError("UDP tracker without port: {}".format(url))
+        return socket.gethostbyname(parts.hostname), parts.port
+
+
+    def _request(self, tracker: Address, action: int,
+                 build: Callable[[int, int], bytes]) -> bytes:
+        """
+        Sends the request `build(connection_id, transaction_id)` to the
+        tracker, connecting first if needed, until it answers.
+        """
+        for n in range(self.max_retries + 1):
+            timeout = self.base_timeout * 2**n
+
+            connection_id = self._connection_id(tracker)
+            if connection_id is None:
+                connection_id = self._connect(tracker, timeout)
+                if connection_id is None:
+                    continue
+
+            answer = self._exchange(tracker, lambda tid: build(connection_id, tid), timeout)
+            if answer is not None:
+                self._check(answer, action)
+                return answer
+
+        raise TimeoutError("{}:{} did not answer".format(*tracker))
+
+
+    def _connect(self, tracker: Address, timeout: float) -> Optional[int]:
+        answer = self._exchange(
+            tracker, lambda tid: CONNECT_REQUEST.pack(PROTOCOL_ID, CONNECT, tid), timeout
+        )
+        if answer is None:
+            return None
+
+        self._check(answer, CONNECT)
+        if len(answer) < CONNECT_RESPONSE.size:
+            raise TrackerError("connect answer too short ({} bytes)".format(len(answer)))
+
+        connection_id = CONNECT_RESPONSE.unpack_from(answer)[2]
+        with self.lock:
+            self.connects += 1
+            self.connection_ids[tracker] = (connection_id, time.monotonic())
+        return connection_id
+
+
+    def _connection_id(self, tracker: Address) -> Optional[int]:
+        with self.lock:
+            if tracker not in self.connection_ids:
+                return None
+            connection_id, received_at = self.connection_ids[tracker]
+            if time.monotonic() - received_at > CONNECTION_ID_TTL:
+                del self.connection_ids[tracker]
+                return None
+            return connection_id
+
+
+    def _exchange(self, tracker: Address, build: Callable[[int], bytes],
+                  timeout: float) -> Optional[bytes]:
+        """ Sends a datagram and waits for its answer (None if it does not come). """
+        answers: Queue = Queue()
+        with self.lock:
+            transaction_id = random.getrandbits(32)
+            while transaction_id in self.pending:
+                transaction_id = random.getrandbits(32)
+            self.pending[transaction_id] = (tracker, answers)
+
+        try:
+            self.sock.sendto(build(transaction_id), tracker)
+            return answers.get(timeout=timeout)
+        except Empty:
+            self.logger.debug("%s did not answer in %.1fs", tracker, timeout)
+            return None
+        finally:
+            with self.lock:
+                del self.pending[transaction_id]
+
+
+    def _check(self, answer: bytes, action: int):
+        """ Raises if the tracker answered with an error, or with something else. """
+        got = HEADER.unpack_from(answer)[0]
+        if got == ERROR:
+            raise TrackerError(answer[HEADER.size:].decode("utf-8", "replace"))
+        if got != action:
+            raise TrackerError("expected action {}, got {}".format(action, got))
+
+
+    def _receive(self):
+        while not self.closed:
+            try:
+                data, sender = self.sock.recvfrom(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+
+            if len(data) < HEADER.size:
+                continue
+
+            transaction_id = HEADER.unpack_from(data)[1]
+            with self.lock:
+                waiting = self.pending.get(transaction_id)
+            # Answers from someone else are not trusted
+            if waiting is not None and waiting[0] == sender:
+                waiting[1].put(data)
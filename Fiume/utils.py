@@ -1,16 +1,23 @@
 import random
 import os
+import errno
+import socket
 import logging
+import threading
+import ipaddress
 
 from typing import *
 from typing.io import *
 from pathlib import Path
 from dataclasses import dataclass
+from contextlib import contextmanager
 from threading import Event
 
 import enum
 import Fiume.config as config
 
+from Fiume.bitfield import Bitfield
+
 Address = Tuple[str, int]
 
 THE_TERMINATOR = Event()
@@ -33,10 +40,12 @@ class M_SCHEDULE(MasterMex):
     """
     Master -> PM. 
     
-    Assigns a list of pieces to the PM, who will be the only PM 
-    authorized to request and download them.
+    Assigns a list of pieces to the PM, who is authorized to request
+    their blocks (other PMs may be filling the same pieces).
     """
     pieces_index: List[int]
+    # Needed soon (streaming): to be started before the others
+    urgent: bool = False
 
 @dataclass
 class M_DESCHEDULE(MasterMex):
@@ -56,6 +65,8 @@ class M_PEER_HAS(MasterMex):
     sender: Tuple[str, int]
     # How many new pieces ought the master schedule for the PeerManager, if any
     schedule_new_pieces: int = 10
+    # Bytes downloaded from the peer since the last report (for the master's rate estimate)
+    downloaded: int = 0
 
 
 @dataclass
@@ -63,9 +74,10 @@ class M_OUR_BITMAP(MasterMex):
     """
     Master -> PM.
 
-    Sent at the very beginning of a Master/PM relationship.
+    Sent at the very beginning of a Master/PM relationship (a copy: from
+    then on, the PM updates it with M_NEW_HAVE).
     """
-    bitmap: List[bool]
+    bitmap: Bitfield
     
     
 @dataclass
@@ -105,6 +117,96 @@ class M_PIECE(MasterMex):
     sender: Tuple[str, int]
     # How many new pieces ought the master schedule for the PeerManager
     schedule_new_pieces: int = 1
+    # Bytes downloaded from the peer since the last report (for the master's rate estimate)
+    downloaded: int = 0
+
+    
+@dataclass
+class M_PEER_INTERESTED(MasterMex):
+    """
+    PM -> Master.
+
+    The peer sent INTERESTED (or NOT_INTERESTED): the master's choker
+    decides whether to upload to it.
+    """
+    sender: Tuple[str, int]
+    interested: bool = True
+
+
+@dataclass
+class M_STREAM_SEEK(MasterMex):
+    """
+    StreamReader -> Master.
+
+    The reader needs the piece `piece_index` (and the following ones,
+    reading `rate` bytes/sec, if known): puts the master in streaming mode.
+    """
+    piece_index: int
+    rate: float = 0.0
+
+
+@dataclass
+class M_TIMED_OUT(MasterMex):
+    """
+    PM -> Master.
+
+    REQUESTs to the peer went unanswered for too long: the PM stopped
+    downloading `pieces_index` (their blocks can be requested by other
+    connections). `snubbed` if the peer sent no data at all for a while,
+    even if unchoked.
+    """
+    pieces_index: List[int]
+    sender: Tuple[str, int]
+    snubbed: bool = False
+
+
+@dataclass
+class M_HASHED(MasterMex):
+    """
+    Hasher -> PM.
+
+    The hash of a piece completed by the PM was verified: `ok` if it
+    matches the one in the metainfo.
+    """
+    piece_index: int
+    ok: bool
+
+
+@dataclass
+class M_HASH_FAILED(MasterMex):
+    """
+    PM -> Master.
+
+    A piece completed by the PM did not match its hash, and was
+    discarded: the master schedules it again, to other peers if possible.
+    """
+    piece_index: int
+    sender: Tuple[str, int]
+
+
+@dataclass
+class M_RECHECKED(MasterMex):
+    """
+    ThreadedServer -> Master.
+
+    Pieces found in the download file by the recheck running in
+    background, when the resume file could not be trusted: the master
+    marks them as downloaded. `done` when the recheck is over.
+    """
+    pieces_index: List[int]
+    done: bool = False
+
+
+@dataclass
+class M_CHOKE(MasterMex):
+    """ Master -> PM. The PM must stop uploading to its peer (CHOKE). """
+    pass
+
+
+@dataclass
+class M_UNCHOKE(MasterMex):
+    """ Master -> PM. The PM can upload to its peer (UNCHOKE). """
+    pass
 
     
 @dataclass
@@ -140,15 +242,7 @@ class M_DEBUG(MasterMex):
 ###################################à
     
 def bool_to_bitmap(bs: List[bool]) -> bytes:
-    bitmap = bytearray()
-
-    for byte_ in range(0, len(bs), 8):
-        single_byte = 0
-        for i, x in enumerate(bs[byte_:byte_+8]):
-            single_byte += int(x) << (7-i)
-        bitmap.append(single_byte)
-
-    return bytes(bitmap)
+    return Bitfield.from_bools(bs).to_bytes()
 
 def to_int(b: bytes) -> int:
     return int.from_bytes(b, byteorder="big", signed=False) 
@@ -185,41 +279,14 @@ def mask_data(data: List[bytes], seed: int, padding=b"") -> List[bytes]:
 def get_bitmap_file(download_fpath: Path) -> Path:
     return config.BITMAPS_DIR / download_fpath.name
 
-def update_bitmap_file(download_fpath: Path, bitmap: List[bool]):
-    with open(get_bitmap_file(download_fpath), "w") as f:
-        f.write("".join([str(int(x)) for x in bitmap]))
-        
-def empty_bitmap(num_pieces) -> List[bool]:
-    return [False for _ in range(num_pieces)]
-
-def data_to_bitmap(download_fpath: Path, num_pieces=None) -> List[bool]:
-    bitmap_fpath = get_bitmap_file(download_fpath)
-
-    # Se il file bitmap relativo al torrent NON esiste, allora crealo
-    # inserendo tutti 0. Idem se esiste il bitmap file ma non esiste
-    # il file scaricato (magari perché è stato eliminato)
-    if ((not bitmap_fpath.exists()) or
-        (bitmap_fpath.exists() and not download_fpath.exists())):
-
-        assert num_pieces is not None
-        bitmap_fpath.touch()
-        
-        with open(bitmap_fpath, "w") as f:
-            f.write("0"*num_pieces)
+def get_peers_file(download_fpath: Path) -> Path:
+    return config.PEERS_DIR / download_fpath.name
 
-        return empty_bitmap(num_pieces)
-
-    with open(bitmap_fpath, "r") as f:
-        return [bool(int(x)) for x in f.read().strip()]
+def empty_bitmap(num_pieces) -> Bitfield:
+    return Bitfield(num_pieces)
 
 def bitmap_to_bool(bs: bytes, num_pieces: int) -> List[bool]:
-    bool_bitmap = list()
-
-    for b in bs:
-        for i in range(8):
-            bool_bitmap.append(bool(b >> (7-i) & 1))
-
-    return bool_bitmap[:num_pieces]
+    return list(Bitfield(num_pieces, bs))
 
 
 def generate_peer_id(seed=None) -> bytes:
@@ -256,24 +323,108 @@ def already_started_download(download_fpath: Path):
     
     return True
 
-def already_completed_download(download_fpath: Path):
-    """ 
-    Heuristic, not necessarily correct!
+def set_nodelay(sock: socket.socket):
     """
-    
-    bitmap_fpath = get_bitmap_file(download_fpath)
+    Disables Nagle's algorithm on a peer connection: a message (eg. the
+    header of a PIECE, sent on its own before the payload) must not wait
+    for the ACK of the previous one.
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
-    if not bitmap_fpath.exists():
-        return False
-    
-    with open(bitmap_fpath, "r") as f:
-        return all([bool(x) for x in f.read().strip()])
-    
+@contextmanager
+def corked(sock: socket.socket):
+    """
+    Small writes done inside are held by the kernel and sent together
+    (eg. the header of a PIECE and its payload sent with sendfile), where
+    TCP_CORK exists.
+    """
+    if not hasattr(socket, "TCP_CORK"):
+        yield
+        return
+
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+    try:
+        yield
+    finally:
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+        except OSError: # connection closed meanwhile
+            pass
+
+def sendfile_nowait(sock_fd: int, file_fd: int, offset: int, count: int) -> int:
+    """
+    Sends with os.sendfile as much as the socket accepts right now, without
+    blocking. Returns how many bytes were sent (0 where there is no sendfile).
+    """
+    if not hasattr(os, "sendfile"):
+        return 0
+
+    sent = 0
+    try:
+        while sent < count:
+            n = os.sendfile(sock_fd, file_fd, offset + sent, count - sent)
+            if n == 0: # end of file
+                break
+            sent += n
+    except BlockingIOError:
+        pass
+    except OSError as e:
+        # sendfile not supported for these descriptors: the caller copies
+        if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+            raise
+    return sent
+
+EXTERNAL_IP_SERVICE = "https://api.ipify.org"
+
+_external_ip: Optional[str] = None
+_external_ip_known = Event()
+_external_ip_lock = threading.Lock()
+_external_ip_lookup: Optional[threading.Thread] = None
+
+def get_external_ip(wait: Optional[float] = 0) -> Optional[str]:
+    """
+    The public IP of this host, or None if not known (yet).
+
+    It is asked to EXTERNAL_IP_SERVICE once per session, in background,
+    unless given with set_external_ip. Waits at most `wait` seconds for
+    the answer (None: until it comes, or the lookup fails).
+    """
+    global _external_ip_lookup
 
-def get_external_ip() -> str:
+    with _external_ip_lock:
+        if _external_ip_lookup is None and not _external_ip_known.is_set():
+            _external_ip_lookup = threading.Thread(
+                target=_lookup_external_ip, name="ExternalIP", daemon=True
+            )
+            _external_ip_lookup.start()
+
+    if wait is None or wait > 0:
+        _external_ip_known.wait(wait)
+    return _external_ip
+
+def set_external_ip(ip: Optional[str]):
+    """ Overrides the public IP of this host (no lookup is done). """
+    global _external_ip
+
+    with _external_ip_lock:
+        _external_ip = ip
+        _external_ip_known.set()
+
+def _lookup_external_ip():
+    global _external_ip
     import requests
 
-    return requests.get("https://api.ipify.org").text
+    try:
+        ip = requests.get(EXTERNAL_IP_SERVICE, timeout=10).text.strip()
+        ipaddress.ip_address(ip) # not some error page
+    except Exception as e:
+        logging.getLogger("utils").warning("Could not find the external IP: %s", e)
+        ip = None
+
+    with _external_ip_lock:
+        if not _external_ip_known.is_set(): # not overridden meanwhile
+            _external_ip = ip
+            _external_ip_known.set()
 
 def int_to_loglevel(n):
     if n == 0:
@@ -281,7 +432,7 @@ def int_to_loglevel(n):
     
     return logging.DEBUG
 
-def pprint_bitmap(bitmap: List[bool], who="my"):
+def pprint_bitmap(bitmap: Bitfield, who="my"):
     print(who, end=" |")
     for my in bitmap:
         print("+" if my else " ", end="")
@@ -0,0 +1,139 @@
+"""
+Time to complete a download under peer churn, for each piece picker.
+
+A simulated swarm (no network: time goes in ticks) starts with one seed
+and many empty leechers. Every tick, each peer uploads and downloads a
+few pieces, choosing them with the picker under test; peers leave at
+random and are replaced by new, empty ones, completed peers seed for a
+while then leave, and the initial seed leaves early. When the last
+owner of a piece leaves, nobody can complete any more.
+
+    python benchmarks/churn.py --pieces 200 --peers 30 --churn 0.02 --runs 5
+"""
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import argparse
+import random
+import statistics
+
+from Fiume.picker import PICKERS, make_picker
+
+
+class Peer:
+    def __init__(self, joined: int, pieces=()):
+        self.joined = joined
+        self.pieces = set(pieces)
+        self.completed_at = None
+        self.uploads_left = 0
+
+
+def simulate(policy: str, args, seed: int):
+    rng = random.Random(seed)
+    random.seed(seed) # used by the pickers
+    picker = make_picker(policy) # the whole swarm is connected: availability is global
+
+    def join(peer):
+        peers.append(peer)
+        picker.peer_has(peer.pieces)
+
+    def leave(peer):
+        peers.remove(peer)
+        picker.peer_gone(peer.pieces)
+
+    peers = list()
+    seed_peer = Peer(0, range(args.pieces))
+    join(seed_peer)
+    for _ in range(args.peers):
+        join(Peer(0))
+
+    times, lost_at = list(), None
+    for tick in range(args.ticks):
+        for peer in peers:
+            peer.uploads_left = args.upload
+
+        received = list()
+        for peer in rng.sample(peers, len(peers)):
+            if peer.completed_at is not None:
+                continue
+
+            # As the master does: pieces are chosen among those of a
+            # given peer (here, a random one with upload slots left)
+            wanted, asked = args.download, set()
+            for uploader in rng.sample(peers, len(peers)):
+                if wanted == 0:
+                    break
+                if uploader is peer or uploader.uploads_left == 0:
+                    continue
+
+                candidates = uploader.pieces - peer.pieces - asked
+                for piece in picker.pick(candidates, min(wanted, uploader.uploads_left)):
+                    asked.add(piece)
+                    received.append((peer, piece))
+                    uploader.uploads_left -= 1
+                    wanted -= 1
+
+        # Pieces arrive at the end of the tick
+        for peer, piece in received:
+            if piece not in peer.pieces:
+                peer.pieces.add(piece)
+                picker.peer_has([piece])
+            if len(peer.pieces) == args.pieces and peer.completed_at is None:
+                peer.completed_at = tick
+                times.append(tick - peer.joined)
+
+        if lost_at is None and len(picker.availability) < args.pieces:
+            lost_at = tick
+
+        # Churn
+        for peer in list(peers):
+            if peer is seed_peer:
+                gone = tick >= args.seed_leaves
+            elif peer.completed_at is not None:
+                gone = tick - peer.completed_at >= args.linger
+            else:
+                gone = rng.random() < args.churn
+            if gone:
+                leave(peer)
+                join(Peer(tick + 1))
+
+    return times, lost_at
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pieces", type=int, default=200)
+    parser.add_argument("--peers", type=int, default=30, help="peers in the swarm, besides the seed")
+    parser.add_argument("--upload", type=int, default=4, help="pieces uploaded per peer per tick")
+    parser.add_argument("--download", type=int, default=4, help="pieces requested per peer per tick")
+    parser.add_argument("--churn", type=float, default=0.02, help="probability that a peer leaves, every tick")
+    parser.add_argument("--linger", type=int, default=5, help="ticks a completed peer keeps seeding")
+    parser.add_argument("--seed-leaves", type=int, default=60, help="tick at which the initial seed leaves")
+    parser.add_argument("--ticks", type=int, default=300)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--policies", nargs="+", choices=list(PICKERS), default=list(PICKERS))
+    args = parser.parse_args()
+
+    for policy in args.policies:
+        times, lost = list(), list()
+        for run in range(args.runs):
+            t, lost_at = simulate(policy, args, seed=run)
+            times += t
+            if lost_at is not None:
+                lost.append(lost_at)
+
+        if len(times) > 1:
+            deciles = statistics.quantiles(times, n=10)
+            summary = "median={:6.1f}  p90={:6.1f} ticks".format(statistics.median(times), deciles[-1])
+        else:
+            summary = "median={:>6}  p90={:>6} ticks".format("-", "-")
+
+        print("{:10} completed={:5}  {}  swarm lost a piece in {}/{} runs{}".format(
+            policy, len(times), summary, len(lost), args.runs,
+            " (at tick {:.0f} on average)".format(statistics.mean(lost)) if lost else ""
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Messages/sec of the wire-frame reader on a HAVE-heavy stream.
+
+A thread writes, on one end of a socketpair, a stream of HAVE messages
+(with a keep-alive every now and then, as a real peer would do); the
+other end is read both with the old recv(4)+recv(length) loop and with
+FrameBuffer.recv_from.
+
+    python benchmarks/framing.py --messages 500000
+"""
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import argparse
+import socket
+import threading
+import time
+
+import Fiume.utils as utils
+from Fiume.framing import FrameBuffer
+
+
+def make_stream(messages: int, keep_alive_every: int) -> bytes:
+    stream = bytearray()
+    for i in range(messages):
+        stream += utils.to_bytes(5, length=4) + bytes([4]) + utils.to_bytes(i % 5000, length=4)
+        if i % keep_alive_every == 0:
+            stream += bytes(4)
+    return bytes(stream)
+
+
+def read_recv(sock: socket.socket) -> int:
+    """ The old PeerManager.message_socket_receiver loop. """
+    received = 0
+    while True:
+        raw_length = sock.recv(4)
+        if raw_length == b"":
+            return received
+        length = int.from_bytes(raw_length, byteorder="big", signed=False)
+        if length == 0:
+            continue # the old code disconnected here
+
+        raw_mex = bytes()
+        while length != 0:
+            data = sock.recv(length)
+            raw_mex += data
+            length -= len(data)
+
+        mex = raw_length + raw_mex
+        utils.to_int(mex[5:9])
+        received += 1
+
+
+def read_frames(sock: socket.socket) -> int:
+    received = 0
+    frames = FrameBuffer(handshake=False)
+    while frames.recv_from(sock) > 0:
+        for mex in frames.messages():
+            utils.to_int(mex[5:9])
+            received += 1
+    return received
+
+
+def run(reader, stream: bytes, messages: int):
+    a, b = socket.socketpair()
+    sender = threading.Thread(target=lambda: (a.sendall(stream), a.close()))
+
+    start = time.perf_counter()
+    sender.start()
+    received = reader(b)
+    elapsed = time.perf_counter() - start
+    sender.join()
+    b.close()
+
+    assert received == messages, (received, messages)
+    print("{:12} {:9d} messages  {:6.2f}s  {:10.0f} messages/s".format(
+        reader.__name__, received, elapsed, received / elapsed
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=500000)
+    parser.add_argument("--keep-alive-every", type=int, default=1000)
+    args = parser.parse_args()
+
+    stream = make_stream(args.messages, args.keep_alive_every)
+    for reader in [read_recv, read_frames]:
+        run(reader, stream, args.messages)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Hashes/sec of piece verification.
+
+    inline       every piece is hashed, whole, by the thread that completed
+                 it (how PeerManager.verify_hash worked)
+    pool         complete pieces are verified by a Hasher with --workers
+                 threads
+    incremental  blocks are hashed by the Hasher as they arrive, in order:
+                 when the piece is complete only the tail is left; also
+                 reports how long the last block waits for the result
+
+    python benchmarks/hashing.py --pieces 256 --workers 1 2 4 8
+"""
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import argparse
+import hashlib
+import random
+import threading
+import time
+
+from Fiume.hasher import Hasher
+from Fiume.piece_buffer import PieceBuffer
+
+BLOCK_SIZE = 1 << 14
+
+
+def make_pieces(data: bytes, piece_size: int) -> list:
+    pieces = list()
+    for index, start in enumerate(range(0, len(data), piece_size)):
+        piece = PieceBuffer(index, piece_size, BLOCK_SIZE)
+        piece.data[:] = data[start:start+piece_size]
+        piece.received[:] = bytes([1]) * len(piece.received)
+        piece.missing = 0
+        pieces.append(piece)
+    return pieces
+
+
+def report(name: str, pieces: int, piece_size: int, elapsed: float, extra=""):
+    print("{:16} {:6d} pieces  {:6.2f}s  {:9.1f} hashes/s  {:8.1f} MB/s{}".format(
+        name, pieces, elapsed, pieces / elapsed, pieces * piece_size / elapsed / 1e6, extra
+    ))
+
+
+def run_inline(data: bytes, piece_size: int, hashes: list):
+    start = time.perf_counter()
+    for i, offset in enumerate(range(0, len(data), piece_size)):
+        assert hashlib.sha1(data[offset:offset+piece_size]).digest() == hashes[i]
+    report("inline", len(hashes), piece_size, time.perf_counter() - start)
+
+
+def run_pool(data: bytes, piece_size: int, hashes: list, workers: int):
+    pieces = make_pieces(data, piece_size)
+    hasher = Hasher(workers)
+    done = threading.Semaphore(0)
+
+    def callback(piece, ok):
+        assert ok, piece
+        done.release()
+
+    start = time.perf_counter()
+    for piece in pieces:
+        hasher.verify(piece, hashes[piece.index], callback)
+    for _ in pieces:
+        done.acquire()
+    report("pool x{}".format(workers), len(pieces), piece_size, time.perf_counter() - start)
+    hasher.close()
+
+
+def run_incremental(data: bytes, piece_size: int, hashes: list, workers: int):
+    """
+    Pieces are filled block by block, a few at a time (as many peers do):
+    the hasher keeps up with the blocks, in background.
+    """
+    hasher = Hasher(workers)
+    results = list()
+    lock = threading.Lock()
+    all_done = threading.Event()
+    num_pieces = len(hashes)
+
+    def callback(piece, ok):
+        assert ok, piece
+        with lock:
+            results.append(time.perf_counter() - piece.completed_at)
+            if len(results) == num_pieces:
+                all_done.set()
+
+    start = time.perf_counter()
+    for index, offset in enumerate(range(0, len(data), piece_size)):
+        piece = PieceBuffer(index, piece_size, BLOCK_SIZE)
+        for block in range(0, piece_size, BLOCK_SIZE):
+            piece.write(block, data[offset+block:offset+block+BLOCK_SIZE])
+            hasher.update(piece)
+        piece.completed_at = time.perf_counter()
+        hasher.verify(piece, hashes[index], callback)
+
+    all_done.wait()
+    report(
+        "incremental x{}".format(workers), num_pieces, piece_size, time.perf_counter() - start,
+        "  tail latency {:.2f} ms".format(1000 * sum(results) / len(results))
+    )
+    hasher.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pieces", type=int, default=256)
+    parser.add_argument("--piece-size", type=int, default=1 << 20, help="bytes")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    data = random.randbytes(args.pieces * args.piece_size)
+    hashes = [
+        hashlib.sha1(data[i:i+args.piece_size]).digest()
+        for i in range(0, len(data), args.piece_size)
+    ]
+
+    run_inline(data, args.piece_size, hashes)
+    for workers in args.workers:
+        run_pool(data, args.piece_size, hashes, workers)
+    for workers in args.workers:
+        run_incremental(data, args.piece_size, hashes, workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+Compares the asyncio peer engine with the thread-per-peer fallback.
+
+A ThreadedServer seeds a small random torrent on loopback; hundreds of
+leechers connect at once, do HANDSHAKE/INTERESTED/UNCHOKE and request
+some blocks each. Every engine runs in a fresh process, so that thread
+counts and CPU times are not polluted by the other run.
+
+    python benchmarks/peer_engine.py --peers 300 --blocks 4
+"""
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import argparse
+import asyncio
+import logging
+import random
+import subprocess
+import tempfile
+import threading
+import time
+
+from queue import Queue
+
+import bencodepy
+
+import Fiume.metainfo_decoder as md
+import Fiume.state_machine as sm
+import Fiume.utils as utils
+from Fiume.bitfield import Bitfield
+import Fiume.resume as resume
+
+PIECE_SIZE = 16384
+
+
+class NoTrackers:
+    """ The benchmark swarm lives on loopback only. """
+    def __init__(self):
+        self.queue_for_new_peers = Queue()
+
+    def cached_peers(self):
+        return []
+
+    def start(self):
+        pass
+
+    def notify_completion(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def make_seeder(engine: str, num_pieces: int, workdir: Path) -> sm.ThreadedServer:
+    data = random.randbytes(PIECE_SIZE * num_pieces)
+    output_file = workdir / "bench-{}.bin".format(engine)
+    output_file.write_bytes(data)
+
+    info = {
+        b"name": output_file.name.encode(),
+        b"piece length": PIECE_SIZE,
+        b"length": len(data),
+        b"pieces": b"".join(
+            utils.sha1(data[i:i+PIECE_SIZE]) for i in range(0, len(data), PIECE_SIZE)
+        ),
+    }
+    options = {
+        "port": 0,
+        "output_file": output_file,
+        "timeout": 30,
+        "max_peer_connections": 1024,
+        "max_concurrent_pieces": 5,
+        "peer_engine": engine,
+        "debug_level": logging.CRITICAL,
+    }
+    metainfo = md.MetaInfo(
+        {b"announce": b"http://localhost/announce", b"info": info} | options
+    )
+    resume.ResumeFile(
+        utils.get_bitmap_file(output_file), Bitfield.full(num_pieces), metainfo.info_hash
+    ).save()
+
+    return sm.ThreadedServer(metainfo, NoTrackers(), **options)
+
+
+async def read_frame(reader: asyncio.StreamReader) -> bytes:
+    length = utils.to_int(await reader.readexactly(4))
+    return await reader.readexactly(length)
+
+
+async def leecher(port: int, info_hash: bytes, num_pieces: int, blocks: int):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(
+        utils.HANDSHAKE_PREAMBLE + bytes(8) + info_hash + utils.generate_peer_id()
+    )
+    await reader.readexactly(68)
+    await read_frame(reader) # BITFIELD
+
+    writer.write(utils.to_bytes(1, length=4) + utils.to_bytes(sm.MexType.INTERESTED.value))
+    while (await read_frame(reader))[0] != sm.MexType.UNCHOKE.value:
+        pass
+
+    for _ in range(blocks):
+        piece = random.randrange(num_pieces)
+        writer.write(
+            utils.to_bytes(13, length=4) + utils.to_bytes(sm.MexType.REQUEST.value) +
+            utils.to_bytes(piece, length=4) + utils.to_bytes(0, length=4) +
+            utils.to_bytes(PIECE_SIZE, length=4)
+        )
+        while (await read_frame(reader))[0] != sm.MexType.PIECE.value:
+            pass # HAVEs, keep-alives...
+
+    writer.close()
+
+
+def run_one(engine: str, peers: int, blocks: int, num_pieces: int):
+    logging.disable(logging.CRITICAL)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        seeder = make_seeder(engine, num_pieces, Path(workdir))
+        seeder.main()
+        time.sleep(0.2) # let the listening socket come up
+
+        max_threads = threading.active_count()
+        done = threading.Event()
+
+        def sample_threads():
+            nonlocal max_threads
+            while not done.wait(0.05):
+                max_threads = max(max_threads, threading.active_count())
+
+        threading.Thread(target=sample_threads, daemon=True).start()
+
+        async def swarm():
+            await asyncio.gather(*[
+                leecher(seeder.port, seeder.metainfo.info_hash, num_pieces, blocks)
+                for _ in range(peers)
+            ])
+
+        cpu_start, wall_start = time.process_time(), time.perf_counter()
+        asyncio.run(swarm())
+        cpu, wall = time.process_time() - cpu_start, time.perf_counter() - wall_start
+        done.set()
+        seeder.master_queue.put(utils.M_KILL())
+
+    served = peers * blocks
+    print("{:8} peers={:<5} wall={:6.2f}s  cpu={:6.2f}s  blocks/s={:9.1f}  MB/s={:7.2f}  max_threads={}".format(
+        engine, peers, wall, cpu, served / wall, served * PIECE_SIZE / wall / 2**20, max_threads
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--peers", type=int, default=300)
+    parser.add_argument("--blocks", type=int, default=4, help="blocks requested by each leecher")
+    parser.add_argument("--pieces", type=int, default=64)
+    parser.add_argument("--engine", choices=["asyncio", "threads"], default=None,
+                        help="run only this engine, in this process")
+    args = parser.parse_args()
+
+    if args.engine is not None:
+        run_one(args.engine, args.peers, args.blocks, args.pieces)
+        return
+
+    for engine in ["threads", "asyncio"]:
+        subprocess.run(
+            [sys.executable, __file__, "--engine", engine,
+             "--peers", str(args.peers), "--blocks", str(args.blocks),
+             "--pieces", str(args.pieces)],
+            check=True
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Startup recheck of an existing download file, in MB/s.
+
+    sequential   one thread reads and hashes the file, piece by piece
+    pool         Fiume.recheck with --workers threads over an mmap
+
+The file is written once and read from the page cache: the numbers are
+the hashing throughput (a cold disk is read at its own speed anyway).
+
+    python benchmarks/recheck.py --size 512 --workers 1 2 4 8
+"""
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import argparse
+import hashlib
+import random
+import tempfile
+import time
+
+from Fiume.recheck import recheck
+
+
+def report(name: str, size: int, elapsed: float):
+    print("{:16} {:8.0f} MB  {:6.2f}s  {:8.1f} MB/s".format(
+        name, size / 1e6, elapsed, size / elapsed / 1e6
+    ))
+
+
+def run_sequential(path: Path, piece_size: int, hashes: list, size: int):
+    start = time.perf_counter()
+    present = 0
+    with open(path, "rb") as f:
+        for expected in hashes:
+            present += hashlib.sha1(f.read(piece_size)).digest() == expected
+    assert present == len(hashes)
+    report("sequential", size, time.perf_counter() - start)
+
+
+def run_pool(path: Path, piece_size: int, hashes: list, size: int, workers: int):
+    start = time.perf_counter()
+    bitmap = recheck(path, piece_size, hashes, size, workers=workers)
+    assert bitmap.complete
+    report("pool x{}".format(workers), size, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=512, help="MB")
+    parser.add_argument("--piece-size", type=int, default=1 << 20, help="bytes")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    size = args.size * (1 << 20)
+    hashes = list()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir) / "data"
+        with open(path, "wb") as f:
+            for _ in range(0, size, args.piece_size):
+                piece = random.randbytes(args.piece_size)
+                hashes.append(hashlib.sha1(piece).digest())
+                f.write(piece)
+
+        run_sequential(path, args.piece_size, hashes, size)
+        for workers in args.workers:
+            run_pool(path, args.piece_size, hashes, size, workers)
+
+
+if __name__ == "__main__":
+    main()
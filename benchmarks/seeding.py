@@ -0,0 +1,213 @@
+"""
+Upload throughput and CPU cost of serving PIECEs, for each seeding path.
+
+    master    REQUESTs go through the master, which reads the whole piece
+              and passes it to the peer manager (how it worked before
+              peer managers could read the storage)
+    copy      the peer manager reads the piece from storage, through the
+              shared piece cache, and sends the block
+    sendfile  the block goes from the file to the socket with sendfile
+
+The seeder runs in a child process, so that its CPU time (user + system,
+as sendfile moves the work into the kernel) is measured alone; leechers
+live in this process and keep many requests in flight.
+
+    python benchmarks/seeding.py --size 64 --rounds 4
+"""
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import resource
+import subprocess
+import tempfile
+import time
+
+from queue import Queue
+
+import Fiume.metainfo_decoder as md
+import Fiume.state_machine as sm
+import Fiume.utils as utils
+from Fiume.bitfield import Bitfield
+import Fiume.resume as resume
+
+PIECE_SIZE = 1 << 18
+BLOCK_SIZE = 1 << 14
+MODES = ["master", "copy", "sendfile"]
+
+
+class NoTrackers:
+    """ The benchmark swarm lives on loopback only. """
+    def __init__(self):
+        self.queue_for_new_peers = Queue()
+
+    def cached_peers(self):
+        return []
+
+    def start(self):
+        pass
+
+    def notify_completion(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def serve(mode: str, engine: str, size: int, workdir: Path):
+    """ Child process: seeds until stdin is closed. """
+    logging.disable(logging.CRITICAL)
+
+    data = random.randbytes(size)
+    output_file = workdir / "seed-{}.bin".format(mode)
+    output_file.write_bytes(data)
+    num_pieces = len(range(0, size, PIECE_SIZE))
+
+    info = {
+        b"name": output_file.name.encode(),
+        b"piece length": PIECE_SIZE,
+        b"length": size,
+        b"pieces": b"".join(
+            utils.sha1(data[i:i+PIECE_SIZE]) for i in range(0, size, PIECE_SIZE)
+        ),
+    }
+    options = {
+        "port": 0,
+        "output_file": output_file,
+        "timeout": 60,
+        "max_peer_connections": 64,
+        "peer_engine": engine,
+        "sendfile": mode == "sendfile",
+        "debug_level": logging.CRITICAL,
+    }
+    metainfo = md.MetaInfo(
+        {b"announce": b"http://localhost/announce", b"info": info} | options
+    )
+    resume.ResumeFile(
+        utils.get_bitmap_file(output_file), Bitfield.full(num_pieces), metainfo.info_hash
+    ).save()
+
+    seeder = sm.ThreadedServer(metainfo, NoTrackers(), **options)
+    if mode == "master":
+        seeder.storage = None # peer managers will ask the master
+    seeder.main()
+
+    print(seeder.port, num_pieces, seeder.metainfo.info_hash.hex(), flush=True)
+    sys.stdin.read()
+    seeder.master_queue.put(utils.M_KILL())
+    os._exit(0)
+
+
+async def read_frame(reader: asyncio.StreamReader) -> bytes:
+    length = utils.to_int(await reader.readexactly(4))
+    return await reader.readexactly(length)
+
+
+async def leecher(port: int, info_hash: bytes, blocks: list, depth: int) -> int:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(
+        utils.HANDSHAKE_PREAMBLE + bytes(8) + info_hash + utils.generate_peer_id()
+    )
+    await reader.readexactly(68)
+    await read_frame(reader) # BITFIELD
+
+    writer.write(utils.to_bytes(1, length=4) + utils.to_bytes(sm.MexType.INTERESTED.value))
+    while (await read_frame(reader))[0] != sm.MexType.UNCHOKE.value:
+        pass
+
+    def request(piece, offset):
+        writer.write(
+            utils.to_bytes(13, length=4) + utils.to_bytes(sm.MexType.REQUEST.value) +
+            utils.to_bytes(piece, length=4) + utils.to_bytes(offset, length=4) +
+            utils.to_bytes(BLOCK_SIZE, length=4)
+        )
+
+    received, pending = 0, iter(blocks)
+    for block in [next(pending) for _ in range(min(depth, len(blocks)))]:
+        request(*block)
+
+    while received < len(blocks):
+        mex = await read_frame(reader)
+        if mex[0] != sm.MexType.PIECE.value:
+            continue
+        received += 1
+        block = next(pending, None)
+        if block is not None:
+            request(*block)
+
+    writer.close()
+    return received * BLOCK_SIZE
+
+
+def run(mode: str, args):
+    with tempfile.TemporaryDirectory() as workdir:
+        child = subprocess.Popen(
+            [sys.executable, __file__, "--serve", mode, "--engine", args.engine,
+             "--size", str(args.size), "--workdir", workdir],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
+        )
+        port, num_pieces, info_hash = child.stdout.readline().split()
+        port, num_pieces, info_hash = int(port), int(num_pieces), bytes.fromhex(info_hash)
+
+        blocks = [(p, o) for p in range(num_pieces) for o in range(0, PIECE_SIZE, BLOCK_SIZE)]
+
+        async def swarm():
+            sizes = await asyncio.gather(*[
+                leecher(port, info_hash, random.sample(blocks, len(blocks)) * args.rounds, args.depth)
+                for _ in range(args.peers)
+            ])
+            return sum(sizes)
+
+        start = time.perf_counter()
+        sent = asyncio.run(swarm())
+        wall = time.perf_counter() - start
+
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        child.stdin.close()
+        child.wait()
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    # The child's CPU time is known only when it exits: it includes
+    # the setup (hashing the data), which is measured apart
+    cpu_user, cpu_sys = after.ru_utime - before.ru_utime, after.ru_stime - before.ru_stime
+    return sent, wall, cpu_user, cpu_sys
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=64, help="MB seeded")
+    parser.add_argument("--rounds", type=int, default=4, help="times every block is requested")
+    parser.add_argument("--peers", type=int, default=4)
+    parser.add_argument("--depth", type=int, default=32, help="requests in flight per leecher")
+    parser.add_argument("--engine", choices=["asyncio", "threads"], default="asyncio")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    parser.add_argument("--serve", choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", type=Path, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    size = args.size * 2**20
+    if args.serve is not None:
+        serve(args.serve, args.engine, size, args.workdir)
+        return
+
+    # Baseline: the cost of starting the seeder and doing nothing
+    args_idle = argparse.Namespace(**vars(args) | {"rounds": 0})
+    _, _, idle_user, idle_sys = run("copy", args_idle)
+
+    for mode in args.modes:
+        sent, wall, cpu_user, cpu_sys = run(mode, args)
+        cpu_user, cpu_sys = max(0, cpu_user - idle_user), max(0, cpu_sys - idle_sys)
+        gb = sent / 2**30
+        print("{:9} {:6} sent={:7.1f}MB  {:8.1f} MB/s  cpu/GB: user={:5.2f}s sys={:5.2f}s total={:5.2f}s".format(
+            mode, args.engine, sent / 2**20, sent / 2**20 / wall,
+            cpu_user / gb, cpu_sys / gb, (cpu_user + cpu_sys) / gb
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -46,7 +46,7 @@ setup(
     packages=find_packages(),
     # package_dir={"": "Fiume"},
     install_requires=[
-        "pathos", "requests", "bencode.py"
+        "requests", "bencode.py"
     ],
     include_package_data=True,
     cmdclass={ #specifica azioni da intraprendere post-installazione
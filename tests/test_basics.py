@@ -4,6 +4,8 @@ import threading
 import time
 import random
 
+from unittest.mock import patch, Mock
+
 import Fiume.utils as utils
 # import Fiume.state_machine as sm
 
@@ -35,3 +37,39 @@ class BasicsTestCase(unittest.TestCase):
                     num_pieces=num_pieces
                 )
             )
+
+
+class ExternalIPTestCase(unittest.TestCase):
+    def setUp(self):
+        # A new session
+        for name, value in [("_external_ip", None), ("_external_ip_lookup", None),
+                            ("_external_ip_known", threading.Event())]:
+            patcher = patch.object(utils, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_looked_up_once_in_background(self):
+        answered = threading.Event()
+
+        def slow_get(*args, **kwargs):
+            answered.wait(2)
+            return Mock(text="1.2.3.4\n")
+
+        with patch("requests.get", side_effect=slow_get) as get:
+            self.assertIsNone(utils.get_external_ip()) # does not wait
+            answered.set()
+            self.assertEqual(utils.get_external_ip(wait=None), "1.2.3.4")
+            self.assertEqual(utils.get_external_ip(), "1.2.3.4")
+            get.assert_called_once()
+
+    def test_lookup_failure(self):
+        with patch("requests.get", side_effect=OSError("unreachable")) as get:
+            self.assertIsNone(utils.get_external_ip(wait=None))
+            self.assertIsNone(utils.get_external_ip(wait=None))
+            get.assert_called_once()
+
+    def test_override(self):
+        with patch("requests.get") as get:
+            utils.set_external_ip("5.6.7.8")
+            self.assertEqual(utils.get_external_ip(), "5.6.7.8")
+            get.assert_not_called()
@@ -0,0 +1,88 @@
+import unittest
+import random
+
+from Fiume.bitfield import Bitfield
+
+
+class BitfieldTests(unittest.TestCase):
+    def random_bools(self, n):
+        return [bool(random.randint(0, 1)) for _ in range(n)]
+
+    def test_same_as_list(self):
+        for _ in range(100):
+            bools = self.random_bools(random.randint(0, 50))
+            bitfield = Bitfield.from_bools(bools)
+
+            self.assertEqual(list(bitfield), bools)
+            self.assertEqual(len(bitfield), len(bools))
+            self.assertEqual(bitfield.count(), sum(bools))
+            self.assertEqual(bitfield.complete, all(bools))
+            self.assertEqual(list(bitfield.indices()), [i for i, b in enumerate(bools) if b])
+            self.assertEqual(list(bitfield.indices(False)), [i for i, b in enumerate(bools) if not b])
+            self.assertEqual(Bitfield.from_string(bitfield.to_string()), bitfield)
+
+    def test_wire_format(self):
+        bitfield = Bitfield.from_bools([True, False, False, True, False, True, True, False, True])
+        self.assertEqual(bitfield.to_bytes(), bytes([150, 128]))
+        self.assertEqual(bytes(bitfield.view()), bytes([150, 128]))
+        self.assertEqual(Bitfield(9, bytes([150, 128])), bitfield)
+
+    def test_spare_bits_are_cleared(self):
+        bitfield = Bitfield(9, b"\xff\xff")
+        self.assertEqual(bitfield.to_bytes(), b"\xff\x80")
+        self.assertTrue(bitfield.complete)
+        self.assertEqual(list(Bitfield(9, b"\x00\x00").indices(False)), list(range(9)))
+
+    def test_wrong_length(self):
+        with self.assertRaises(ValueError):
+            Bitfield(9, b"\xff")
+        with self.assertRaises(ValueError):
+            Bitfield(9, b"\xff\xff\xff")
+
+    def test_count_is_kept_updated(self):
+        bitfield = Bitfield(10)
+        bitfield[3] = True
+        bitfield[3] = True
+        bitfield[-1] = True
+        self.assertEqual(bitfield.count(), 2)
+        self.assertTrue(bitfield[9])
+
+        bitfield[3] = False
+        bitfield[3] = False
+        self.assertEqual(bitfield.count(), 1)
+        self.assertFalse(bitfield.complete)
+
+        with self.assertRaises(IndexError):
+            bitfield[10] = True
+
+    def test_complete(self):
+        bitfield = Bitfield(3)
+        for i in range(3):
+            self.assertFalse(bitfield.complete)
+            bitfield[i] = True
+        self.assertTrue(bitfield.complete)
+        self.assertTrue(Bitfield.full(3).complete)
+        self.assertTrue(Bitfield(0).complete)
+
+    def test_set_operations(self):
+        a, b = self.random_bools(37), self.random_bools(37)
+        fa, fb = Bitfield.from_bools(a), Bitfield.from_bools(b)
+
+        self.assertEqual(list(fa & fb), [x and y for x, y in zip(a, b)])
+        self.assertEqual(list(fa | fb), [x or y for x, y in zip(a, b)])
+        self.assertEqual(list(fa - fb), [x and not y for x, y in zip(a, b)])
+        self.assertEqual((fa - fb).count(), sum(x and not y for x, y in zip(a, b)))
+
+        with self.assertRaises(ValueError):
+            fa & Bitfield(36)
+
+    def test_copy_is_independent(self):
+        bitfield = Bitfield(5)
+        copy = bitfield.copy()
+        copy[0] = True
+        self.assertFalse(bitfield[0])
+        self.assertEqual(bitfield.count(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
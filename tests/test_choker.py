@@ -0,0 +1,84 @@
+import unittest
+import random
+
+from types import SimpleNamespace
+
+from Fiume.choker import Choker
+
+
+def peer(rate=0.0, upload_rate=0.0, interested=True, unchoked_at=None, snubbed=False):
+    return SimpleNamespace(
+        rate=rate, upload_rate=upload_rate, interested=interested,
+        am_choking=unchoked_at is None, unchoked_at=unchoked_at, snubbed=snubbed
+    )
+
+
+class ChokerTests(unittest.TestCase):
+    def setUp(self):
+        self.choker = Choker(upload_slots=3, rng=random.Random(0))
+
+    def test_tit_for_tat(self):
+        peers = {i: peer(rate=i * 100) for i in range(6)}
+        peers[5].interested = False
+
+        unchoked = self.choker.round(peers, seeding=False, now=0)
+        self.assertEqual(len(unchoked), 3)
+        # The two fastest interested peers, plus a random one
+        self.assertTrue({4, 3} <= unchoked)
+        self.assertIn(self.choker.optimistic, {0, 1, 2})
+        self.assertNotIn(5, unchoked)
+
+    def test_snubbing_peers_are_not_reciprocated(self):
+        peers = {i: peer(rate=i * 100) for i in range(4)}
+        peers[3].snubbed = True # fast, once
+
+        for now in range(0, 300, 10):
+            unchoked = self.choker.round(peers, seeding=False, now=now)
+            self.assertTrue({2, 1} <= unchoked)
+            if 3 in unchoked:
+                self.assertEqual(self.choker.optimistic, 3)
+
+    def test_optimistic_unchoke_rotates(self):
+        peers = {i: peer(rate=0 if i > 1 else 1000) for i in range(20)}
+
+        optimistic = self.choker.optimistic
+        seen = set()
+        for now in range(0, 300, 10):
+            self.choker.round(peers, seeding=False, now=now)
+            if self.choker.optimistic != optimistic:
+                # Kept for 30 seconds at least
+                self.assertEqual(now % 30, 0)
+                optimistic = self.choker.optimistic
+            seen.add(optimistic)
+
+        self.assertGreater(len(seen), 3)
+        self.assertTrue({0, 1}.isdisjoint(seen))
+
+    def test_everyone_fits(self):
+        peers = {i: peer() for i in range(2)}
+        self.assertEqual(self.choker.round(peers, seeding=False, now=0), {0, 1})
+        self.assertTrue(self.choker.has_free_slot(peers))
+
+        peers[0].am_choking = peers[1].am_choking = False
+        self.assertTrue(self.choker.has_free_slot(peers))
+        peers[2] = peer(unchoked_at=0)
+        self.assertFalse(self.choker.has_free_slot(peers))
+
+    def test_seeding_is_round_robin(self):
+        # Peers 0 and 1 are the fastest to upload to, but had their turn
+        peers = {
+            0: peer(upload_rate=900, unchoked_at=0),
+            1: peer(upload_rate=800, unchoked_at=0),
+            2: peer(upload_rate=100),
+            3: peer(upload_rate=50),
+        }
+        unchoked = self.choker.round(peers, seeding=True, now=30)
+        self.assertTrue({2, 3} <= unchoked)
+
+        # Before their turn is over, they come first
+        unchoked = Choker(upload_slots=3).round(peers, seeding=True, now=10)
+        self.assertTrue({0, 1} <= unchoked)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import socket
+import unittest
+
+import Fiume.utils as utils
+from Fiume.framing import FrameBuffer
+
+HANDSHAKE = utils.HANDSHAKE_PREAMBLE + bytes(8) + bytes(20) + bytes(20)
+
+
+def have(piece: int) -> bytes:
+    return utils.to_bytes(5, length=4) + bytes([4]) + utils.to_bytes(piece, length=4)
+
+KEEP_ALIVE = bytes(4)
+
+
+class FrameBufferTests(unittest.TestCase):
+    def test_split_messages(self):
+        frames = FrameBuffer()
+        frames.feed(HANDSHAKE + have(1) + KEEP_ALIVE + have(2) + have(3)[:3])
+
+        self.assertEqual([bytes(m) for m in frames.messages()], [HANDSHAKE, have(1), have(2)])
+        self.assertEqual(frames.keep_alives, 1)
+
+        frames.feed(have(3)[3:])
+        self.assertEqual([bytes(m) for m in frames.messages()], [have(3)])
+        self.assertEqual(len(frames), 0)
+
+    def test_byte_by_byte(self):
+        stream = have(7) + KEEP_ALIVE + have(8)
+        frames = FrameBuffer(handshake=False)
+        received = list()
+
+        for i in range(len(stream)):
+            frames.feed(stream[i:i+1])
+            received += [bytes(m) for m in frames.messages()]
+
+        self.assertEqual(received, [have(7), have(8)])
+
+    def test_grows_for_long_messages(self):
+        piece = utils.to_bytes(9 + 1000, length=4) + bytes([7]) + bytes(8) + bytes(range(250)) * 4
+        frames = FrameBuffer(size=64, handshake=False)
+
+        for i in range(0, len(piece), 50):
+            frames.feed(piece[i:i+50])
+            messages = [bytes(m) for m in frames.messages()]
+
+        self.assertEqual(messages, [piece])
+
+    def test_too_long(self):
+        frames = FrameBuffer(max_message=100, handshake=False)
+        frames.feed(utils.to_bytes(1000, length=4))
+        with self.assertRaises(ValueError):
+            list(frames.messages())
+
+    def test_recv_from(self):
+        a, b = socket.socketpair()
+        with a, b:
+            a.sendall(have(1) + have(2) + KEEP_ALIVE)
+            a.close()
+
+            frames = FrameBuffer(handshake=False)
+            received = list()
+            while frames.recv_from(b) > 0:
+                received += [bytes(m) for m in frames.messages()]
+
+        self.assertEqual(received, [have(1), have(2)])
+        self.assertEqual(frames.keep_alives, 1)
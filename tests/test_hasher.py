@@ -0,0 +1,62 @@
+import unittest
+import hashlib
+import random
+import threading
+
+from unittest.mock import patch
+
+from Fiume.hasher import Hasher
+from Fiume.piece_buffer import PieceBuffer
+
+BLOCK = 16384
+
+
+class HasherTests(unittest.TestCase):
+    def setUp(self):
+        self.hasher = Hasher(workers=4)
+        self.addCleanup(self.hasher.close)
+
+    def verify(self, piece: PieceBuffer, expected: bytes) -> bool:
+        results = list()
+        done = threading.Event()
+
+        def callback(p, ok):
+            results.append((p, ok))
+            done.set()
+
+        self.hasher.verify(piece, expected, callback)
+        self.assertTrue(done.wait(5))
+        self.assertIs(results[0][0], piece)
+        return results[0][1]
+
+    def test_incremental_hash(self):
+        data = random.randbytes(10 * BLOCK - 100)
+        piece = PieceBuffer(0, len(data), BLOCK)
+
+        # In order, except for the last blocks
+        offsets = list(range(0, len(data), BLOCK))
+        for offset in offsets[:7] + offsets[:6:-1]:
+            piece.write(offset, data[offset:offset+BLOCK])
+            self.hasher.update(piece)
+
+        self.assertTrue(self.verify(piece, hashlib.sha1(data).digest()))
+        self.assertEqual(self.hasher.verified, 1)
+
+    def test_mismatch(self):
+        piece = PieceBuffer(0, BLOCK, BLOCK)
+        piece.write(0, bytes(BLOCK))
+        self.assertFalse(self.verify(piece, hashlib.sha1(b"something else").digest()))
+        self.assertEqual(self.hasher.failed, 1)
+
+    def test_hashing_error_is_a_mismatch(self):
+        # The piece is downloaded again, instead of waiting forever
+        piece = PieceBuffer(0, BLOCK, BLOCK)
+        piece.write(0, bytes(BLOCK))
+        with patch.object(piece, "digest", side_effect=MemoryError), \
+             self.assertLogs("Hasher", "ERROR"):
+            self.assertFalse(self.verify(piece, hashlib.sha1(bytes(BLOCK)).digest()))
+        self.assertEqual(self.hasher.failed, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
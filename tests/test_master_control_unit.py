@@ -5,6 +5,7 @@ from hashlib import sha1
 
 import unittest
 import random
+import time
 import tempfile
 
 from Fiume.utils import *
@@ -24,6 +25,7 @@ class PeerHasEverything(unittest.TestCase):
 
         self.metainfo = Mock(
             piece_size=piece_size,
+            block_size=16384,
             piece_number=piece_number,
             download_fpath=Path(self.file.name),
             pieces_hash = self.hashes
@@ -35,7 +37,7 @@ class PeerHasEverything(unittest.TestCase):
         self.peer2 = Mock(address=("localhost", 50155), queue_in=Queue())
         self.peer3 = Mock(address=("localhost", 50157), queue_in=Queue())
 
-        self.initial_bitmap = [False for _ in range(piece_number)]
+        self.initial_bitmap = Bitfield(piece_number)
         
         self.mcu = master.MasterControlUnit(
             self.metainfo,
@@ -178,12 +180,11 @@ class PeerHasEverything(unittest.TestCase):
         # A peer reserves for itself all the pieces
         self.send_mcu(M_PEER_HAS(list(range(100)), self.peer.address, schedule_new_pieces=100))
 
-        # A new peer tries to connect and ask for pieces, but
-        # peer1 has already scheduled all the pieces; as a result,
-        # no piece is scheduled for peer2
+        # Two new peers connect, but don't ask for pieces yet
+        # (otherwise they would help peer1 with its pieces)
         self.mcu.add_connection_to(self.peer2)
         self.get_mex(self.peer2) # M_out_bitmap mex
-        self.send_mcu(M_PEER_HAS(list(range(100)), self.peer2.address))
+        self.send_mcu(M_PEER_HAS(list(range(100)), self.peer2.address, schedule_new_pieces=0))
         self.assertEqual(
             self.get_mex(self.peer2).pieces_index,
             []
@@ -191,7 +192,7 @@ class PeerHasEverything(unittest.TestCase):
 
         self.mcu.add_connection_to(self.peer3)
         self.get_mex(self.peer3) # M_out_bitmap mex
-        self.send_mcu(M_PEER_HAS(list(range(50)), self.peer3.address))
+        self.send_mcu(M_PEER_HAS(list(range(50)), self.peer3.address, schedule_new_pieces=0))
         self.assertEqual(
             self.get_mex(self.peer3).pieces_index,
             []
@@ -231,7 +232,26 @@ class PeerHasEverything(unittest.TestCase):
             set(range(99))
         )
 
-        
+    def test_messages_after_disconnection_are_dropped(self):
+        """
+        A peer manager may send messages after its M_DISCONNECTED:
+        the master ignores them, and keeps serving the other peers.
+        """
+        self.get_mex(self.peer) # M_out_bitmap mex
+
+        self.send_mcu(M_DISCONNECTED(self.peer.address))
+        self.send_mcu(M_PEER_HAS(list(range(100)), self.peer.address, schedule_new_pieces=10))
+        self.send_mcu(M_PIECE(0, self.data[0], self.peer.address))
+
+        self.mcu.add_connection_to(self.peer2)
+        self.get_mex(self.peer2) # M_out_bitmap mex
+        self.send_mcu(M_PEER_HAS(list(range(100)), self.peer2.address, schedule_new_pieces=10))
+
+        mex = self.get_mex(self.peer2)
+        self.assertIsInstance(mex, M_SCHEDULE)
+        self.assertEqual(len(mex.pieces_index), 10)
+
+
     def test_block_request(self):
         """ 
         Tests peer's requests for blocks.
@@ -311,7 +331,7 @@ class PeerHasEverything(unittest.TestCase):
 
         self.mcu.add_connection_to(self.peer2)
         self.get_mex(self.peer2) # M_out_bitmap mex
-        self.send_mcu(M_PEER_HAS(list(range(25)), self.peer2.address))
+        self.send_mcu(M_PEER_HAS(list(range(25)), self.peer2.address, schedule_new_pieces=0))
         self.assertEqual(
             self.get_mex(self.peer2).pieces_index,
             []
@@ -337,3 +357,376 @@ class PeerHasEverything(unittest.TestCase):
         self.assertEqual(m.data, self.data[99])
 
         self.tracker_manager.notify_completion.assert_called()
+
+    def test_rarest_pieces_first(self):
+        """
+        Peer1 has all the pieces, peer2 only [0..50]: pieces [50..100]
+        are rarer, and are scheduled first to peer1.
+        """
+        self.get_mex(self.peer) # M_out_bitmap mex
+
+        self.mcu.add_connection_to(self.peer2)
+        self.get_mex(self.peer2) # M_out_bitmap mex
+        self.send_mcu(M_PEER_HAS(list(range(50)), self.peer2.address, schedule_new_pieces=0))
+        self.get_mex(self.peer2)
+
+        self.send_mcu(M_PEER_HAS(list(range(100)), self.peer.address, schedule_new_pieces=10))
+        scheduled = self.get_mex(self.peer).pieces_index
+        self.assertEqual(len(scheduled), 10)
+        self.assertTrue(all(x >= 50 for x in scheduled), scheduled)
+
+        # HAVEs already known are not counted twice
+        self.send_mcu(M_PEER_HAS([0], self.peer2.address, schedule_new_pieces=0))
+        self.get_mex(self.peer2)
+        self.assertEqual(self.mcu.picker.availability[0], 2)
+
+        # When peer2 leaves, pieces [0..50] are as rare as the others
+        self.send_mcu(M_DISCONNECTED(self.peer2.address))
+        self.get_mex(self.peer2) # M_KILL
+        self.send_mcu(M_PEER_HAS([], self.peer.address, schedule_new_pieces=0))
+        self.get_mex(self.peer)
+        self.assertEqual(self.mcu.picker.availability[0], 1)
+        self.assertEqual(self.mcu.picker.availability[99], 1)
+
+    def test_scheduling_indexes_stay_consistent(self):
+        """
+        The incremental indexes always agree with what a full scan of
+        every connection would compute.
+        """
+        # A peer with no pieces: the only SCHEDULEs it receives are the
+        # answers to its own (empty) PEER_HAS
+        sync = Mock(address=("localhost", 50159), queue_in=Queue())
+        self.mcu.add_connection_to(sync)
+
+        def check():
+            # Waits for the master to process everything sent so far
+            self.send_mcu(M_PEER_HAS([], sync.address, schedule_new_pieces=1))
+            while not isinstance(self.get_mex(sync), M_SCHEDULE):
+                pass
+
+            for address, state in self.mcu.connections.items():
+                self.assertSetEqual(state.wanted, {
+                    p for p in state.peer_has
+                    if not self.mcu.bitmap[p] and p not in self.mcu.scheduled
+                })
+                for p in state.already_scheduled:
+                    self.assertIn(address, self.mcu.scheduled[p])
+                    self.assertIn(p, state.peer_has)
+            self.assertEqual(
+                sum(len(addresses) for addresses in self.mcu.scheduled.values()),
+                sum(len(s.already_scheduled) for s in self.mcu.connections.values())
+            )
+
+        self.mcu.add_connection_to(self.peer2)
+        self.mcu.add_connection_to(self.peer3)
+
+        self.send_mcu(M_PEER_HAS(list(range(0, 100, 2)), self.peer.address, schedule_new_pieces=20))
+        self.send_mcu(M_PEER_HAS(list(range(50)), self.peer2.address, schedule_new_pieces=20))
+        self.send_mcu(M_PEER_HAS(list(range(40, 100)), self.peer3.address, schedule_new_pieces=5))
+        check()
+
+        scheduled = list(self.mcu.connections[self.peer.address].already_scheduled)
+        for p in scheduled[:10]:
+            self.send_mcu(M_PIECE(p, self.data[p], self.peer.address, schedule_new_pieces=2))
+        check()
+
+        # Peer1 leaves: its pieces go to peers who have them
+        self.send_mcu(M_PEER_HAS([1, 3, 99], self.peer.address, schedule_new_pieces=0))
+        self.send_mcu(M_DISCONNECTED(self.peer.address))
+        check()
+        self.assertNotIn(self.peer.address, set().union(*self.mcu.scheduled.values()))
+        self.assertNotIn(self.peer.address, set().union(*self.mcu.owners.values()))
+
+    def test_idle_peers_share_pieces_in_flight(self):
+        """
+        When a peer has nothing new to download, it is given pieces
+        scheduled to others whose blocks are not all requested yet.
+        """
+        self.get_mex(self.peer) # M_OUR_BITMAP
+        self.send_mcu(M_PEER_HAS(list(range(100)), self.peer.address, schedule_new_pieces=100))
+        self.get_mex(self.peer)
+
+        # Peer1 requested every block of piece 3 already
+        self.mcu.piece_table.start(3, 256)
+        self.assertEqual(self.mcu.piece_table.claim(3, 10), [0])
+
+        self.mcu.add_connection_to(self.peer2)
+        self.get_mex(self.peer2) # M_OUR_BITMAP
+        self.send_mcu(M_PEER_HAS(list(range(10)), self.peer2.address, schedule_new_pieces=20))
+        shared = self.get_mex(self.peer2).pieces_index
+        self.assertCountEqual(shared, [0, 1, 2, 4, 5, 6, 7, 8, 9])
+        for p in shared:
+            self.assertEqual(self.mcu.scheduled[p], {self.peer.address, self.peer2.address})
+
+        # The first to complete a shared piece tells the other
+        self.send_mcu(M_PIECE(0, self.data[0], self.peer2.address, schedule_new_pieces=1))
+        self.assertEqual(self.get_mex(self.peer), M_NEW_HAVE(0))
+        self.assertNotIn(0, self.mcu.connections[self.peer.address].already_scheduled)
+
+    def test_endgame(self):
+        """
+        When few blocks are missing, the pieces in flight are scheduled
+        to every peer that has them; the first copy wins.
+        """
+        self.mcu.endgame_blocks = 99 # that is, after the first piece
+        self.mcu.add_connection_to(self.peer2)
+        self.get_mex(self.peer)  # M_OUR_BITMAP
+        self.get_mex(self.peer2) # M_OUR_BITMAP
+
+        self.send_mcu(M_PEER_HAS(list(range(100)), self.peer.address, schedule_new_pieces=100))
+        self.assertEqual(len(self.get_mex(self.peer).pieces_index), 100)
+        self.send_mcu(M_PEER_HAS(list(range(100)), self.peer2.address, schedule_new_pieces=0))
+        self.assertEqual(self.get_mex(self.peer2).pieces_index, [])
+
+        # The first piece starts the endgame: peer2 gets every piece left
+        self.send_mcu(M_PIECE(0, self.data[0], self.peer.address, schedule_new_pieces=1))
+        self.assertEqual(self.get_mex(self.peer2), M_NEW_HAVE(0))
+        duplicates = self.get_mex(self.peer2)
+        self.assertIsInstance(duplicates, M_SCHEDULE)
+        self.assertCountEqual(duplicates.pieces_index, range(1, 100))
+        self.assertEqual(self.get_mex(self.peer), M_SCHEDULE([]))
+        self.assertTrue(self.mcu.endgame)
+
+        # Peer2 completes piece 1 first: peer1 is told, and may abandon it
+        self.send_mcu(M_PIECE(1, self.data[1], self.peer2.address, schedule_new_pieces=1))
+        self.assertEqual(self.get_mex(self.peer), M_NEW_HAVE(1))
+        self.get_mex(self.peer2) # M_SCHEDULE
+
+        # ... or complete it anyway: nothing changes
+        self.send_mcu(M_PIECE(1, self.data[1], self.peer.address, schedule_new_pieces=1))
+        self.assertEqual(self.get_mex(self.peer), M_SCHEDULE([]))
+        self.assertTrue(self.peer2.queue_in.empty())
+        self.assertEqual(self.mcu.bitmap.count(), 2)
+        self.assertNotIn(1, self.mcu.connections[self.peer.address].already_scheduled)
+
+        # When peer2 leaves, peer1 is still downloading everything
+        self.send_mcu(M_DISCONNECTED(self.peer2.address))
+        self.assertEqual(self.get_mex(self.peer2), M_KILL())
+        self.send_mcu(M_PEER_HAS([], self.peer.address, schedule_new_pieces=0))
+        self.assertEqual(self.get_mex(self.peer), M_SCHEDULE([]))
+        self.assertEqual(set(self.mcu.scheduled), set(range(2, 100)))
+        for addresses in self.mcu.scheduled.values():
+            self.assertEqual(addresses, {self.peer.address})
+
+    def test_endgame_schedules_at_most_n(self):
+        self.mcu.add_connection_to(self.peer2)
+        self.get_mex(self.peer)  # M_OUR_BITMAP
+        self.get_mex(self.peer2) # M_OUR_BITMAP
+
+        self.send_mcu(M_PEER_HAS(list(range(100)), self.peer.address, schedule_new_pieces=100))
+        self.get_mex(self.peer)
+        self.send_mcu(M_PEER_HAS(list(range(100)), self.peer2.address, schedule_new_pieces=0))
+        self.get_mex(self.peer2)
+
+        self.mcu.endgame = True
+        self.assertEqual(len(self.mcu.schedule_for(self.peer2.address, n=5)), 5)
+        self.assertEqual(len(self.mcu.schedule_for(self.peer2.address, n=200)), 95)
+
+    def test_schedule_size_follows_rate(self):
+        """
+        Once their rate is known, fast peers are scheduled enough pieces
+        for schedule_horizon seconds, slow peers just one.
+        """
+        now = [0.0]
+        self.mcu.clock = lambda: now[0]
+        self.mcu.schedule_horizon = 1.0
+
+        fast_peer, slow_peer = self.peer2, self.peer3
+        for peer in [fast_peer, slow_peer]:
+            self.mcu.add_connection_to(peer)
+            self.get_mex(peer) # M_OUR_BITMAP
+
+        # Rates unknown: what the peer managers asked for
+        self.send_mcu(M_PEER_HAS(list(range(100)), fast_peer.address, schedule_new_pieces=2))
+        fast = self.get_mex(fast_peer).pieces_index
+        self.send_mcu(M_PEER_HAS(list(range(100)), slow_peer.address, schedule_new_pieces=2))
+        slow = self.get_mex(slow_peer).pieces_index
+        self.assertEqual((len(fast), len(slow)), (2, 2))
+
+        # In 2 seconds, the first downloads 20 pieces' worth, the other half a piece
+        now[0] = 2.0
+        self.send_mcu(M_PIECE(fast[0], self.data[fast[0]], fast_peer.address,
+                              schedule_new_pieces=1, downloaded=20*256))
+        self.assertEqual(len(self.get_mex(fast_peer).pieces_index), 10 - 1)
+        self.assertEqual(self.get_mex(slow_peer), M_NEW_HAVE(fast[0]))
+
+        self.send_mcu(M_PIECE(slow[0], self.data[slow[0]], slow_peer.address,
+                              schedule_new_pieces=1, downloaded=128))
+        self.assertEqual(self.get_mex(slow_peer).pieces_index, [])
+
+        self.assertEqual(self.mcu.connections[fast_peer.address].rate, 20 * 256 / 2)
+        self.assertEqual(self.mcu.connections[slow_peer.address].piece_latency, 2.0)
+
+    def test_upload_slots(self):
+        """
+        Interested peers are unchoked while there are free upload slots;
+        the others wait for the next choke round.
+        """
+        self.mcu.choker.upload_slots = 2
+        peers = [self.peer, self.peer2, self.peer3]
+        self.mcu.add_connection_to(self.peer2)
+        self.mcu.add_connection_to(self.peer3)
+        for peer in peers:
+            peer.uploaded = 0
+            self.get_mex(peer) # M_OUR_BITMAP
+            self.send_mcu(M_PEER_INTERESTED(peer.address, True))
+
+        self.assertEqual(self.get_mex(self.peer), M_UNCHOKE())
+        self.assertEqual(self.get_mex(self.peer2), M_UNCHOKE())
+
+        # A slot is freed, but peer3 waits for the round
+        self.send_mcu(M_PEER_INTERESTED(self.peer.address, False))
+        self.assertEqual(self.get_mex(self.peer), M_CHOKE())
+        self.assertTrue(self.peer3.queue_in.empty())
+
+        start = time.monotonic()
+        self.mcu.clock = lambda: start + self.mcu.choker.round_interval
+        self.send_mcu(M_PEER_HAS([], self.peer.address, schedule_new_pieces=0))
+        self.assertEqual(self.get_mex(self.peer), M_SCHEDULE([]))
+        self.assertEqual(self.get_mex(self.peer3), M_UNCHOKE())
+        self.assertTrue(self.peer2.queue_in.empty())
+
+    def test_streaming(self):
+        """
+        A reader at piece 50 gets pieces 50.. scheduled right away; when
+        late, they are scheduled to one more peer.
+        """
+        self.mcu.options["stream_window"] = 4
+        self.mcu.add_connection_to(self.peer2)
+        for peer in [self.peer, self.peer2]:
+            self.get_mex(peer) # M_OUR_BITMAP
+            self.send_mcu(M_PEER_HAS(list(range(100)), peer.address, schedule_new_pieces=0))
+            self.get_mex(peer) # M_SCHEDULE([])
+        self.mcu.connections[self.peer2.address].rate = 1000 # the fastest
+        self.peer.uploaded = self.peer2.uploaded = 0 # for the choker
+
+        self.send_mcu(M_STREAM_SEEK(50, rate=256))
+        for p in range(50, 54):
+            self.assertEqual(self.get_mex(self.peer2), M_SCHEDULE([p], urgent=True))
+        self.assertTrue(self.peer.queue_in.empty())
+
+        # Ten seconds later, the first pieces are late
+        start = time.monotonic()
+        self.mcu.clock = lambda: start + 10
+        self.send_mcu(M_STREAM_SEEK(50, rate=256))
+        self.send_mcu(M_PEER_HAS([], self.peer.address, schedule_new_pieces=0))
+        self.assertEqual(self.get_mex(self.peer), M_SCHEDULE([50], urgent=True))
+        self.get_mex(self.peer) # M_SCHEDULE([])
+        self.assertIn(50, self.mcu.piece_table.urgent)
+
+        # Then the window (what is left of it), then the usual picker
+        self.send_mcu(M_STREAM_SEEK(52, rate=256))
+        self.send_mcu(M_PEER_HAS([], self.peer.address, schedule_new_pieces=3))
+        self.assertEqual(self.get_mex(self.peer2), M_SCHEDULE([54], urgent=True))
+        self.assertEqual(self.get_mex(self.peer2), M_SCHEDULE([55], urgent=True))
+        self.assertNotIn(54, self.get_mex(self.peer).pieces_index)
+
+    def test_timed_out_pieces_are_rescheduled(self):
+        """
+        The pieces a peer manager gave up go to other peers that have
+        them; a peer snubbing us gets one piece at a time.
+        """
+        self.get_mex(self.peer) # M_OUR_BITMAP
+        self.send_mcu(M_PEER_HAS(list(range(10)), self.peer.address, schedule_new_pieces=3))
+        given_up = self.get_mex(self.peer).pieces_index
+        
+        for peer, pieces in [(self.peer2, range(10)), (self.peer3, [50])]:
+            self.mcu.add_connection_to(peer)
+            self.get_mex(peer) # M_OUR_BITMAP
+            self.send_mcu(M_PEER_HAS(list(pieces), peer.address, schedule_new_pieces=0))
+            self.get_mex(peer) # M_SCHEDULE([])
+
+        self.send_mcu(M_TIMED_OUT(given_up, self.peer.address, snubbed=True))
+        self.assertCountEqual(self.get_mex(self.peer2).pieces_index, given_up)
+        retry = self.get_mex(self.peer).pieces_index
+        self.assertEqual(len(retry), 1)
+        self.assertNotIn(retry[0], given_up)
+        for p in given_up:
+            self.assertEqual(self.mcu.scheduled[p], {self.peer2.address})
+        self.assertTrue(self.mcu.connections[self.peer.address].snubbed)
+
+        # Data again: no longer snubbed
+        self.send_mcu(M_PIECE(retry[0], self.data[retry[0]], self.peer.address, downloaded=256))
+        self.get_mex(self.peer2) # M_NEW_HAVE
+        self.get_mex(self.peer3) # M_NEW_HAVE
+        self.get_mex(self.peer) # M_SCHEDULE
+        self.assertFalse(self.mcu.connections[self.peer.address].snubbed)
+
+        # Nobody else has it: it comes back, later
+        self.send_mcu(M_PEER_HAS([], self.peer3.address, schedule_new_pieces=1))
+        self.assertEqual(self.get_mex(self.peer3), M_SCHEDULE([50]))
+        self.send_mcu(M_TIMED_OUT([50], self.peer3.address))
+        self.assertEqual(self.get_mex(self.peer3), M_SCHEDULE([50]))
+
+    def test_hash_failed_pieces_go_to_other_peers(self):
+        self.get_mex(self.peer) # M_OUR_BITMAP
+        self.send_mcu(M_PEER_HAS([7, 8], self.peer.address, schedule_new_pieces=1))
+        piece = self.get_mex(self.peer).pieces_index[0]
+
+        self.mcu.add_connection_to(self.peer2)
+        self.get_mex(self.peer2) # M_OUR_BITMAP
+        self.send_mcu(M_PEER_HAS([7, 8], self.peer2.address, schedule_new_pieces=0))
+        self.get_mex(self.peer2) # M_SCHEDULE([])
+
+        self.send_mcu(M_HASH_FAILED(piece, self.peer.address))
+        self.assertEqual(self.get_mex(self.peer2), M_SCHEDULE([piece]))
+        # Not even to help peer2
+        self.assertNotIn(piece, self.get_mex(self.peer).pieces_index)
+
+    def test_rechecked_pieces_are_announced(self):
+        self.get_mex(self.peer) # M_OUR_BITMAP
+        self.send_mcu(M_PEER_HAS([3, 4, 5], self.peer.address, schedule_new_pieces=1))
+        piece = self.get_mex(self.peer).pieces_index[0]
+
+        # Found by the recheck, even the one being downloaded
+        self.send_mcu(M_RECHECKED([piece, 50]))
+        self.send_mcu(M_RECHECKED([], done=True))
+        self.assertEqual(self.get_mex(self.peer), M_NEW_HAVE(piece))
+        self.assertEqual(self.get_mex(self.peer), M_NEW_HAVE(50))
+        self.assertTrue(self.mcu.bitmap[piece] and self.mcu.bitmap[50])
+        self.assertNotIn(piece, self.mcu.scheduled)
+
+
+class ConnectionStatusTests(unittest.TestCase):
+    def setUp(self):
+        self.state = master.ConnectionStatus(Mock(queue_in=Queue()), now=10.0)
+
+    def test_rate_is_an_ewma(self):
+        self.state.update_rate(1000, 11.0)
+        self.assertEqual(self.state.rate, 1000)
+
+        # Reports too close are merged
+        self.state.update_rate(500, 11.2)
+        self.assertEqual(self.state.rate, 1000)
+        self.state.update_rate(1500, 12.0)
+        alpha = master.ConnectionStatus.ALPHA
+        self.assertAlmostEqual(self.state.rate, alpha * 2000 + (1 - alpha) * 1000)
+
+    def test_rate_decays_without_data(self):
+        self.state.update_rate(1000, 11.0)
+        alpha = master.ConnectionStatus.ALPHA
+
+        self.state.decay_rate(12.0) # not stalled yet
+        self.assertEqual(self.state.rate, 1000)
+        self.state.decay_rate(11.0 + master.ConnectionStatus.STALL_INTERVAL)
+        self.assertAlmostEqual(self.state.rate, (1 - alpha) * 1000)
+        self.state.decay_rate(11.0 + 2 * master.ConnectionStatus.STALL_INTERVAL)
+        self.assertAlmostEqual(self.state.rate, (1 - alpha) ** 2 * 1000)
+
+        # Data again: the silence was accounted already
+        self.state.update_rate(1000, 22.0)
+        self.assertAlmostEqual(
+            self.state.rate, alpha * 1000 + (1 - alpha) ** 3 * 1000
+        )
+
+    def test_piece_latency(self):
+        self.state.scheduled_at[4] = 10.0
+        self.state.update_latency(4, 13.0)
+        self.assertEqual(self.state.piece_latency, 3.0)
+
+        # Pieces not scheduled for it (or completed elsewhere) don't count
+        self.state.scheduled_at[5] = 10.0
+        self.state.completed_piece(5)
+        self.state.update_latency(5, 20.0)
+        self.state.update_latency(6, 20.0)
+        self.assertEqual(self.state.piece_latency, 3.0)
@@ -0,0 +1,255 @@
+from unittest.mock import Mock, patch
+from queue import Queue
+from pathlib import *
+
+import unittest
+import random
+import socket
+import threading
+import tempfile
+import logging
+
+import bencodepy
+
+import Fiume.utils as utils
+from Fiume.bitfield import Bitfield
+import Fiume.resume as resume
+import Fiume.metainfo_decoder as md
+import Fiume.state_machine as sm
+import Fiume.peer_engine as peer_engine
+
+logging.disable(logging.WARNING)
+
+
+class AsyncEngineSeeding(unittest.TestCase):
+    """
+    A ThreadedServer seeding a complete torrent through the asyncio
+    engine, contacted by raw loopback sockets.
+    """
+
+    # MiB
+    cache_size = 64
+
+    def setUp(self):
+        self.piece_size = 16384
+        self.num_pieces = 8
+        self.data = random.randbytes(self.piece_size * self.num_pieces)
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        output_file = Path(self.tmpdir.name) / "engine-test.bin"
+        output_file.write_bytes(self.data)
+
+        options = {
+            "port": 0, "output_file": output_file, "timeout": 5,
+            "max_peer_connections": 16, "peer_engine": "asyncio",
+            "cache_size": self.cache_size,
+            "debug_level": logging.CRITICAL,
+        }
+        info = {
+            b"name": b"engine-test.bin",
+            b"piece length": self.piece_size,
+            b"length": len(self.data),
+            b"pieces": b"".join(
+                utils.sha1(self.data[i:i+self.piece_size])
+                for i in range(0, len(self.data), self.piece_size)
+            ),
+        }
+        self.metainfo = md.MetaInfo(
+            {b"announce": b"http://localhost/announce", b"info": info} | options
+        )
+        # With the stat of the data file: trusted, not rechecked
+        resume.ResumeFile(
+            utils.get_bitmap_file(output_file), Bitfield.full(self.num_pieces),
+            self.metainfo.info_hash, data_path=output_file
+        ).save()
+
+        tracker_manager = Mock()
+        tracker_manager.cached_peers.return_value = []
+        tracker_manager.queue_for_new_peers = Queue()
+
+        self.ts = sm.ThreadedServer(self.metainfo, tracker_manager, **options)
+        self.ts.main()
+
+    def tearDown(self):
+        self.ts.master_queue.put(utils.M_KILL())
+        self.tmpdir.cleanup()
+
+    def connect(self, info_hash) -> socket.socket:
+        s = socket.create_connection(("localhost", self.ts.port), timeout=5)
+        s.sendall(utils.HANDSHAKE_PREAMBLE + bytes(8) + info_hash + utils.generate_peer_id())
+        return s
+
+    def read_frame(self, s) -> bytes:
+        length = utils.to_int(self.recv_exactly(s, 4))
+        return self.recv_exactly(s, length)
+
+    def recv_exactly(self, s, n) -> bytes:
+        out = b""
+        while len(out) < n:
+            data = s.recv(n - len(out))
+            self.assertNotEqual(data, b"", "Connection closed by engine")
+            out += data
+        return out
+
+    ##############################
+
+    def test_handshake_and_bitfield(self):
+        s = self.connect(self.metainfo.info_hash)
+
+        handshake = self.recv_exactly(s, 68)
+        self.assertEqual(handshake[28:48], self.metainfo.info_hash)
+
+        bitfield = self.read_frame(s)
+        self.assertEqual(bitfield[0], sm.MexType.BITFIELD.value)
+        self.assertEqual(
+            utils.bitmap_to_bool(bitfield[1:], self.num_pieces),
+            [True] * self.num_pieces
+        )
+        s.close()
+
+    def test_unknown_info_hash_is_dropped(self):
+        s = self.connect(bytes(20))
+        self.assertEqual(s.recv(68), b"")
+        s.close()
+
+    def test_request_block(self):
+        s = self.connect(self.metainfo.info_hash)
+        self.recv_exactly(s, 68)
+        self.read_frame(s) # BITFIELD
+
+        s.sendall(utils.to_bytes(1, length=4) + utils.to_bytes(sm.MexType.INTERESTED.value))
+        self.assertEqual(self.read_frame(s)[0], sm.MexType.UNCHOKE.value)
+
+        s.sendall(
+            utils.to_bytes(13, length=4) + utils.to_bytes(sm.MexType.REQUEST.value) +
+            utils.to_bytes(3, length=4) + utils.to_bytes(100, length=4) +
+            utils.to_bytes(1000, length=4)
+        )
+        piece = self.read_frame(s)
+        self.assertEqual(piece[0], sm.MexType.PIECE.value)
+        self.assertEqual(utils.to_int(piece[1:5]), 3)
+        self.assertEqual(piece[9:], self.data[3*self.piece_size+100:3*self.piece_size+1100])
+        s.close()
+
+    def test_pieces_are_read_off_the_loop(self):
+        readers = list()
+        read = self.ts.storage.read
+        def recording_read(*args):
+            readers.append(threading.current_thread())
+            return read(*args)
+        self.ts.storage.read = recording_read
+
+        s = self.unchoked_connection()
+        s.sendall(self.request(3, 100, 1000))
+        piece = self.read_frame(s)
+        self.assertEqual(piece[9:], self.data[3*self.piece_size+100:3*self.piece_size+1100])
+        s.close()
+
+        self.assertEqual(len(readers), 1)
+        self.assertIsNot(readers[0], self.ts.engine.thread)
+
+    def test_cancelled_request_is_not_served(self):
+        s = self.connect(self.metainfo.info_hash)
+        self.recv_exactly(s, 68)
+        self.read_frame(s) # BITFIELD
+
+        s.sendall(utils.to_bytes(1, length=4) + utils.to_bytes(sm.MexType.INTERESTED.value))
+        self.assertEqual(self.read_frame(s)[0], sm.MexType.UNCHOKE.value)
+
+        def block_message(mex_type, index):
+            return (
+                utils.to_bytes(13, length=4) + utils.to_bytes(mex_type.value) +
+                utils.to_bytes(index, length=4) + utils.to_bytes(0, length=4) +
+                utils.to_bytes(1000, length=4)
+            )
+
+        # Arriving together, the CANCEL reaches the first REQUEST while queued
+        s.sendall(
+            block_message(sm.MexType.REQUEST, 2) +
+            block_message(sm.MexType.CANCEL, 2) +
+            block_message(sm.MexType.REQUEST, 5)
+        )
+        piece = self.read_frame(s)
+        self.assertEqual(piece[0], sm.MexType.PIECE.value)
+        self.assertEqual(utils.to_int(piece[1:5]), 5)
+        s.close()
+
+    def unchoked_connection(self, rcvbuf: int = None) -> socket.socket:
+        s = socket.socket()
+        if rcvbuf is not None:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        s.settimeout(5)
+        s.connect(("localhost", self.ts.port))
+        s.sendall(utils.HANDSHAKE_PREAMBLE + bytes(8) + self.metainfo.info_hash + utils.generate_peer_id())
+        self.recv_exactly(s, 68)
+        self.read_frame(s) # BITFIELD
+
+        s.sendall(utils.to_bytes(1, length=4) + utils.to_bytes(sm.MexType.INTERESTED.value))
+        self.assertEqual(self.read_frame(s)[0], sm.MexType.UNCHOKE.value)
+        return s
+
+    def request(self, index: int, offset: int, length: int) -> bytes:
+        return (
+            utils.to_bytes(13, length=4) + utils.to_bytes(sm.MexType.REQUEST.value) +
+            utils.to_bytes(index, length=4) + utils.to_bytes(offset, length=4) +
+            utils.to_bytes(length, length=4)
+        )
+
+    def test_requests_while_choked_are_rejected(self):
+        s = self.connect(self.metainfo.info_hash)
+        self.recv_exactly(s, 68)
+        self.read_frame(s) # BITFIELD
+
+        # Before the choker unchokes it
+        s.sendall(utils.to_bytes(1, length=4) + utils.to_bytes(sm.MexType.INTERESTED.value) +
+                  self.request(3, 0, 1000))
+        self.assertEqual(self.read_frame(s)[0], sm.MexType.UNCHOKE.value)
+
+        s.sendall(self.request(5, 0, 1000))
+        self.assertEqual(utils.to_int(self.read_frame(s)[1:5]), 5)
+        s.close()
+
+    def test_queued_requests_are_capped(self):
+        s = self.unchoked_connection()
+
+        with patch.object(sm, "MAX_QUEUED_REQUESTS", 4):
+            s.sendall(b"".join(self.request(i, 0, 1000) for i in range(self.num_pieces)))
+            pieces = [utils.to_int(self.read_frame(s)[1:5]) for _ in range(4)]
+
+            self.assertEqual(pieces, [0, 1, 2, 3])
+            s.settimeout(0.5)
+            with self.assertRaises(socket.timeout):
+                self.read_frame(s)
+        s.close()
+
+    def test_uploads_resume_when_the_peer_reads(self):
+        # Much more than the socket buffers take, a tiny transport
+        # buffer, and a peer slow to read
+        blocks = [(i % self.num_pieces, self.piece_size - i) for i in range(sm.MAX_QUEUED_REQUESTS)]
+
+        with patch.object(peer_engine, "WRITE_HIGH_WATER", 1):
+            s = self.unchoked_connection(rcvbuf=4096)
+            s.sendall(b"".join(self.request(index, 0, length) for index, length in blocks))
+
+            for index, length in blocks:
+                piece = self.read_frame(s)
+                self.assertEqual((utils.to_int(piece[1:5]), len(piece) - 9), (index, length))
+        s.close()
+
+
+class UncachedEngineSeeding(AsyncEngineSeeding):
+    """
+    The same, with no piece cache: the blocks waiting for a piece are
+    sent from what was read for them (once, see test_pieces_are_read_off_the_loop).
+    """
+    cache_size = 0
+
+    def test_blocks_are_copied_without_sendfile(self):
+        self.ts.options["sendfile"] = False
+        s = self.unchoked_connection()
+        s.sendall(self.request(3, 100, 1000) + self.request(3, 2000, 1000))
+        for offset in (100, 2000):
+            piece = self.read_frame(s)
+            start = 3*self.piece_size + offset
+            self.assertEqual(piece[9:], self.data[start:start+1000])
+        s.close()
@@ -0,0 +1,53 @@
+from queue import Queue
+
+import unittest
+
+import Fiume.pex as pex
+
+
+class PeerExchangeTests(unittest.TestCase):
+    def setUp(self):
+        self.queue = Queue()
+        self.pex = pex.PeerExchange(self.queue, 6881, known=[("10.0.0.1", 1)])
+
+    def test_peers(self):
+        self.pex.add(("10.0.0.2", 50000), ("10.0.0.2", 2), pex.FLAG_REACHABLE)
+        self.pex.add(("10.0.0.3", 50001), ("10.0.0.3", 3))
+        self.pex.add(("::1", 50002), ("::1", 4))
+
+        # Not to itself, nor IPv6 ones
+        self.assertEqual(self.pex.peers(but=("10.0.0.3", 50001)),
+                         {("10.0.0.2", 2): pex.FLAG_REACHABLE})
+
+        self.pex.remove(("10.0.0.2", 50000))
+        self.assertEqual(self.pex.peers(but=("10.0.0.3", 50001)), {})
+
+    def test_new_peers_are_queued_once(self):
+        self.pex.add(("10.0.0.2", 50000), ("10.0.0.2", 2))
+
+        new = self.pex.learned([("10.0.0.1", 1), ("10.0.0.2", 2), ("10.0.0.4", 4), ("10.0.0.4", 4)])
+        self.assertEqual(new, [("10.0.0.4", 4)])
+        self.assertEqual(self.pex.learned([("10.0.0.4", 4)]), [])
+
+        self.assertEqual(self.queue.get_nowait(), ("10.0.0.4", 4))
+        self.assertTrue(self.queue.empty())
+
+    def test_at_most_max_peers_are_learned(self):
+        peers = [("10.0.1.{}".format(i), 6881) for i in range(pex.MAX_PEX_PEERS + 10)]
+        self.assertEqual(self.pex.learned(peers), peers[:pex.MAX_PEX_PEERS])
+
+    def test_message(self):
+        added = {("10.0.0.2", 2): pex.FLAG_REACHABLE, ("10.0.0.3", 51413): 0}
+        message = pex.pex_message(added, [("10.0.0.4", 4)])
+
+        self.assertEqual(pex.decode_peers(message[b"added"]), list(added))
+        self.assertEqual(message[b"added.f"], bytes([pex.FLAG_REACHABLE, 0]))
+        self.assertEqual(pex.decode_peers(message[b"dropped"]), [("10.0.0.4", 4)])
+
+        # Truncated, or not even bytes
+        self.assertEqual(pex.decode_peers(message[b"added"][:-1]), [("10.0.0.2", 2)])
+        self.assertEqual(pex.decode_peers(42), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+
+from Fiume.picker import PICKERS, StreamingPicker, make_picker
+from Fiume.bitfield import Bitfield
+
+
+class PickerTests(unittest.TestCase):
+    def test_rarest_first(self):
+        picker = make_picker("rarest")
+        picker.peer_has(range(10))
+        picker.peer_has(range(5))
+        picker.peer_has([0])
+
+        self.assertEqual(sorted(picker.pick(range(10), 5)), [5, 6, 7, 8, 9])
+        chosen = set(picker.pick(range(10), 7))
+        self.assertTrue({5, 6, 7, 8, 9} < chosen and 0 not in chosen, chosen)
+        self.assertEqual(picker.pick(range(10), 10)[-1], 0)
+
+    def test_ties_are_broken_at_random(self):
+        picker = make_picker("rarest")
+        picker.peer_has(range(100))
+        firsts = {picker.pick(range(100), 1)[0] for _ in range(20)}
+        self.assertGreater(len(firsts), 1)
+
+    def test_peer_gone(self):
+        picker = make_picker("rarest")
+        picker.peer_has(range(4))
+        picker.peer_has([0, 1])
+        picker.peer_gone(range(4))
+
+        self.assertEqual(picker.availability[0], 1)
+        self.assertNotIn(3, picker.availability)
+        # Pieces nobody has any more are picked first (from the other candidates)
+        self.assertEqual(set(picker.pick([0, 1, 2, 3], 2)), {2, 3})
+
+    def test_sequential(self):
+        picker = make_picker("sequential")
+        picker.peer_has([9])
+        self.assertEqual(picker.pick({9, 3, 7, 5}, 3), [3, 5, 7])
+
+    def test_random(self):
+        picker = make_picker("random")
+        chosen = picker.pick(set(range(10)), 4)
+        self.assertEqual(len(set(chosen)), 4)
+        self.assertEqual(picker.pick({1}, 4), [1])
+
+    def test_every_policy_handles_few_candidates(self):
+        for kind in PICKERS:
+            self.assertEqual(make_picker(kind).pick([], 3), [])
+
+        with self.assertRaises(ValueError):
+            make_picker("fastest")
+
+
+    def test_streaming_window_comes_first(self):
+        bitmap = Bitfield.from_string("1101000000")
+        picker = StreamingPicker(make_picker("rarest"), bitmap, piece_size=100, window=3)
+        picker.peer_has([9])
+
+        self.assertEqual(picker.window(), [2, 4, 5])
+        missing = {2, 5, 6, 7, 8, 9} # 4 is scheduled already
+        self.assertEqual(picker.pick(missing, 2), [2, 5])
+        # Outside the window, the rarest (piece 9 is not)
+        chosen = picker.pick(missing, 3)
+        self.assertEqual(chosen[:2], [2, 5])
+        self.assertIn(chosen[2], {6, 7, 8})
+        self.assertEqual(picker.availability[9], 1)
+
+        picker.seek(6, now=0)
+        self.assertEqual(picker.pick({2, 7, 8}, 2), [7, 8])
+
+    def test_streaming_deadlines(self):
+        bitmap = Bitfield(10)
+        picker = StreamingPicker(make_picker("rarest"), bitmap, piece_size=100, window=4)
+
+        # Reading at 50 bytes/sec: a piece every 2 seconds
+        picker.seek(2, now=10, rate=50)
+        self.assertEqual(picker.deadlines, {2: 10, 3: 12, 4: 14, 5: 16})
+        self.assertEqual(picker.overdue(now=12), [2, 3])
+        bitmap[2] = True
+        self.assertEqual(picker.overdue(now=12), [3])
+
+        # Without a rate, only the piece being read is urgent
+        picker.seek(7, now=20)
+        self.assertEqual(picker.deadlines, {7: 20})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+import hashlib
+
+from Fiume.piece_buffer import PieceBuffer
+
+BLOCK = 4
+
+
+class PieceBufferTests(unittest.TestCase):
+    def setUp(self):
+        # 3 blocks, the last one shorter
+        self.piece = PieceBuffer(7, 10, BLOCK)
+
+    def test_out_of_order(self):
+        self.assertTrue(self.piece.write(8, b"ij"))
+        self.assertTrue(self.piece.write(0, b"abcd"))
+        self.assertFalse(self.piece.is_complete())
+        self.assertEqual(list(self.piece.missing_offsets()), [4])
+
+        self.assertTrue(self.piece.write(4, memoryview(b"xxefgh")[2:]))
+        self.assertTrue(self.piece.is_complete())
+        self.assertEqual(self.piece.data, b"abcdefghij")
+
+    def test_duplicates_are_ignored(self):
+        self.assertTrue(self.piece.write(0, b"abcd"))
+        self.assertFalse(self.piece.write(0, b"zzzz"))
+        self.assertEqual(self.piece.data[:4], b"abcd")
+        self.assertEqual(self.piece.missing, 2)
+
+    def test_hash_follows_blocks_in_order(self):
+        self.assertFalse(self.piece.can_hash())
+        self.piece.write(4, b"efgh")
+        self.assertEqual(self.piece.hash_prefix(), 0)
+
+        self.piece.write(0, b"abcd")
+        self.assertTrue(self.piece.can_hash())
+        self.assertEqual(self.piece.hash_prefix(), 8)
+        self.assertFalse(self.piece.can_hash())
+
+        self.piece.write(8, b"ij")
+        self.assertEqual(self.piece.digest(), hashlib.sha1(b"abcdefghij").digest())
+
+    def test_invalid_blocks(self):
+        self.assertFalse(self.piece.write(2, b"abcd"))   # misaligned
+        self.assertFalse(self.piece.write(4, b"abc"))    # too short
+        self.assertFalse(self.piece.write(8, b"ijkl"))   # past the end
+        self.assertFalse(self.piece.write(12, b"abcd"))  # out of the piece
+        self.assertEqual(list(self.piece.missing_offsets()), [0, 4, 8])
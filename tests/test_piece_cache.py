@@ -0,0 +1,68 @@
+import unittest
+import threading
+import time
+
+from Fiume.piece_cache import PieceCache
+
+
+class PieceCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.cache = PieceCache(budget=100)
+
+    def test_hits_and_misses(self):
+        self.assertIsNone(self.cache.get(1))
+        self.cache.put(1, b"a" * 10)
+        self.assertEqual(self.cache.get(1), b"a" * 10)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_lru_eviction(self):
+        for key in range(4):
+            self.cache.put(key, bytes(30))
+        self.assertNotIn(0, self.cache)
+        self.assertEqual(self.cache.size, 90)
+
+        self.cache.get(1) # 2 is now the least recently used
+        self.cache.put(4, bytes(30))
+        self.assertIn(1, self.cache)
+        self.assertNotIn(2, self.cache)
+        self.assertEqual(self.cache.evictions, 2)
+
+    def test_too_big(self):
+        self.cache.put(1, bytes(101))
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.size, 0)
+
+    def test_replace(self):
+        self.cache.put(1, bytes(30))
+        self.cache.put(1, bytes(50))
+        self.assertEqual(self.cache.size, 50)
+
+    def test_concurrent_loads_read_once(self):
+        loads = list()
+
+        def load():
+            loads.append(1)
+            time.sleep(0.05)
+            return b"piece"
+
+        results = list()
+        threads = [
+            threading.Thread(target=lambda: results.append(self.cache.get_or_load(7, load)))
+            for _ in range(8)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(results, [b"piece"] * 8)
+        self.assertEqual(len(loads), 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (7, 1))
+
+    def test_failed_load(self):
+        def fail():
+            raise OSError("disk error")
+
+        with self.assertRaises(OSError):
+            self.cache.get_or_load(1, fail)
+        self.assertEqual(self.cache.get_or_load(1, lambda: b"ok"), b"ok")
@@ -0,0 +1,65 @@
+import unittest
+
+from Fiume.piece_table import PieceTable
+
+BLOCK = 4
+
+
+class PieceTableTests(unittest.TestCase):
+    def setUp(self):
+        self.table = PieceTable(BLOCK)
+        # 3 blocks, the last one shorter
+        self.assertTrue(self.table.start(7, 10))
+
+    def test_connections_share_a_piece(self):
+        self.assertEqual(self.table.claim(7, 2), [0, 4])
+        self.assertTrue(self.table.start(7, 10)) # joins, keeps the claims
+        self.assertEqual(self.table.claim(7, 2), [8])
+        self.assertEqual(self.table.claim(7, 2), [])
+        self.assertFalse(self.table.has_unclaimed(7))
+
+        self.assertTrue(self.table.write(7, 8, b"ij"))
+        self.assertTrue(self.table.write(7, 0, b"abcd"))
+        self.assertIsNone(self.table.complete(7))
+
+        self.assertTrue(self.table.write(7, 4, memoryview(b"efgh")))
+        piece = self.table.complete(7)
+        self.assertEqual(piece.data, b"abcdefghij")
+
+        # Taken only once, and never started again
+        self.assertIsNone(self.table.complete(7))
+        self.assertNotIn(7, self.table)
+        self.assertFalse(self.table.start(7, 10))
+        self.assertFalse(self.table.write(7, 0, b"abcd"))
+
+    def test_released_blocks_can_be_claimed_again(self):
+        self.assertEqual(self.table.claim(7, 3), [0, 4, 8])
+        self.table.release([(7, 4)])
+        self.assertTrue(self.table.has_unclaimed(7))
+        self.assertEqual(self.table.claim(7, 3), [4])
+
+    def test_endgame_claims_requested_blocks(self):
+        self.assertEqual(self.table.claim(7, 2), [0, 4])
+        self.table.endgame = True
+        self.assertEqual(self.table.claim(7, 3), [8, 0, 4])
+        self.assertEqual(self.table.claim(7, 3, mine={(7, 0), (7, 8)}), [4])
+
+        # The first copy wins
+        self.assertTrue(self.table.write(7, 4, b"efgh"))
+        self.assertFalse(self.table.write(7, 4, b"zzzz"))
+        self.assertEqual(self.table.pieces[7].data[4:8], b"efgh")
+
+    def test_dropped_pieces_start_over(self):
+        self.table.claim(7, 3)
+        for offset, block in [(0, b"abcd"), (4, b"efgh"), (8, b"ij")]:
+            self.table.write(7, offset, block)
+        self.assertIsNotNone(self.table.complete(7))
+
+        self.table.drop(7)
+        self.assertTrue(self.table.has_unclaimed(7))
+        self.assertTrue(self.table.start(7, 10))
+        self.assertEqual(self.table.claim(7, 3), [0, 4, 8])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+
+from Fiume.pipeline import RequestPipeline
+
+BLOCK = 16384
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class PipelineTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.pipeline = RequestPipeline(BLOCK, max_depth=64, initial_depth=4, clock=self.clock)
+
+    def simulate(self, seconds: float, rtt: float, link_rate: float):
+        """
+        Keeps the pipeline full towards a peer with a given RTT and
+        upload capacity (bytes/sec).
+        """
+        piece, offset = 0, 0
+        in_flight = list()
+        next_free = 0.0 # when the peer's upload link is free again
+
+        end = self.clock.now + seconds
+        while self.clock.now < end:
+            while self.pipeline.free_slots() > 0:
+                self.pipeline.sent(piece, offset)
+                arrival = max(self.clock.now + rtt, next_free + BLOCK / link_rate)
+                next_free = arrival
+                in_flight.append((arrival, piece, offset))
+                offset += BLOCK
+
+            in_flight.sort()
+            arrival, p, o = in_flight.pop(0)
+            self.clock.now = arrival
+            self.assertTrue(self.pipeline.received(p, o, BLOCK))
+
+    ##############################
+
+    def test_free_slots(self):
+        self.assertEqual(self.pipeline.free_slots(), 4)
+        self.pipeline.sent(0, 0)
+        self.pipeline.sent(0, BLOCK)
+        self.assertEqual(self.pipeline.free_slots(), 2)
+        self.assertIn((0, BLOCK), self.pipeline)
+
+    def test_unrequested_blocks_are_rejected(self):
+        self.assertFalse(self.pipeline.received(3, 0, BLOCK))
+        self.pipeline.sent(3, 0)
+        self.assertTrue(self.pipeline.received(3, 0, BLOCK))
+        self.assertFalse(self.pipeline.received(3, 0, BLOCK))
+
+    def test_discard(self):
+        self.pipeline.sent(0, 0)
+        self.pipeline.sent(1, 0)
+        self.pipeline.discard(0)
+        self.assertNotIn((0, 0), self.pipeline)
+        self.assertIn((1, 0), self.pipeline)
+        self.pipeline.discard()
+        self.assertEqual(len(self.pipeline), 0)
+
+    def test_expired(self):
+        self.pipeline.sent(0, 0)
+        self.clock.now = 3.0
+        self.pipeline.sent(0, BLOCK)
+        self.clock.now = 5.0
+        self.assertEqual(self.pipeline.expired(5.0), [(0, 0)])
+
+        self.assertTrue(self.pipeline.received(0, 0, BLOCK))
+        self.assertEqual(self.pipeline.last_received, 5.0)
+        self.assertEqual(self.pipeline.expired(5.0), [])
+
+    def test_depth_grows_to_bandwidth_delay_product(self):
+        # 100ms RTT, 4 MB/s: BDP is ~25 blocks
+        self.simulate(seconds=20, rtt=0.1, link_rate=4e6)
+        self.assertGreaterEqual(self.pipeline.depth, 25)
+        self.assertLess(self.pipeline.depth, 64)
+
+    def test_depth_is_capped(self):
+        self.simulate(seconds=20, rtt=0.5, link_rate=50e6)
+        self.assertEqual(self.pipeline.depth, 64)
+
+    def test_slow_peer_stays_shallow(self):
+        # 10ms RTT, 100 KB/s: less than a block in flight
+        self.simulate(seconds=20, rtt=0.01, link_rate=1e5)
+        self.assertLessEqual(self.pipeline.depth, 3)
@@ -0,0 +1,144 @@
+import unittest
+import tempfile
+import hashlib
+import random
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+
+import Fiume.config as config
+import Fiume.recheck as recheck
+import Fiume.resume as resume
+
+PIECE_SIZE = 1024
+NUM_PIECES = 40
+TOTAL_SIZE = PIECE_SIZE * (NUM_PIECES - 1) + 100 # last piece is shorter
+
+
+class DataFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmpdir.name) / "file.bin"
+
+        random.seed(0)
+        self.data = random.randbytes(TOTAL_SIZE)
+        self.hashes = [
+            hashlib.sha1(self.data[i:i+PIECE_SIZE]).digest()
+            for i in range(0, TOTAL_SIZE, PIECE_SIZE)
+        ]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+
+class RecheckTests(DataFileTest):
+    def recheck(self, workers=4):
+        return recheck.recheck(self.path, PIECE_SIZE, self.hashes, TOTAL_SIZE, workers=workers)
+
+    def test_complete_file(self):
+        self.path.write_bytes(self.data)
+        self.assertTrue(self.recheck().complete)
+        self.assertTrue(self.recheck(workers=1).complete)
+
+    def test_missing_and_damaged_pieces(self):
+        data = bytearray(self.data)
+        data[3*PIECE_SIZE + 10] ^= 0xFF
+        data[17*PIECE_SIZE:18*PIECE_SIZE] = bytes(PIECE_SIZE) # never downloaded
+        self.path.write_bytes(data[:30*PIECE_SIZE + 5]) # truncated
+
+        expected = set(range(30)) - {3, 17}
+        self.assertEqual(set(self.recheck().indices()), expected)
+
+    def test_on_a_shared_pool(self):
+        self.path.write_bytes(self.data)
+        found = list()
+        with ThreadPoolExecutor(2) as pool:
+            bitmap = recheck.recheck(self.path, PIECE_SIZE, self.hashes, TOTAL_SIZE,
+                                     workers=2, pool=pool, found=found.extend)
+            self.assertEqual(pool.submit(lambda: 42).result(), 42) # still usable
+
+        self.assertTrue(bitmap.complete)
+        self.assertEqual(found, list(range(NUM_PIECES)))
+
+    def test_missing_or_empty_file(self):
+        self.assertEqual(self.recheck().count(), 0)
+        self.path.touch()
+        self.assertEqual(self.recheck().count(), 0)
+
+
+class OpenResumeTests(DataFileTest):
+    """ How open_resume finds the pieces we have, for each --recheck mode. """
+
+    def setUp(self):
+        super().setUp()
+        bitmaps_dir = Path(self.tmpdir.name) / "bitmaps"
+        bitmaps_dir.mkdir()
+        patcher = mock.patch.object(config, "BITMAPS_DIR", bitmaps_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.metainfo = SimpleNamespace(
+            human_name="test", download_fpath=self.path, info_hash=bytes(20),
+            piece_size=PIECE_SIZE, pieces_hash=self.hashes,
+            total_size=TOTAL_SIZE, num_pieces=NUM_PIECES
+        )
+
+    def open(self, mode) -> resume.ResumeFile:
+        """ As the master does, with the pieces found by the recheck. """
+        options = {"recheck": mode, "hash_workers": 2}
+        r = resume.open_resume(self.metainfo, options)
+        if r.needs_recheck:
+            for i in resume.recheck_file(self.metainfo, options).indices():
+                r.mark(i)
+            r.save()
+        r.close()
+        return r
+
+    def test_file_is_not_hashed_when_opened(self):
+        self.path.write_bytes(self.data)
+        with mock.patch.object(recheck, "recheck") as mocked:
+            r = resume.open_resume(self.metainfo, {"recheck": "full"})
+            mocked.assert_not_called()
+
+        self.assertTrue(r.needs_recheck)
+        self.assertEqual(r.bitmap.count(), 0)
+
+    def test_previous_session_is_trusted_if_unchanged(self):
+        self.path.write_bytes(self.data)
+        self.assertTrue(self.open("quick").bitmap.complete) # no resume file: rechecked
+
+        with mock.patch.object(recheck, "recheck") as mocked:
+            self.assertTrue(self.open("quick").bitmap.complete)
+            mocked.assert_not_called()
+
+            self.assertTrue(self.open("off").bitmap.complete)
+            mocked.assert_not_called()
+
+    def test_changed_file_is_rechecked(self):
+        self.path.write_bytes(self.data)
+        self.open("quick")
+
+        # Damaged by someone else: size is the same, mtime is not
+        data = bytearray(self.data)
+        data[5*PIECE_SIZE] ^= 0xFF
+        self.path.write_bytes(data)
+        st = os.stat(self.path)
+        os.utime(self.path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+        self.assertTrue(self.open("off").bitmap[5])
+        self.assertEqual(set(range(NUM_PIECES)) - set(self.open("quick").bitmap.indices()), {5})
+
+    def test_full_always_rechecks(self):
+        self.path.write_bytes(self.data)
+        self.open("quick")
+
+        with mock.patch.object(recheck, "recheck", wraps=recheck.recheck) as mocked:
+            self.assertTrue(self.open("full").bitmap.complete)
+            mocked.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
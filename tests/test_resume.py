@@ -0,0 +1,149 @@
+import unittest
+import tempfile
+import time
+import threading
+
+from pathlib import Path
+from unittest.mock import Mock
+
+import Fiume.resume as resume
+import Fiume.recheck as recheck
+from Fiume.bitfield import Bitfield
+
+INFO_HASH = bytes(range(20))
+
+
+class ResumeFileTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmpdir.name) / "torrent.bitmap"
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def resume_file(self, num_pieces=20, **kwargs) -> resume.ResumeFile:
+        return resume.ResumeFile(self.path, Bitfield(num_pieces), INFO_HASH, **kwargs)
+
+    def test_round_trip(self):
+        r = self.resume_file()
+        for i in [0, 3, 19]:
+            r.mark(i)
+        r.close()
+
+        bitmap = resume.load_bitmap(self.path, 20, INFO_HASH)
+        self.assertEqual(list(bitmap.indices()), [0, 3, 19])
+        self.assertFalse(self.path.with_name(self.path.name + ".tmp").exists())
+
+    def test_updates_are_coalesced(self):
+        r = self.resume_file(flush_interval=60, flush_every=4)
+        for i in range(3):
+            r.mark(i)
+        self.assertEqual(r.flushes, 0)
+        self.assertFalse(self.path.exists())
+
+        r.mark(3) # saved right away, by the timer thread
+        r.mark(3) # already there: nothing to save
+        self.wait_for_flushes(r, 1)
+        self.assertEqual(resume.load_bitmap(self.path, 20, INFO_HASH).count(), 4)
+        r.close()
+        self.assertEqual(r.flushes, 1)
+
+    def wait_for_flushes(self, r: resume.ResumeFile, flushes: int):
+        deadline = time.monotonic() + 2
+        while r.flushes < flushes and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(r.flushes, flushes)
+
+    def test_mark_does_not_wait_for_the_disk(self):
+        syncing, release = threading.Event(), threading.Event()
+        storage = Mock()
+        storage.flush.side_effect = lambda: (syncing.set(), release.wait(5))
+        r = self.resume_file(storage=storage, flush_every=1)
+
+        r.mark(0)
+        self.assertTrue(syncing.wait(2))
+        start = time.monotonic()
+        r.mark(1) # while the first save waits for fsync
+        self.assertLess(time.monotonic() - start, 0.1)
+
+        release.set()
+        self.wait_for_flushes(r, 2)
+        r.close()
+        self.assertEqual(list(resume.load_bitmap(self.path, 20, INFO_HASH).indices()), [0, 1])
+
+    def test_flushed_after_interval(self):
+        r = self.resume_file(flush_interval=0.05, flush_every=100)
+        r.mark(5)
+        self.assertEqual(r.flushes, 0)
+
+        time.sleep(0.2)
+        self.assertEqual(r.flushes, 1)
+        self.assertTrue(resume.load_bitmap(self.path, 20, INFO_HASH)[5])
+        r.close()
+        self.assertEqual(r.flushes, 1)
+
+    def test_other_torrents_are_ignored(self):
+        r = self.resume_file()
+        r.mark(1)
+        r.close()
+
+        self.assertIsNone(resume.load_bitmap(self.path, 21, INFO_HASH))
+        self.assertIsNone(resume.load_bitmap(self.path, 20, bytes(20)))
+
+        self.path.write_bytes(resume.MAGIC + b"\x01")
+        self.assertIsNone(resume.load_bitmap(self.path, 20, INFO_HASH))
+        self.assertIsNone(resume.load_bitmap(self.path.with_name("missing"), 20, INFO_HASH))
+
+    def test_data_file_stat_is_saved(self):
+        data_path = Path(self.tmpdir.name) / "data"
+        data_path.write_bytes(b"x" * 100)
+        r = self.resume_file(data_path=data_path)
+        r.mark(2)
+        r.close()
+
+        bitmap, stat = resume.load_resume(self.path, 20, INFO_HASH)
+        self.assertEqual(list(bitmap.indices()), [2])
+        self.assertEqual(stat, recheck.file_stat(data_path))
+        self.assertEqual(stat[0], 100)
+
+        # Without a download file, no stat
+        r = self.resume_file()
+        r.mark(2)
+        r.close()
+        self.assertIsNone(resume.load_resume(self.path, 20, INFO_HASH)[1])
+
+    def test_data_is_flushed_first(self):
+        storage = Mock()
+        storage.flush.side_effect = lambda: self.assertFalse(self.path.exists())
+        r = self.resume_file(storage=storage)
+        r.mark(2)
+        r.close()
+
+        storage.flush.assert_called_once()
+        self.assertTrue(self.path.exists())
+
+    def test_version_1_format(self):
+        bitmap = Bitfield(20)
+        bitmap[7] = True
+        self.path.write_bytes(
+            resume.HEADER_V1.pack(resume.MAGIC, 1, 20, INFO_HASH) + bitmap.to_bytes()
+        )
+        bitmap, stat = resume.load_resume(self.path, 20, INFO_HASH)
+        self.assertEqual(list(bitmap.indices()), [7])
+        self.assertIsNone(stat)
+
+    def test_old_ascii_format(self):
+        self.path.write_text("0110\n")
+        self.assertEqual(list(resume.load_bitmap(self.path, 4, INFO_HASH)), [False, True, True, False])
+        self.assertIsNone(resume.load_bitmap(self.path, 5, INFO_HASH))
+
+    def test_without_path_nothing_is_saved(self):
+        r = resume.ResumeFile(None, Bitfield(4), None, flush_every=1)
+        r.mark(2)
+        r.close()
+        self.assertTrue(r.bitmap[2])
+        self.assertEqual(r.flushes, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
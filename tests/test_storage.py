@@ -0,0 +1,117 @@
+from pathlib import *
+from unittest.mock import patch
+
+import unittest
+import os
+import threading
+import random
+import tempfile
+
+import Fiume.storage as storage
+
+
+class StorageTests:
+    """ The same tests, for every kind of storage. """
+    kind = None
+    size = 10 * 1000 + 123
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmpdir.name) / "sub" / "data.bin"
+        storage.initialize_file(self.kind, self.path, self.size)
+        self.storage = storage.open_storage(self.kind, self.path, self.size)
+
+    def tearDown(self):
+        self.storage.close()
+        self.tmpdir.cleanup()
+
+    def test_read_write(self):
+        self.storage.write(1000, b"abcd")
+        self.assertEqual(self.storage.read(1000, 4), b"abcd")
+        self.assertEqual(self.storage.read(998, 4), b"\x00\x00ab")
+
+    def test_short_read_at_the_end(self):
+        self.storage.write(self.size - 3, memoryview(b"xyz"))
+        self.assertEqual(self.storage.read(self.size - 3, 1000), b"xyz")
+
+    def test_concurrent_writes(self):
+        data = random.randbytes(self.size)
+        chunks = list(range(0, self.size, 1000))
+        random.shuffle(chunks)
+
+        def writer(offsets):
+            for offset in offsets:
+                self.storage.write(offset, data[offset:offset+1000])
+
+        threads = [threading.Thread(target=writer, args=(chunks[i::4],)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(self.storage.read(0, self.size), data)
+
+    def test_flush(self):
+        self.storage.write(0, b"abc")
+        self.storage.flush()
+        self.assertEqual(self.storage.read(0, 3), b"abc")
+
+
+class FileStorageTests(StorageTests, unittest.TestCase):
+    kind = "file"
+
+    def test_file_is_preallocated(self):
+        self.assertEqual(self.path.stat().st_size, self.size)
+
+    def test_handles_are_reused(self):
+        pool = storage.FileHandlePool(max_open=1)
+        a = storage.FileStorage(self.path, pool)
+        b = storage.FileStorage(self.path.with_name("other.bin"), pool)
+
+        a.write(0, b"a")
+        fd = pool.handles[a.path][0]
+        a.write(1, b"b")
+        self.assertEqual(pool.handles[a.path][0], fd)
+
+        b.write(0, b"b") # evicts a
+        self.assertNotIn(a.path, pool.handles)
+        self.assertEqual(a.read(0, 2), b"ab")
+
+        a.close()
+        b.close()
+        self.assertEqual(len(pool.handles), 0)
+
+    def test_handle_in_use_is_closed_when_released(self):
+        pool = storage.FileHandlePool()
+        a = storage.FileStorage(self.path, pool)
+
+        with patch.object(storage.os, "close", wraps=os.close) as close:
+            with pool.handle(a.path) as fd:
+                a.close()
+                close.assert_not_called()
+                os.pwrite(fd, b"ab", 0)
+
+                # Reopened for new users
+                self.assertEqual(a.read(0, 2), b"ab")
+                self.assertNotEqual(pool.handles[a.path][0], fd)
+
+            close.assert_called_once_with(fd)
+
+        a.close()
+        self.assertEqual(len(pool.handles), 0)
+
+
+class MmapStorageTests(StorageTests, unittest.TestCase):
+    kind = "mmap"
+
+    def test_writes_reach_the_file(self):
+        self.storage.write(0, b"mmap")
+        self.storage.close()
+        self.assertEqual(self.path.read_bytes()[:4], b"mmap")
+
+
+class MemoryStorageTests(StorageTests, unittest.TestCase):
+    kind = "memory"
+
+    def test_no_file(self):
+        self.assertFalse(self.path.exists())
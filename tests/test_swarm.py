@@ -0,0 +1,419 @@
+from unittest.mock import Mock, patch
+from queue import Queue
+from pathlib import *
+from typing import *
+
+import unittest
+import random
+import io
+import math
+import socket
+import threading
+import tempfile
+import logging
+
+import bencodepy
+
+import Fiume.config as config
+import Fiume.utils as utils
+from Fiume.bitfield import Bitfield
+import Fiume.resume as resume
+import Fiume.recheck as recheck
+import Fiume.metainfo_decoder as md
+import Fiume.state_machine as sm
+import Fiume.picker as picker
+import Fiume.pex as pex
+
+logging.disable(logging.WARNING)
+
+
+def make_torrent(data: bytes, piece_size: int, output_file: Path, **options) -> md.MetaInfo:
+    info = {
+        b"name": b"swarm-test.bin",
+        b"piece length": piece_size,
+        b"length": len(data),
+        b"pieces": b"".join(
+            utils.sha1(data[i:i+piece_size]) for i in range(0, len(data), piece_size)
+        ),
+    }
+    return md.MetaInfo(
+        {b"announce": b"http://localhost/announce", b"info": info,
+         "output_file": output_file} | options
+    )
+
+
+def make_server(metainfo: md.MetaInfo, peers: List[Tuple[str, int]],
+                tracker_manager: md.TrackerManager = None, **options) -> sm.ThreadedServer:
+    if tracker_manager is None:
+        tracker_manager = Mock()
+        tracker_manager.cached_peers.return_value = peers
+        tracker_manager.queue_for_new_peers = Queue()
+
+    options = {
+        "port": 0, "output_file": metainfo.download_fpath, "timeout": 5,
+        "max_peer_connections": 16, "max_concurrent_pieces": 5,
+        "debug_level": logging.CRITICAL,
+    } | options
+
+    return sm.ThreadedServer(metainfo, tracker_manager, **options)
+
+
+class MuteSeeder:
+    """
+    A peer that has every piece and unchokes us, but never answers
+    REQUESTs. Remembers the types of the messages it receives.
+    """
+    def __init__(self, info_hash: bytes, num_pieces: int):
+        self.sock = socket.create_server(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        self.received: List[int] = list()
+
+        bitfield = bytes([0xff] * math.ceil(num_pieces / 8))
+        self.greeting = (
+            utils.HANDSHAKE_PREAMBLE + bytes(8) + info_hash + utils.generate_peer_id() +
+            utils.to_bytes(1 + len(bitfield), length=4) + utils.to_bytes(sm.MexType.BITFIELD.value) + bitfield +
+            utils.to_bytes(1, length=4) + utils.to_bytes(sm.MexType.UNCHOKE.value)
+        )
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        conn, _ = self.sock.accept()
+        with conn, conn.makefile("rb") as f:
+            f.read(68) # HANDSHAKE
+            conn.sendall(self.greeting)
+            while True:
+                header = f.read(4)
+                if len(header) < 4:
+                    return
+                mex = f.read(utils.to_int(header))
+                if mex:
+                    self.received.append(mex[0])
+
+    def close(self):
+        self.sock.close()
+
+
+class PexPeer:
+    """
+    A peer that has no pieces, and speaks only the extension protocol:
+    it tells `peers` in a ut_pex message, and remembers the extended
+    messages it receives, as (extended id, decoded payload).
+    """
+    UT_PEX_ID = 3 # ours, different from Fiume's
+
+    def __init__(self, info_hash: bytes, peers: List[Tuple[str, int]] = []):
+        self.sock = socket.create_server(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        self.received: Queue = Queue()
+
+        self.greeting = (
+            utils.HANDSHAKE_PREAMBLE + sm.RESERVED + info_hash + utils.generate_peer_id() +
+            self.extended(sm.EXTENDED_HANDSHAKE, {b"m": {b"ut_pex": self.UT_PEX_ID}, b"p": self.port})
+        )
+        if peers:
+            self.greeting += self.extended(pex.UT_PEX_ID, pex.pex_message(dict.fromkeys(peers, 0), []))
+
+    def extended(self, extended_id: int, payload: Dict) -> bytes:
+        mex = bytes([sm.MexType.EXTENDED.value, extended_id]) + bencodepy.encode(payload)
+        return utils.to_bytes(len(mex), length=4) + mex
+
+    def serve(self):
+        """ Waits for a connection. """
+        threading.Thread(target=lambda: self.talk(self.sock.accept()[0]), daemon=True).start()
+
+    def connect(self, address: Tuple[str, int]):
+        self.talk(socket.create_connection(address))
+
+    def talk(self, conn: socket.socket):
+        with conn, conn.makefile("rb") as f:
+            conn.sendall(self.greeting)
+            f.read(68) # HANDSHAKE
+            while True:
+                header = f.read(4)
+                if len(header) < 4:
+                    return
+                mex = f.read(utils.to_int(header))
+                if mex and mex[0] == sm.MexType.EXTENDED.value:
+                    self.received.put((mex[1], bencodepy.decode(mex[2:])))
+
+    def close(self):
+        self.sock.close()
+
+
+class LoopbackSwarm(unittest.TestCase):
+    """
+    A leecher downloads a whole torrent from a seeder, both living in
+    this process and talking through loopback.
+    """
+    piece_size = 2 * 16384
+    num_pieces = 40
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmpdir.name)
+        # last piece has an irregular size
+        self.data = random.randbytes(self.piece_size * self.num_pieces - 1000)
+        self.servers = list()
+
+    def tearDown(self):
+        for server in self.servers:
+            server.master_queue.put(utils.M_KILL())
+        self.tmpdir.cleanup()
+
+    def make_seeder(self, **options) -> sm.ThreadedServer:
+        """ Unless options["recheck"] is "full", the resume file is trusted. """
+        seed_file = self.dir / "seed-{}.bin".format(random.randbytes(4).hex())
+        seed_file.write_bytes(self.data)
+        metainfo = make_torrent(self.data, self.piece_size, seed_file)
+        resume.ResumeFile(
+            utils.get_bitmap_file(seed_file), Bitfield.full(self.num_pieces),
+            metainfo.info_hash, data_path=seed_file
+        ).save()
+
+        seeder = make_server(metainfo, [], **options)
+        self.servers.append(seeder)
+        return seeder
+
+    def start_seeder(self, **options) -> sm.ThreadedServer:
+        seeder = self.make_seeder(**options)
+        seeder.main()
+        return seeder
+
+    def download(self, seeders: List[sm.ThreadedServer], while_downloading=None,
+                 tracker_tiers=None, **options) -> sm.ThreadedServer:
+        """
+        With `tracker_tiers`, the leecher uses a real TrackerManager: the
+        seeders are known from a previous session.
+        """
+        leech_file = self.dir / "leech-{}.bin".format(random.randbytes(4).hex())
+        utils.get_bitmap_file(leech_file).unlink(missing_ok=True)
+        metainfo = make_torrent(self.data, self.piece_size, leech_file)
+
+        tracker_manager = None
+        if tracker_tiers is not None:
+            metainfo.tiers = tracker_tiers
+            utils.get_peers_file(leech_file).write_text("".join(
+                "127.0.0.1:{}\n".format(s.port) for s in seeders
+            ))
+            tracker_manager = md.TrackerManager(
+                metainfo, {"port": 0, "tracker_timeout": 10, "debug_level": logging.CRITICAL}
+            )
+            self.addCleanup(tracker_manager.close)
+
+        leecher = make_server(
+            metainfo, [("127.0.0.1", s.port) for s in seeders],
+            tracker_manager=tracker_manager, **options
+        )
+        self.servers.append(leecher)
+
+        t = threading.Thread(target=leecher.main, daemon=True)
+        t.start()
+        if while_downloading is not None:
+            while_downloading(leecher)
+        t.join(timeout=20)
+
+        self.assertFalse(t.is_alive(), "Download did not complete in time")
+        self.assertTrue(leecher.mcu.bitmap.complete)
+        saved = resume.load_bitmap(
+            utils.get_bitmap_file(leech_file), self.num_pieces, leecher.metainfo.info_hash
+        )
+        self.assertTrue(saved.complete)
+        self.assertEqual(leecher.mcu.storage.read(0, len(self.data)), self.data)
+        if options.get("storage", "file") != "memory":
+            self.assertEqual(leech_file.read_bytes(), self.data)
+        return leecher
+
+    ##############################
+
+    def test_download_asyncio(self):
+        seeder = self.start_seeder(peer_engine="asyncio")
+        self.download([seeder], peer_engine="asyncio")
+
+    def test_download_threads(self):
+        seeder = self.start_seeder(peer_engine="threads")
+        self.download([seeder], peer_engine="threads")
+
+    def test_download_from_many_seeders(self):
+        seeders = [self.start_seeder() for _ in range(3)]
+        self.download(seeders)
+
+    def test_download_without_pipelining(self):
+        seeder = self.start_seeder()
+        self.download([seeder], request_queue_depth=1)
+
+    def test_download_mmap(self):
+        seeder = self.start_seeder(storage="mmap")
+        self.download([seeder], storage="mmap")
+
+    def test_download_in_memory(self):
+        seeder = self.start_seeder()
+        self.download([seeder], storage="memory")
+
+    def test_seed_without_sendfile(self):
+        seeder = self.start_seeder(sendfile=False)
+        self.download([seeder])
+
+    def test_seed_without_sendfile_threads(self):
+        seeder = self.start_seeder(peer_engine="threads", sendfile=False)
+        self.download([seeder], peer_engine="threads")
+
+    def test_piece_cache_is_shared(self):
+        seeder = self.start_seeder(sendfile=False)
+        self.download([seeder])
+        self.download([seeder])
+
+        # Every piece was read from disk once, for both leechers
+        self.assertEqual(seeder.piece_cache.misses, self.num_pieces)
+        self.assertGreater(seeder.piece_cache.hits, 0)
+
+    def test_one_piece_from_many_seeders(self):
+        # A single large piece: its blocks are requested from every seeder
+        self.piece_size, self.num_pieces = 64 * 16384, 1
+        self.data = random.randbytes(self.piece_size - 1000)
+
+        seeders = [self.start_seeder(sendfile=False) for _ in range(3)]
+        leecher = self.download(seeders)
+
+        uploaders = [s for s in seeders if s.piece_cache.misses > 0]
+        self.assertGreater(len(uploaders), 1)
+        self.assertEqual(len(leecher.piece_table), 0)
+
+    def test_corrupted_piece_is_downloaded_again(self):
+        good = self.start_seeder(sendfile=False)
+        bad = self.start_seeder(sendfile=False)
+        # Every piece it sends is wrong
+        bad.metainfo.download_fpath.write_bytes(random.randbytes(len(self.data)))
+
+        leecher = self.download([good, bad])
+        self.assertEqual(leecher.hasher.verified, self.num_pieces)
+        self.assertGreater(leecher.hasher.failed, 0)
+
+    def test_unanswered_requests_go_to_other_peers(self):
+        info_hash = make_torrent(self.data, self.piece_size, self.dir / "x").info_hash
+        mute = MuteSeeder(info_hash, self.num_pieces)
+        self.addCleanup(mute.close)
+        seeder = self.start_seeder(delay=0.01)
+
+        # (no endgame, which would CANCEL the requests anyway)
+        self.download([seeder, mute], request_timeout=0.5, snub_timeout=1.0, endgame_blocks=0)
+        # The requests were cancelled, and the connection kept
+        self.assertIn(sm.MexType.REQUEST.value, mute.received)
+        self.assertIn(sm.MexType.CANCEL.value, mute.received)
+
+    def test_startup_does_not_wait_for_trackers(self):
+        seeder = self.start_seeder()
+        tracker = socket.create_server(("127.0.0.1", 0)) # never answers
+        self.addCleanup(tracker.close)
+        tracker_url = "http://127.0.0.1:{}/announce".format(tracker.getsockname()[1]).encode()
+
+        with patch.object(config, "PEERS_DIR", self.dir), \
+             patch.object(utils, "get_external_ip", return_value=None):
+            leecher = self.download([seeder], tracker_tiers=[[tracker_url]])
+
+        # Downloaded from the peer of the previous session, while the
+        # announce was still waiting
+        self.assertIsNone(leecher.tracker_manager.working)
+        self.assertEqual(leecher.tracker_manager.tiers[0][0].failures, 0)
+
+    def test_recheck_does_not_delay_listening(self):
+        rechecking = threading.Event()
+        release = threading.Event()
+        real_recheck = recheck.recheck
+
+        def slow_recheck(*args, **kwargs):
+            rechecking.set()
+            release.wait(10)
+            return real_recheck(*args, **kwargs)
+
+        with patch.object(recheck, "recheck", side_effect=slow_recheck):
+            seeder = self.make_seeder(recheck="full")
+            # Returns when the recheck completes it
+            threading.Thread(target=seeder.main, daemon=True).start()
+            self.assertTrue(rechecking.wait(5))
+
+            # Accepts connections meanwhile, with nothing to offer yet
+            socket.create_connection(("127.0.0.1", seeder.port), timeout=5).close()
+            self.assertEqual(seeder.mcu.bitmap.count(), 0)
+
+            release.set()
+            self.download([seeder])
+
+    def download_from_pex(self, **options):
+        seeder = self.start_seeder(**options)
+        info_hash = seeder.metainfo.info_hash
+        # The only peer the leecher knows: it has nothing, but knows the seeder
+        peer = PexPeer(info_hash, peers=[("127.0.0.1", seeder.port)])
+        self.addCleanup(peer.close)
+        peer.serve()
+
+        leecher = self.download([peer], **options)
+
+        # The leecher told its port, and that it wants PEX messages
+        extended_id, handshake = peer.received.get(timeout=1)
+        self.assertEqual(extended_id, sm.EXTENDED_HANDSHAKE)
+        self.assertEqual(handshake[b"m"], {b"ut_pex": pex.UT_PEX_ID})
+        self.assertEqual(handshake[b"p"], leecher.port)
+
+    def test_download_from_peers_found_by_pex(self):
+        self.download_from_pex(peer_engine="asyncio")
+
+    def test_download_from_peers_found_by_pex_threads(self):
+        self.download_from_pex(peer_engine="threads")
+
+    def test_connected_peers_are_sent_by_pex(self):
+        seeder = self.start_seeder(pex_interval=0.5)
+        first, second = [PexPeer(seeder.metainfo.info_hash) for _ in range(2)]
+
+        for peer in (first, second):
+            self.addCleanup(peer.close)
+            threading.Thread(
+                target=peer.connect, args=(("127.0.0.1", seeder.port),), daemon=True
+            ).start()
+
+            extended_id, handshake = peer.received.get(timeout=2)
+            self.assertEqual(extended_id, sm.EXTENDED_HANDSHAKE)
+            self.assertEqual(handshake[b"p"], seeder.port)
+
+        # Each one is told about the other (at the port it told), not itself
+        for peer, other in ((first, second), (second, first)):
+            extended_id, message = peer.received.get(timeout=3)
+            self.assertEqual(extended_id, PexPeer.UT_PEX_ID)
+            self.assertEqual(pex.decode_peers(message[b"added"]), [("127.0.0.1", other.port)])
+            self.assertEqual(message[b"added.f"], bytes(1))
+
+    def flooding_peer_is_dropped(self, **options):
+        seeder = self.start_seeder(**options)
+        flood = [("10.0.0.{}".format(i), 6881) for i in range(pex.MAX_PEX_PEERS + 1)]
+        peer = PexPeer(seeder.metainfo.info_hash, peers=flood)
+        self.addCleanup(peer.close)
+        # Before it, an EXTENDED message without extended id: ignored
+        i = peer.greeting.index(peer.extended(pex.UT_PEX_ID, pex.pex_message(dict.fromkeys(flood, 0), [])))
+        peer.greeting = peer.greeting[:i] + utils.to_bytes(1, length=4) + bytes([sm.MexType.EXTENDED.value]) + peer.greeting[i:]
+
+        t = threading.Thread(target=peer.connect, args=(("127.0.0.1", seeder.port),), daemon=True)
+        t.start()
+        t.join(timeout=5)
+
+        # The seeder closed the connection, and learned nobody
+        self.assertFalse(t.is_alive(), "The connection was not closed")
+        self.assertTrue(all(address not in seeder.pex.known for address in flood))
+
+    def test_flooding_peer_is_dropped(self):
+        self.flooding_peer_is_dropped(peer_engine="asyncio")
+
+    def test_flooding_peer_is_dropped_threads(self):
+        self.flooding_peer_is_dropped(peer_engine="threads")
+
+    def test_stream_while_downloading(self):
+        seeder = self.start_seeder()
+        read = list()
+
+        def stream(leecher):
+            with io.BufferedReader(leecher.open_stream(timeout=10)) as reader:
+                read.append(reader.read(5000))
+                reader.seek(-3000, io.SEEK_END)
+                read.append(reader.read())
+
+        leecher = self.download([seeder], while_downloading=stream, streaming=True)
+        self.assertEqual(read, [self.data[:5000], self.data[-3000:]])
+        self.assertIsInstance(leecher.mcu.picker, picker.StreamingPicker)
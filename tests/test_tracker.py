@@ -0,0 +1,373 @@
+from unittest.mock import patch
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from pathlib import Path
+from typing import *
+from queue import Queue
+
+import unittest
+import tempfile
+import threading
+import socket
+import time
+import logging
+
+import bencodepy
+
+import Fiume.config as config
+import Fiume.utils as utils
+import Fiume.metainfo_decoder as md
+import Fiume.tracker_client as tracker_client
+
+logging.disable(logging.WARNING)
+
+
+class StubTracker:
+    """
+    An HTTP tracker on loopback, answering every announce with `peers`
+    after `delay` seconds, and every scrape with `seeders`. Remembers the
+    announces and scrapes received, and the client ports they came from
+    (one per TCP connection).
+    """
+    def __init__(self, peers: List[Tuple[str, int]], delay: float = 0, interval: int = 1800,
+                 min_interval: int = None, seeders: int = 0):
+        self.announces: List[Dict[str, List[str]]] = list()
+        self.scrapes: List[Dict[str, List[str]]] = list()
+        self.client_ports: Set[int] = set()
+        self.seeders = seeders
+        tracker = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # keep-alive
+
+            def do_GET(self):
+                time.sleep(delay)
+                path = urlsplit(self.path)
+                query = parse_qs(path.query, encoding="latin-1")
+                tracker.client_ports.add(self.client_address[1])
+
+                if path.path == "/scrape":
+                    tracker.scrapes.append(query)
+                    body = bencodepy.encode({b"files": {
+                        info_hash.encode("latin-1"): {
+                            b"complete": tracker.seeders, b"downloaded": 0, b"incomplete": 1
+                        }
+                        for info_hash in query["info_hash"]
+                    }})
+                else:
+                    tracker.announces.append(query)
+                    answer = {
+                        b"interval": interval,
+                        b"complete": tracker.seeders,
+                        b"peers": b"".join(
+                            socket.inet_aton(ip) + utils.to_bytes(port, 2) for ip, port in peers
+                        ),
+                    }
+                    if min_interval is not None:
+                        answer[b"min interval"] = min_interval
+                    body = bencodepy.encode(answer)
+
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = "http://127.0.0.1:{}/announce".format(self.server.server_port).encode()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def make_metainfo(tiers: List[List[bytes]]) -> md.MetaInfo:
+    info = {
+        b"name": b"tracker-test.bin",
+        b"piece length": 16384,
+        b"length": 16384 * 4,
+        b"pieces": bytes(20 * 4),
+    }
+    return md.MetaInfo({
+        b"announce": tiers[0][0],
+        b"announce-list": tiers,
+        b"info": info,
+        "output_file": Path("tracker-test.bin"),
+    })
+
+
+def dead_tracker() -> Tuple[socket.socket, bytes]:
+    """ A tracker that accepts connections, but never answers. """
+    sock = socket.create_server(("127.0.0.1", 0))
+    return sock, "http://127.0.0.1:{}/announce".format(sock.getsockname()[1]).encode()
+
+
+def start_and_wait(tm: md.TrackerManager, timeout: float = 2) -> List[Tuple[str, int]]:
+    """
+    tm.start(), until it is over (the next announce is scheduled): the
+    peers it queued.
+    """
+    previous = tm.timer
+    tm.start()
+    deadline = time.monotonic() + timeout
+    while tm.timer is previous:
+        if time.monotonic() > deadline:
+            raise AssertionError("The trackers were not contacted in time")
+        time.sleep(0.01)
+
+    peers = list()
+    while not tm.queue_for_new_peers.empty():
+        peers.append(tm.queue_for_new_peers.get_nowait())
+    return peers
+
+
+class TrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.trackers: List[StubTracker] = list()
+        self.client = tracker_client.TrackerClient({"tracker_timeout": 0.5})
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        for patcher in [patch.object(config, "PEERS_DIR", Path(self.tmpdir.name)),
+                        patch.object(utils, "get_external_ip", return_value="127.0.0.1")]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.client.close()
+        for tracker in self.trackers:
+            tracker.close()
+
+    def tracker(self, *args, **kwargs) -> StubTracker:
+        self.trackers.append(StubTracker(*args, **kwargs))
+        return self.trackers[-1]
+
+    def tracker_manager(self, tiers: List[List[bytes]]) -> md.TrackerManager:
+        tm = md.TrackerManager(make_metainfo(tiers), {"port": 6881}, client=self.client)
+        self.addCleanup(tm.close)
+        return tm
+
+
+class TrackerClientTests(TrackerTest):
+    def test_connections_are_kept_open(self):
+        tracker = self.tracker([("10.0.0.1", 1)])
+
+        for i in range(5):
+            answer = self.client.announce(tracker.url, {"info_hash": bytes([i]) * 20}).result()
+            self.assertIn(b"interval", answer)
+
+        self.assertEqual(len(tracker.announces), 5)
+        self.assertEqual(len(tracker.client_ports), 1)
+
+    def test_torrents_share_the_connections_to_a_host(self):
+        tracker = self.tracker([], delay=0.05)
+
+        futures = [
+            self.client.announce(tracker.url, {"info_hash": bytes([i]) * 20})
+            for i in range(10)
+        ]
+        for future in futures:
+            future.result()
+
+        self.assertEqual(len(tracker.announces), 10)
+        self.assertLessEqual(len(tracker.client_ports), tracker_client.CONNECTIONS_PER_HOST)
+
+    def test_slow_tracker_does_not_hold_the_threads(self):
+        slow, fast = self.tracker([], delay=0.5), self.tracker([])
+
+        # More than the threads of the pool, all for the same host
+        for i in range(tracker_client.MAX_ANNOUNCES + 8):
+            self.client.announce(slow.url, {"info_hash": bytes([i]) * 20})
+
+        start = time.monotonic()
+        self.client.announce(fast.url, {"info_hash": bytes(20)}).result(timeout=2)
+        self.assertLess(time.monotonic() - start, 0.4)
+        self.assertLessEqual(len(slow.announces), tracker_client.CONNECTIONS_PER_HOST)
+
+    def test_identical_announces_are_sent_once(self):
+        tracker = self.tracker([], delay=0.1)
+
+        params = {"info_hash": bytes(20), "event": "started"}
+        first = self.client.announce(tracker.url, params)
+        self.assertIs(self.client.announce(tracker.url, dict(params)), first)
+        first.result()
+        self.assertEqual(len(tracker.announces), 1)
+
+    def test_start_without_answers(self):
+        dead, dead_url = dead_tracker()
+        tm = self.tracker_manager([[dead_url], [b"http://127.0.0.1:1/announce"]])
+
+        start = time.monotonic()
+        self.assertEqual(start_and_wait(tm), [])
+        self.assertLess(time.monotonic() - start, 1.5)
+        dead.close()
+
+    def test_start_in_background(self):
+        tracker = self.tracker([("10.0.0.1", 1), ("10.0.0.2", 2)], delay=0.2)
+        tm = self.tracker_manager([[tracker.url]])
+
+        start = time.monotonic()
+        tm.start()
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertEqual(
+            {tm.queue_for_new_peers.get(timeout=2) for _ in range(2)},
+            {("10.0.0.1", 1), ("10.0.0.2", 2)}
+        )
+
+    def test_peers_are_remembered(self):
+        tracker = self.tracker([("10.0.0.1", 1), ("10.0.0.2", 2)])
+        tm = self.tracker_manager([[tracker.url]])
+        self.assertEqual(tm.cached_peers(), [])
+        start_and_wait(tm)
+
+        # Next session
+        tm = self.tracker_manager([[tracker.url]])
+        self.assertEqual(set(tm.cached_peers()), {("10.0.0.1", 1), ("10.0.0.2", 2)})
+        # Already known: not queued again
+        tm.start()
+        time.sleep(0.2)
+        self.assertTrue(tm.queue_for_new_peers.empty())
+
+    def test_scrape(self):
+        tracker = self.tracker([], seeders=7)
+
+        info_hashes = [bytes([i]) * 20 for i in range(3)]
+        files = self.client.scrape(tracker.url, info_hashes).result()
+        self.assertEqual(set(files), set(info_hashes))
+        self.assertEqual(files[info_hashes[0]][b"complete"], 7)
+
+        self.assertEqual(tracker_client.scrape_url("http://t.org/announce.php?k=1"),
+                         "http://t.org/scrape.php?k=1")
+        self.assertIsNone(tracker_client.scrape_url("http://t.org/a"))
+        with self.assertRaises(ValueError):
+            self.client.scrape("http://t.org/a", info_hashes)
+
+
+class TierTests(TrackerTest):
+    """ Announces to tiers of trackers (BEP 12). """
+
+    def test_tiers(self):
+        tiers = [[b"http://a/announce", b"http://b/announce"], [b"http://c/announce"]]
+        metainfo = make_metainfo(tiers)
+        self.assertEqual([sorted(tier) for tier in metainfo.tiers], tiers)
+        self.assertEqual(set(metainfo.trackers), {url for tier in tiers for url in tier})
+
+    def test_next_tier_only_on_failure(self):
+        first, second = self.tracker([("10.0.0.1", 1)]), self.tracker([("10.0.0.2", 2)])
+        tm = self.tracker_manager([[first.url], [second.url]])
+
+        self.assertEqual(start_and_wait(tm), [("10.0.0.1", 1)])
+        self.assertEqual(len(second.announces), 0)
+
+    def test_first_answer_wins(self):
+        fast = self.tracker([("10.0.0.1", 1)])
+        slow = self.tracker([("10.0.0.1", 1), ("10.0.0.2", 2)], delay=0.3)
+        dead, dead_url = dead_tracker()
+        tm = self.tracker_manager([[slow.url, dead_url, fast.url]])
+
+        start = time.monotonic()
+        peers = start_and_wait(tm)
+        self.assertLess(time.monotonic() - start, 0.25)
+        self.assertEqual(peers, [("10.0.0.1", 1)])
+        self.assertEqual(tm.tiers[0][0].url, fast.url)
+
+        # The others, when they answer (or time out), only add new peers
+        self.assertEqual(tm.queue_for_new_peers.get(timeout=2), ("10.0.0.2", 2))
+        time.sleep(0.5)
+        self.assertTrue(tm.queue_for_new_peers.empty())
+        dead.close()
+
+    def test_slow_tier_does_not_delay_the_next(self):
+        dead, dead_url = dead_tracker()
+        tracker = self.tracker([("10.0.0.1", 1)])
+        tm = self.tracker_manager([[dead_url], [tracker.url]])
+
+        start = time.monotonic()
+        with patch.object(md, "TIER_PATIENCE", 0.1):
+            self.assertEqual(start_and_wait(tm), [("10.0.0.1", 1)])
+        self.assertLess(time.monotonic() - start, 0.4)
+        dead.close()
+
+    def test_all_tiers_failing_out_of_order(self):
+        # The last tier, started by impatience, fails before the first one
+        dead, dead_url = dead_tracker()
+        tm = self.tracker_manager([[dead_url], [b"http://127.0.0.1:1/announce"]])
+
+        answers = Queue()
+        with patch.object(md, "TIER_PATIENCE", 0.1):
+            tm.announce({}, answers.put)
+            self.assertIsNone(answers.get(timeout=2))
+        dead.close()
+
+    def test_failed_trackers_back_off(self):
+        dead, dead_url = dead_tracker()
+        tracker = self.tracker([("10.0.0.1", 1)])
+        tm = self.tracker_manager([[dead_url, tracker.url]])
+        dead_status = next(status for status in tm.tiers[0] if status.url == dead_url)
+
+        def announce_until_the_dead_one_fails(failures: int):
+            tm.announce({}, lambda _: None)
+            deadline = time.monotonic() + 2
+            while dead_status.failures < failures and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(dead_status.failures, failures)
+
+        announce_until_the_dead_one_fails(1)
+        self.assertEqual([status.url for status in tm.tiers[0]], [tracker.url, dead_url])
+        backoff = dead_status.retry_at - time.monotonic()
+        self.assertAlmostEqual(backoff, md.TRACKER_BACKOFF, delta=5)
+
+        # Doubling
+        for failures in (2, 3):
+            dead_status.retry_at = 0
+            announce_until_the_dead_one_fails(failures)
+
+        backoff = dead_status.retry_at - time.monotonic()
+        self.assertAlmostEqual(backoff, 4 * md.TRACKER_BACKOFF, delta=5)
+        dead.close()
+
+    def test_unhealthy_swarms_announce_at_min_interval(self):
+        tracker = self.tracker([], interval=1800, min_interval=60, seeders=1)
+        tm = self.tracker_manager([[tracker.url]])
+        start_and_wait(tm)
+
+        self.assertFalse(tm.healthy())
+        self.assertAlmostEqual(tm.next_announce_delay(), 60, delta=1)
+
+        tracker.seeders = md.HEALTHY_SEEDERS
+        start_and_wait(tm)
+        self.assertTrue(tm.healthy())
+        self.assertAlmostEqual(tm.next_announce_delay(), 1800, delta=1)
+
+    def test_scrape_before_early_announces(self):
+        tracker = self.tracker([], interval=1800, min_interval=60, seeders=1)
+        tm = self.tracker_manager([[tracker.url]])
+        start_and_wait(tm)
+
+        # Healthy now: the early announce is skipped
+        tracker.seeders = 10
+        tm.notify_nothing_important()
+        deadline = time.monotonic() + 2
+        while not tm.healthy() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(len(tracker.scrapes), 1)
+        self.assertEqual(len(tracker.announces), 1)
+        self.assertAlmostEqual(tm.next_announce_delay(), 1800, delta=1)
+
+        # Unhealthy: scraped, then announced
+        tracker.seeders = 0
+        tm.notify_nothing_important()
+        deadline = time.monotonic() + 2
+        while len(tracker.announces) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(tracker.scrapes), 2)
+        self.assertEqual(len(tracker.announces), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
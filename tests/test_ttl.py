@@ -59,3 +59,14 @@ class TTL_tests(unittest.TestCase):
         self.ttl.extract(n=1)
         
         self.assertEqual(self.ttl.add("A"), 2)
+
+    def test_next_expiry(self):
+        self.assertIsNone(self.ttl.next_expiry())
+
+        self.ttl.add("A")
+        self.assertTrue(0.5 < self.ttl.next_expiry() <= 1)
+
+        time.sleep(1)
+        self.assertEqual(self.ttl.next_expiry(), 0)
+        self.ttl.extract(n=1)
+        self.assertIsNone(self.ttl.next_expiry())
@@ -0,0 +1,190 @@
+from unittest.mock import patch
+from pathlib import Path
+from typing import *
+
+import unittest
+import tempfile
+import threading
+import socket
+import struct
+import random
+import time
+import logging
+
+import Fiume.config as config
+import Fiume.utils as utils
+import Fiume.metainfo_decoder as md
+import Fiume.udp_tracker as udp
+import Fiume.tracker_client as tracker_client
+
+from tests.test_tracker import make_metainfo, start_and_wait
+
+logging.disable(logging.WARNING)
+
+
+class StubUdpTracker:
+    """
+    A UDP tracker (BEP 15) on loopback. Answers every announce with
+    `peers`, and every scrape with `swarms` (info_hash -> (seeders,
+    completed, leechers)). Drops the first `drop` datagrams it receives.
+    """
+    def __init__(self, peers: List[Tuple[str, int]] = [], swarms: Dict[bytes, Tuple] = {},
+                 drop: int = 0, interval: int = 1800):
+        self.peers, self.swarms, self.drop, self.interval = peers, swarms, drop, interval
+        self.received: List[int] = list() # actions
+        self.announces: List[Tuple] = list()
+        self.connection_ids: Set[int] = set()
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.url = "udp://127.0.0.1:{}/announce".format(self.sock.getsockname()[1]).encode()
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                data, sender = self.sock.recvfrom(2048)
+            except OSError:
+                return
+
+            connection_id, action, transaction_id = struct.unpack_from(">QII", data)
+            self.received.append(action)
+            if self.drop > 0:
+                self.drop -= 1
+                continue
+
+            if action == udp.CONNECT:
+                assert connection_id == udp.PROTOCOL_ID
+                new_id = random.getrandbits(64)
+                self.connection_ids.add(new_id)
+                answer = struct.pack(">IIQ", udp.CONNECT, transaction_id, new_id)
+
+            elif connection_id not in self.connection_ids:
+                answer = struct.pack(">II", udp.ERROR, transaction_id) + b"bad connection id"
+
+            elif action == udp.ANNOUNCE:
+                self.announces.append(udp.ANNOUNCE_REQUEST.unpack(data))
+                answer = struct.pack(
+                    ">IIIII", udp.ANNOUNCE, transaction_id, self.interval, 3, 5
+                ) + b"".join(
+                    socket.inet_aton(ip) + utils.to_bytes(port, 2) for ip, port in self.peers
+                )
+
+            elif action == udp.SCRAPE:
+                answer = struct.pack(">II", udp.SCRAPE, transaction_id)
+                for i in range(16, len(data), 20):
+                    answer += struct.pack(">III", *self.swarms.get(data[i:i+20], (0, 0, 0)))
+
+            self.sock.sendto(answer, sender)
+
+    def close(self):
+        self.sock.close()
+
+
+ANNOUNCE_PARAMS = {
+    "info_hash": bytes(range(20)), "peer_id": b"-FI0001-" + bytes(12), "port": 6881,
+    "downloaded": "0", "uploaded": "0", "left": "1000", "event": "started",
+}
+
+
+class UdpTrackerTests(unittest.TestCase):
+    def setUp(self):
+        self.client = udp.UdpTracker(base_timeout=0.05, max_retries=3)
+        self.trackers: List[StubUdpTracker] = list()
+
+    def tearDown(self):
+        self.client.close()
+        for tracker in self.trackers:
+            tracker.close()
+
+    def tracker(self, *args, **kwargs) -> StubUdpTracker:
+        self.trackers.append(StubUdpTracker(*args, **kwargs))
+        return self.trackers[-1]
+
+    def test_announce(self):
+        tracker = self.tracker(peers=[("10.0.0.1", 6881), ("10.0.0.2", 51413)])
+
+        answer = self.client.announce(tracker.url.decode(), ANNOUNCE_PARAMS)
+        self.assertEqual(answer[b"interval"], 1800)
+        self.assertEqual((answer[b"complete"], answer[b"incomplete"]), (5, 3))
+        self.assertEqual(len(answer[b"peers"]), 12)
+
+        request = tracker.announces[0]
+        self.assertEqual(request[3], ANNOUNCE_PARAMS["info_hash"])
+        self.assertEqual(request[6], 1000) # left
+        self.assertEqual(request[8], 2)    # started
+        self.assertEqual(request[-1], 6881)
+
+    def test_connection_id_is_reused(self):
+        tracker = self.tracker()
+        for _ in range(3):
+            self.client.announce(tracker.url.decode(), ANNOUNCE_PARAMS)
+        self.client.scrape(tracker.url.decode(), [bytes(20)])
+
+        self.assertEqual(tracker.received.count(udp.CONNECT), 1)
+        self.assertEqual(self.client.connects, 1)
+
+        # Expired: connects again
+        with patch.object(udp, "CONNECTION_ID_TTL", -1):
+            self.client.announce(tracker.url.decode(), ANNOUNCE_PARAMS)
+        self.assertEqual(tracker.received.count(udp.CONNECT), 2)
+
+    def test_lost_datagrams_are_sent_again(self):
+        tracker = self.tracker(drop=2) # the first connect, and the second
+
+        start = time.monotonic()
+        self.client.announce(tracker.url.decode(), ANNOUNCE_PARAMS)
+        # Waited 0.05, then 0.1: the third attempt is answered
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+        self.assertEqual(tracker.received, [udp.CONNECT] * 3 + [udp.ANNOUNCE])
+
+    def test_gives_up_eventually(self):
+        tracker = self.tracker(drop=100)
+
+        with self.assertRaises(TimeoutError):
+            self.client.announce(tracker.url.decode(), ANNOUNCE_PARAMS)
+        self.assertEqual(len(tracker.received), 4)
+
+    def test_errors(self):
+        tracker = self.tracker()
+        self.client.announce(tracker.url.decode(), ANNOUNCE_PARAMS)
+        tracker.connection_ids.clear() # eg. the tracker restarted
+
+        with self.assertRaisesRegex(udp.TrackerError, "bad connection id"):
+            self.client.announce(tracker.url.decode(), ANNOUNCE_PARAMS)
+
+    def test_scrape(self):
+        swarms = {bytes([i]) * 20: (i, 2 * i, 3 * i) for i in range(100)}
+        tracker = self.tracker(swarms=swarms)
+
+        files = self.client.scrape(tracker.url.decode(), list(swarms))
+        self.assertEqual(len(files), 100)
+        self.assertEqual(
+            files[bytes([7]) * 20],
+            {b"complete": 7, b"downloaded": 14, b"incomplete": 21}
+        )
+        self.assertEqual(tracker.received.count(udp.SCRAPE), 2) # 74 + 26
+
+
+class UdpTrackerManagerTests(unittest.TestCase):
+    def test_udp_and_http_trackers(self):
+        tracker = StubUdpTracker(peers=[("10.0.0.1", 6881)])
+        client = tracker_client.TrackerClient({"tracker_timeout": 0.5})
+
+        with patch.object(utils, "get_external_ip", return_value="127.0.0.1"), \
+             tempfile.TemporaryDirectory() as tmpdir, \
+             patch.object(config, "PEERS_DIR", Path(tmpdir)):
+            tm = md.TrackerManager(
+                make_metainfo([[tracker.url], [b"http://127.0.0.1:1/announce"]]),
+                {"port": 6882}, client=client
+            )
+            peers = start_and_wait(tm)
+        self.assertEqual(peers, [("10.0.0.1", 6881)])
+
+        tm.close()
+        client.close()
+        tracker.close()
+
+
+if __name__ == "__main__":
+    unittest.main()